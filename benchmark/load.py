@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+import getopt
+import sys
+import os
+import ssl
+import json
+import time
+import socket
+import resource
+import tempfile
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server", "server.py")
+USAGE = "Usage: load.py [-m process,async] [-i idle_clients] [-c active_clients] [-n commands_per_client] " \
+        "[-p main_port] [-t transfer_port] [-o output.json]"
+
+
+def read_options() -> dict:
+    """
+    Reads command-line options. Every option has a default value, so the benchmark can be run without any
+
+    :return: dictionary with the benchmark settings
+    """
+    (opt, arg) = getopt.getopt(sys.argv[1:], 'm:i:c:n:p:t:o:h', ['modes=', 'idle=', 'clients=', 'commands=', 'port=',
+                                                                 'transfer-port=', 'output=', 'help'])
+    options = {"modes": ["process", "async"], "idle": 200, "clients": 20, "commands": 50,
+               "port": 18080, "transfer_port": 13000, "output": None}
+
+    for (option, argument) in opt:
+        if option in ('-m', '--modes'):
+            options["modes"] = argument.split(",")
+        elif option in ('-i', '--idle'):
+            options["idle"] = int(argument)
+        elif option in ('-c', '--clients'):
+            options["clients"] = int(argument)
+        elif option in ('-n', '--commands'):
+            options["commands"] = int(argument)
+        elif option in ('-p', '--port'):
+            options["port"] = int(argument)
+        elif option in ('-t', '--transfer-port'):
+            options["transfer_port"] = int(argument)
+        elif option in ('-o', '--output'):
+            options["output"] = argument
+        elif option in ('-h', '--help'):
+            print(USAGE)
+            sys.exit(0)
+    return options
+
+
+def generate_cert(directory: str) -> str:
+    """
+    Generates a self-signed certificate and private key, stored in the same .pem file, like the README explains
+
+    :param directory: directory where the .pem file is created
+    :return: path to the .pem file
+    """
+    cert_path = os.path.join(directory, "cert.pem")
+    subprocess.run(["openssl", "req", "-new", "-x509", "-days", "1", "-nodes", "-subj", "/CN=localhost",
+                    "-out", cert_path, "-keyout", cert_path], check=True, capture_output=True)
+    return cert_path
+
+
+def start_server(mode: str, options: dict, cert_path: str, workdir: str) -> subprocess.Popen:
+    """
+    Runs server.py in the given mode and waits until its main port accepts connections
+
+    :return: Popen object of the server process
+    """
+    served_root = os.path.join(workdir, f"served-{mode}")
+    os.makedirs(served_root, exist_ok=True)
+    for i in range(100):
+        open(os.path.join(served_root, f"file-{i}.txt"), "w").close()
+
+    env = dict(os.environ, PATH_TO_CERT=cert_path, HOME=served_root, CHECKSUM_CACHE_PATH=os.path.join(workdir, f"{mode}.db"))
+    server = subprocess.Popen([sys.executable, SERVER_PATH, "-p", str(options["port"]), "-t", str(options["transfer_port"]),
+                               "-m", mode], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", options["port"]), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"Server didn't start in {mode} mode")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    server.send_signal(2)
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def process_tree(pid: int) -> list:
+    """
+    :return: list with the given pid and the pids of all its descendants, read from /proc
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                ppid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def memory_kib(pid: int) -> int:
+    """
+    Proportional set size (or resident set size where PSS isn't available) of a process and all its
+    descendants. PSS splits shared pages between the processes using them, so forked children aren't
+    counted several times
+
+    :return: memory in KiB
+    """
+    total = 0
+    for process in process_tree(pid):
+        for path, field in ((f"/proc/{process}/smaps_rollup", "Pss:"), (f"/proc/{process}/status", "VmRSS:")):
+            try:
+                with open(path) as memory_file:
+                    total += next(int(line.split()[1]) for line in memory_file if line.startswith(field))
+                break
+            except (OSError, StopIteration):
+                continue
+    return total
+
+
+def connect(context: ssl.SSLContext, port: int) -> ssl.SSLSocket:
+    client_socket = socket.create_connection(("127.0.0.1", port))
+    return context.wrap_socket(client_socket)
+
+
+def round_trip(client_socket: ssl.SSLSocket, command: str, argument: str = None) -> float:
+    started = time.perf_counter()
+    client_socket.send(json.dumps({"command": command, "argument": argument}).encode())
+    json.loads(client_socket.recv(4096).decode())
+    return time.perf_counter() - started
+
+
+def active_client(context: ssl.SSLContext, port: int, commands: int) -> list:
+    latencies = []
+    with connect(context, port) as client_socket:
+        for i in range(commands):
+            latencies.append(round_trip(client_socket, ("pwd", "ls")[i % 2]))
+    return latencies
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_mode(mode: str, options: dict, cert_path: str, workdir: str) -> dict:
+    """
+    Benchmarks one server mode: opens idle_clients connections and keeps them open, measures the server
+    memory and processes, and then measures round-trip latency of pwd/ls commands of active_clients
+    concurrent clients while the idle ones are still connected
+
+    :return: dictionary with the results of the mode
+    """
+    context = ssl.create_default_context(cafile=cert_path)
+    context.check_hostname = False
+    server = start_server(mode, options, cert_path, workdir)
+    idle_sockets = []
+    try:
+        base_memory = memory_kib(server.pid)
+        started = time.perf_counter()
+        for _ in range(options["idle"]):
+            idle_sockets.append(connect(context, options["port"]))
+        connect_seconds = time.perf_counter() - started
+        time.sleep(1)
+        idle_memory = memory_kib(server.pid)
+        idle_processes = len(process_tree(server.pid))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["clients"]) as executor:
+            results = executor.map(lambda _: active_client(context, options["port"], options["commands"]), range(options["clients"]))
+            latencies = [latency for client_latencies in results for latency in client_latencies]
+        elapsed = time.perf_counter() - started
+    finally:
+        for idle_socket in idle_sockets:
+            idle_socket.close()
+        stop_server(server)
+
+    return {
+        "mode": mode,
+        "idle_clients": options["idle"],
+        "idle_connect_seconds": round(connect_seconds, 3),
+        "base_memory_kib": base_memory,
+        "idle_memory_kib": idle_memory,
+        "memory_per_idle_client_kib": round((idle_memory - base_memory) / max(1, options["idle"]), 1),
+        "idle_processes": idle_processes,
+        "active_clients": options["clients"],
+        "commands": len(latencies),
+        "commands_per_second": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies) * 1000, 3),
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(max(latencies) * 1000, 3)
+        }
+    }
+
+
+def main() -> None:
+    """
+    Runs the load benchmark for every requested mode and prints the results as json, also writing
+    them to the output file if one was given
+
+    :return: None
+    """
+    options = read_options()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with tempfile.TemporaryDirectory(prefix="file-server-bench-") as workdir:
+        cert_path = generate_cert(workdir)
+        results = {"benchmark": "load", "timestamp": time.time(), "results": [run_mode(mode, options, cert_path, workdir) for mode in options["modes"]]}
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if options["output"]:
+        with open(options["output"], "w") as output_file:
+            output_file.write(output)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (getopt.GetoptError, ValueError) as e:
+        print("Error:", e)
+        print(USAGE)
@@ -0,0 +1,489 @@
+#!/usr/bin/python3
+
+import getopt
+import sys
+import os
+import ssl
+import json
+import time
+import socket
+import random
+import platform
+import resource
+import tempfile
+import threading
+import statistics
+import subprocess
+import multiprocessing
+from contextlib import suppress
+from load import generate_cert, start_server, stop_server, process_tree, percentile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+import models
+
+
+REPOSITORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+USAGE = "Usage: suite.py [-m process,async,prefork] [-c concurrent_clients] [-n commands_per_client] " \
+        "[-s 64K,1M,16M] [-r repeats] [-k handshakes_per_client] [-p main_port] [-t transfer_port] [-o output.json]\n" \
+        "       suite.py --compare baseline.json results.json [--threshold percent]"
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+SEED = 2020
+CLIENT_TIMEOUT_SECONDS = 600
+PUT_COMMIT_TIMEOUT_SECONDS = 30
+MEMORY_SAMPLE_SECONDS = 0.05
+
+
+def read_options() -> dict:
+    """
+    Reads command-line options. Every option has a default value, so the benchmark can be run without any.
+    With --compare, the benchmark isn't run: two result files are compared instead
+
+    :return: dictionary with the benchmark settings
+    """
+    (opt, arg) = getopt.gnu_getopt(sys.argv[1:], 'm:c:n:s:r:k:p:t:o:h', ['modes=', 'clients=', 'commands=', 'sizes=',
+                                                                     'repeats=', 'handshakes=', 'port=', 'transfer-port=',
+                                                                     'output=', 'compare=', 'threshold=', 'help'])
+    options = {"modes": ["process", "async", "prefork"], "clients": 8, "commands": 200, "sizes": ["64K", "1M", "16M"],
+               "repeats": 3, "handshakes": 50, "port": 18080, "transfer_port": 13000, "output": None,
+               "compare": None, "threshold": 10.0}
+
+    for (option, argument) in opt:
+        if option in ('-m', '--modes'):
+            options["modes"] = argument.split(",")
+        elif option in ('-c', '--clients'):
+            options["clients"] = int(argument)
+        elif option in ('-n', '--commands'):
+            options["commands"] = int(argument)
+        elif option in ('-s', '--sizes'):
+            options["sizes"] = argument.split(",")
+            for size in options["sizes"]:
+                parse_size(size)
+        elif option in ('-r', '--repeats'):
+            options["repeats"] = int(argument)
+        elif option in ('-k', '--handshakes'):
+            options["handshakes"] = int(argument)
+        elif option in ('-p', '--port'):
+            options["port"] = int(argument)
+        elif option in ('-t', '--transfer-port'):
+            options["transfer_port"] = int(argument)
+        elif option in ('-o', '--output'):
+            options["output"] = argument
+        elif option == '--compare':
+            if len(arg) != 1:
+                raise ValueError("--compare needs the baseline file and the results file")
+            options["compare"] = (argument, arg[0])
+        elif option == '--threshold':
+            options["threshold"] = float(argument)
+        elif option in ('-h', '--help'):
+            print(USAGE)
+            sys.exit(0)
+    if min(options["clients"], options["commands"], options["repeats"], options["handshakes"]) < 1:
+        raise ValueError("Clients, commands, repeats and handshakes must be positive integers")
+    return options
+
+
+def parse_size(size: str) -> int:
+    """
+    :param size: String with a number of bytes, optionally followed by K, M or G, like 16M
+    :return: number of bytes
+    """
+    if size[-1:].upper() in SIZE_UNITS and size[:-1].isdigit():
+        return int(size[:-1]) * SIZE_UNITS[size[-1:].upper()]
+    if size.isdigit():
+        return int(size)
+    raise ValueError(f"Invalid file size '{size}'")
+
+
+def generate_file(path: str, size: int) -> None:
+    """
+    Writes a file of random, incompressible bytes. The generator is seeded, so every run transfers the same files
+    """
+    generator = random.Random(f"{SEED}-{size}")
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1024 * 1024)
+            file.write(generator.randbytes(chunk))
+            remaining -= chunk
+
+
+def blob_name(size: str) -> str:
+    return f"blob-{size}.bin"
+
+
+def rss_kib(pid: int) -> int:
+    """
+    :return: resident set size of a process and all its descendants, in KiB
+    """
+    total = 0
+    for process in process_tree(pid):
+        with suppress(OSError, StopIteration):
+            with open(f"/proc/{process}/status") as status_file:
+                total += next(int(line.split()[1]) for line in status_file if line.startswith("VmRSS:"))
+    return total
+
+
+class MemorySampler(threading.Thread):
+    """
+    Thread sampling the resident memory of the server's process tree until it's stopped, keeping the peak
+    """
+    def __init__(self, pid: int):
+        super().__init__(daemon=True)
+        self.__pid = pid
+        self.__stopped = threading.Event()
+        self.peak = 0
+
+    def run(self) -> None:
+        while not self.__stopped.wait(MEMORY_SAMPLE_SECONDS):
+            self.peak = max(self.peak, rss_kib(self.__pid))
+
+    def stop(self) -> int:
+        self.__stopped.set()
+        self.join()
+        return self.peak
+
+
+"""Synthetic clients, each one runs in a process of its own"""
+
+
+def client_context(cert_path: str) -> ssl.SSLContext:
+    context = ssl.create_default_context(cafile=cert_path)
+    context.check_hostname = False
+    return context
+
+
+def open_client(settings: dict, streams: int = 1) -> models.Client:
+    """
+    Connects a models.Client to the server, the same way client.py does. The client changes to the directory
+    in HOME, which is the directory of its process
+
+    :param settings: dictionary with the settings of the run (see run_mode())
+    :param streams: number of streams of the client's downloads, 1 to measure single-stream throughput
+    :return: the connected models.Client
+    """
+    context = client_context(settings["cert_path"])
+    client_socket = context.wrap_socket(socket.create_connection(("127.0.0.1", settings["port"])))
+    return models.Client("127.0.0.1", client_socket, context, streams)
+
+
+def close_client(client: models.Client) -> None:
+    with suppress(SystemExit):
+        client.disconnect()
+
+
+def run_clients(count: int, target, *args) -> list:
+    """
+    Runs target in count client processes at the same time. Each process gets its own working directory (the
+    clients change to it and download to it) and its output is discarded, so progress bars don't get measured.
+    Targets connect first and then wait for the others at the barrier, so the measured part starts at once
+
+    :param count: number of client processes
+    :param target: function called as target(index, barrier, *args) in each process, returning its results
+    :return: list with the results of each process, in order
+    """
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(count)
+    results = context.Queue()
+    processes = [context.Process(target=client_process, args=(index, barrier, results, target, args), daemon=True)
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    try:
+        outcomes = dict(results.get(timeout=CLIENT_TIMEOUT_SECONDS) for _ in processes)
+    finally:
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+    for outcome in outcomes.values():
+        if isinstance(outcome, BaseException):
+            raise RuntimeError(f"A benchmark client failed: {outcome!r}")
+    return [outcomes[index] for index in range(count)]
+
+
+def client_process(index: int, barrier, results, target, args: tuple) -> None:
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    directory = os.path.join(args[0]["clients_path"], str(index))
+    os.makedirs(directory, exist_ok=True)
+    os.environ["HOME"] = directory
+    try:
+        results.put((index, target(index, barrier, *args)))
+    except BaseException as e:
+        barrier.abort()
+        results.put((index, RuntimeError(f"client {index}: {e!r}")))
+
+
+def command_client(index: int, barrier, settings: dict) -> dict:
+    """
+    Sends pwd, ls and cd commands (cd goes into a directory and back out of it), and measures the round trip
+    of each one: from sending the command to having read, and printed, the whole answer
+
+    :return: dictionary with the latencies of each command, in seconds, and when the commands started and ended
+    """
+    client = open_client(settings)
+    latencies = {"pwd": [], "ls": [], "cd": []}
+    commands = (("pwd", None), ("ls", None), ("cd", "directory"), ("cd", ".."))
+    barrier.wait()
+    started = time.monotonic()
+    for i in range(settings["commands"]):
+        command, argument = commands[i % len(commands)]
+        command_started = time.perf_counter()
+        client.execute(command, argument)
+        latencies[command].append(time.perf_counter() - command_started)
+    ended = time.monotonic()
+    close_client(client)
+    return {"latencies": latencies, "started": started, "ended": ended}
+
+
+def transfer_client(index: int, barrier, settings: dict, operation: str, size: str) -> dict:
+    """
+    Downloads (get) or uploads (put) a file repeats times, with a single stream, and measures each transfer from
+    the request to the file being complete and verified on the other side. Downloads are warmed up with an
+    untimed one, so the server's checksum cache is filled like in a long running server. Uploads go to a new
+    directory each time, since put doesn't replace files
+
+    :return: dictionary with the seconds each transfer took, and when the transfers started and ended
+    """
+    name = blob_name(size)
+    filesize = parse_size(size)
+    client = open_client(settings)
+    if operation == "put" and not os.path.exists(name):
+        os.link(os.path.join(settings["source_path"], name), name)
+    elif operation == "get":
+        client.get(name)
+        os.remove(name)
+    durations = []
+    barrier.wait()
+    started = time.monotonic()
+    for i in range(settings["repeats"]):
+        directory = f"put-{size}-{os.getpid()}-{i}"
+        if operation == "put":
+            client.execute("mkdir", directory)
+            client.execute("cd", directory)
+        transfer_started = time.perf_counter()
+        if operation == "put":
+            client.put(name)
+            wait_for_file(os.path.join(settings["served_path"], directory, name), filesize)
+        else:
+            client.get(name)
+        durations.append(time.perf_counter() - transfer_started)
+        if operation == "put":
+            client.execute("cd", "..")
+        elif os.path.getsize(name) != filesize:
+            raise RuntimeError(f"Download of {name} is incomplete")
+        else:
+            os.remove(name)
+    ended = time.monotonic()
+    close_client(client)
+    return {"durations": durations, "started": started, "ended": ended}
+
+
+def wait_for_file(path: str, size: int) -> None:
+    """
+    Waits until the server moved an upload to its final path. The client doesn't wait for it, the server
+    verifies the file after the client closed the transfer
+    """
+    deadline = time.monotonic() + PUT_COMMIT_TIMEOUT_SECONDS
+    while not (os.path.isfile(path) and os.path.getsize(path) == size):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Upload of {path} wasn't committed")
+        time.sleep(0.001)
+
+
+def handshake_client(index: int, barrier, settings: dict) -> dict:
+    """
+    Opens and closes connections to the main port, each with a full TLS handshake (no session resumption)
+
+    :return: dictionary with the seconds each connection took to be established, and when they started and ended
+    """
+    context = client_context(settings["cert_path"])
+    latencies = []
+    barrier.wait()
+    started = time.monotonic()
+    for _ in range(settings["handshakes"]):
+        handshake_started = time.perf_counter()
+        with context.wrap_socket(socket.create_connection(("127.0.0.1", settings["port"]))):
+            latencies.append(time.perf_counter() - handshake_started)
+    ended = time.monotonic()
+    return {"latencies": latencies, "started": started, "ended": ended}
+
+
+"""Results"""
+
+
+def latency_summary(latencies: list) -> dict:
+    return {
+        "mean": round(statistics.mean(latencies) * 1000, 3),
+        "p50": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99": round(percentile(latencies, 0.99) * 1000, 3),
+        "max": round(max(latencies) * 1000, 3)
+    }
+
+
+def elapsed(outcomes: list) -> float:
+    """
+    :return: seconds from the first client starting to the last one ending
+    """
+    return max(outcome["ended"] for outcome in outcomes) - min(outcome["started"] for outcome in outcomes)
+
+
+def throughput(outcomes: list, filesize: int) -> dict:
+    """
+    :return: dictionary with the throughput of the transfers, in MiB/s. For a single client, it's the median of its
+    transfers, for concurrent ones the aggregate: every byte transferred over the time all of them took
+    """
+    if len(outcomes) == 1:
+        return {"mib_per_second": round(filesize / statistics.median(outcomes[0]["durations"]) / 1024 ** 2, 2)}
+    transfers = sum(len(outcome["durations"]) for outcome in outcomes)
+    durations = [duration for outcome in outcomes for duration in outcome["durations"]]
+    return {"mib_per_second": round(transfers * filesize / elapsed(outcomes) / 1024 ** 2, 2),
+            "transfer_ms": latency_summary(durations)}
+
+
+def run_mode(mode: str, options: dict, cert_path: str, workdir: str) -> dict:
+    """
+    Benchmarks one server mode, with the server's memory sampled all along:
+    - round trip of pwd, ls and cd commands, sent by concurrent clients
+    - throughput of get and put of each file size, for a single client and for concurrent clients
+    - rate of full TLS handshakes, of concurrent clients connecting over and over
+
+    :return: dictionary with the results of the mode
+    """
+    served_path = os.path.join(workdir, f"served-{mode}")
+    os.makedirs(os.path.join(served_path, "directory"), exist_ok=True)
+    for size in options["sizes"]:
+        os.link(os.path.join(workdir, "source", blob_name(size)), os.path.join(served_path, blob_name(size)))
+    settings = dict(options, cert_path=cert_path, served_path=served_path, source_path=os.path.join(workdir, "source"),
+                    clients_path=os.path.join(workdir, f"clients-{mode}"))
+
+    server = start_server(mode, options, cert_path, workdir)
+    sampler = MemorySampler(server.pid)
+    try:
+        base_rss = rss_kib(server.pid)
+        sampler.start()
+
+        outcomes = run_clients(options["clients"], command_client, settings)
+        commands = {"clients": options["clients"],
+                    "per_second": round(options["clients"] * options["commands"] / elapsed(outcomes), 1),
+                    "latency_ms": {command: latency_summary([latency for outcome in outcomes for latency in outcome["latencies"][command]])
+                                   for command in ("pwd", "ls", "cd")}}
+
+        transfers = {}
+        for size in options["sizes"]:
+            transfers[size] = {}
+            for operation in ("get", "put"):
+                transfers[size][operation] = {
+                    "single": throughput(run_clients(1, transfer_client, settings, operation, size), parse_size(size)),
+                    "concurrent": throughput(run_clients(options["clients"], transfer_client, settings, operation, size),
+                                             parse_size(size))
+                }
+
+        outcomes = run_clients(options["clients"], handshake_client, settings)
+        handshakes = {"clients": options["clients"],
+                      "per_second": round(options["clients"] * options["handshakes"] / elapsed(outcomes), 1),
+                      "latency_ms": latency_summary([latency for outcome in outcomes for latency in outcome["latencies"]])}
+    finally:
+        peak_rss = sampler.stop() if sampler.is_alive() else 0
+        stop_server(server)
+
+    return {"commands": commands, "transfers": transfers, "handshakes": handshakes,
+            "memory": {"base_rss_kib": base_rss, "peak_rss_kib": peak_rss}}
+
+
+def environment() -> dict:
+    """
+    :return: dictionary describing what was benchmarked and where: the commit (and whether the tree had changes),
+    python, the platform and the number of CPUs
+    """
+    def git(*args) -> str:
+        result = subprocess.run(["git", "-C", REPOSITORY_PATH, *args], capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(status) if status is not None else None,
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+"""Comparison"""
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    """
+    :return: dictionary with every number of the results, keyed by its path, like process.commands.latency_ms.pwd.p50
+    """
+    values = {}
+    for key, value in results.items():
+        path = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def higher_is_better(path: str) -> bool:
+    return "per_second" in path
+
+
+def compare(baseline_path: str, results_path: str, threshold: float) -> bool:
+    """
+    Prints how every measurement changed between two result files. Throughput and rates are better when they
+    grow, latencies and memory when they shrink. Changes worse than threshold percent are marked as regressions
+
+    :return: True if there were no regressions
+    """
+    with open(baseline_path) as baseline_file, open(results_path) as results_file:
+        baseline, results = json.load(baseline_file), json.load(results_file)
+    print(f"{baseline['environment']['commit']} -> {results['environment']['commit']}")
+    before, after = flatten(baseline["results"]), flatten(results["results"])
+    regressions = 0
+    for path in sorted(before.keys() & after.keys()):
+        if path.endswith(".clients"):
+            continue
+        change = (after[path] - before[path]) / before[path] * 100 if before[path] else 0.0
+        worse = -change if higher_is_better(path) else change
+        mark = "REGRESSION" if worse > threshold else ""
+        regressions += bool(mark)
+        print(f"{path:60} {before[path]:>12} {after[path]:>12} {change:>+8.1f}% {mark}")
+    print(f"{regressions} regressions over {threshold}%")
+    return not regressions
+
+
+def main() -> None:
+    """
+    Runs the benchmark suite for every requested mode and prints the results as json, also writing them to the
+    output file if one was given. With --compare, compares two result files instead, and exits with status 1 if
+    there were regressions
+
+    :return: None
+    """
+    options = read_options()
+    if options["compare"] is not None:
+        sys.exit(0 if compare(*options["compare"], options["threshold"]) else 1)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with tempfile.TemporaryDirectory(prefix="file-server-suite-") as workdir:
+        cert_path = generate_cert(workdir)
+        os.makedirs(os.path.join(workdir, "source"))
+        for size in options["sizes"]:
+            generate_file(os.path.join(workdir, "source", blob_name(size)), parse_size(size))
+        settings = {key: options[key] for key in ("clients", "commands", "sizes", "repeats", "handshakes")}
+        results = {"benchmark": "suite", "timestamp": time.time(), "environment": environment(), "settings": settings,
+                   "results": {mode: run_mode(mode, options, cert_path, workdir) for mode in options["modes"]}}
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if options["output"]:
+        with open(options["output"], "w") as output_file:
+            output_file.write(output)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except (getopt.GetoptError, ValueError) as e:
+        print("Error:", e)
+        print(USAGE)
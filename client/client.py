@@ -1,22 +1,29 @@
 #!/usr/bin/python3
 
+import time
+STARTED = time.perf_counter()
+
 import getopt
 import sys
 import models
 import socket
 import ssl
 import os
-from dotenv import load_dotenv
+IMPORTED = time.perf_counter()
 
 
 def load_cert() -> None:
     """
     First function called on client run. It would search for a .env file containing
-    the path to a SSL cert-chain file. If the file is missing, program will end
+    the path to a SSL cert-chain file. If the file is missing, program will end. If PATH_TO_CERT is
+    already in the environment, like in a cron job that sets it, the .env file isn't read, and dotenv isn't
+    even imported
 
     :return: None
     """
-    load_dotenv()
+    if os.getenv("PATH_TO_CERT") is None:
+        from dotenv import load_dotenv
+        load_dotenv()
     if os.getenv("PATH_TO_CERT") is None:
         print(models.Constants.MISSING_DOTENV)
         exit()
@@ -28,14 +35,22 @@ def load_cert() -> None:
 def read_options() -> tuple:
     """
     Reads command-line options looking for address and port number to connect to, in case that one
-    or both options are missing, it will print an error message and exit
-
-    :return: a tuple with two values (the address and the port)
+    or both options are missing, it will print an error message and exit. Optionally, a file with
+    commands to run non-interactively can be given with -b/--batch ('-' reads them from stdin), the
+    number of parallel streams used to download big files with -s/--streams, a codec to compress
+    transfers with -z/--compress (zlib, bz2 or lzma, optionally with a level, like lzma:9), and -t/--timings
+    to print how long each step of the startup took. Whatever follows the options is a single command to
+    run instead of showing the prompt (client.py -a address -p port get file.txt)
+
+    :return: a tuple with seven values (the address, the port, the batch file or None, the streams, the
+    compression or None, True if timings were asked for, and the command or None)
     """
-    address = port = None
-    (opt, arg) = getopt.getopt(sys.argv[1:], "a:p:", ["address=", "port="])
+    address = port = batch = compression = None
+    streams = models.Constants.DEFAULT_STREAMS
+    timings = False
+    (opt, arg) = getopt.getopt(sys.argv[1:], "a:p:b:s:z:t", ["address=", "port=", "batch=", "streams=", "compress=", "timings"])
 
-    if len(opt) != 2:
+    if len(opt) < 2:
         print(models.Constants.OPT_LEN_ERROR)
         sys.exit(0)
 
@@ -46,36 +61,80 @@ def read_options() -> tuple:
                 raise ValueError(models.Constants.OPT_VALUE_ERROR)
         elif option == "-a" or option == "--address":
             address = argument
+        elif option == "-b" or option == "--batch":
+            batch = argument if argument == "-" else os.path.abspath(argument)
+        elif option == "-s" or option == "--streams":
+            streams = int(argument)
+            if streams < 1:
+                raise ValueError(models.Constants.STREAMS_VALUE_ERROR)
+        elif option == "-z" or option == "--compress":
+            codec, _, level = argument.partition(":")
+            if codec not in models.Constants.CODECS or (level and not (level.isdigit() and int(level) in models.Constants.COMPRESSION_LEVELS)):
+                raise ValueError(models.Constants.COMPRESSION_VALUE_ERROR)
+            compression = argument
+        elif option == "-t" or option == "--timings":
+            timings = True
 
     assert port is not None and address is not None
 
-    return address, port
+    return address, port, batch, streams, compression, timings, " ".join(arg) or None
+
+
+def report_timings(steps: list) -> None:
+    """
+    Prints to stderr how long each step of the startup took, like python -X importtime does for imports
+
+    :param steps: list of tuples with the name of a step and the perf_counter() value when it ended, the
+    first one being when the client started
+    :return: None
+    """
+    for (_, started), (step, ended) in zip(steps, steps[1:]):
+        print(models.Constants.STARTUP_STEP.format(step, (ended - started) * 1000), file=sys.stderr)
+    print(models.Constants.STARTUP_STEP.format("total", (steps[-1][1] - steps[0][1]) * 1000), file=sys.stderr)
 
 
 def main() -> None:
     """
     Main client function, it will read command-line, create a models.Client instance
-    and call its run() method.
+    and call its run() method, or its run_batch() method if a batch file or a command was given.
+
+    The SSL context only trusts the certificate in PATH_TO_CERT, which is the one the server uses, so the
+    system's CA store isn't loaded, which took longer than the rest of the setup. The context is created
+    once, and the transfer connections reuse it and resume the TLS session of the main connection
 
     :return: None
     """
-
-    address, port = read_options()
-    context = ssl.create_default_context()
+    steps = [("start", STARTED), ("imports", IMPORTED)]
+    load_cert()
+    address, port, batch, streams, compression, timings, command = read_options()
+    steps.append(("options", time.perf_counter()))
+    context = ssl.create_default_context(cafile=os.getenv("PATH_TO_CERT"))
     context.check_hostname = False
-    context.load_verify_locations(os.getenv("PATH_TO_CERT"))
+    steps.append(("ssl context", time.perf_counter()))
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((address, port))
+    steps.append(("connection", time.perf_counter()))
     client_socket = context.wrap_socket(client_socket)
+    steps.append(("tls handshake", time.perf_counter()))
     print(models.Constants.connected_message(address, port))
 
-    client = models.Client(address, client_socket, context)
-    client.run()
+    client = models.Client(address, client_socket, context, streams, compression)
+    steps.append(("session", time.perf_counter()))
+    if timings:
+        report_timings(steps)
+    if command is not None:
+        client.run_batch([command])
+        client.disconnect()
+    elif batch is None:
+        client.run()
+    else:
+        with (sys.stdin if batch == "-" else open(batch)) as commands:
+            client.run_batch(commands)
+        client.disconnect()
 
 
 if __name__ == '__main__':
-    load_cert()
     try:
         main()
     except ConnectionRefusedError:
@@ -3,25 +3,75 @@ import os
 import json
 import threading
 from .FileManager import FileManager
-from .client_helper import Constants
+from .TransferChannel import TransferChannel
+from .MessageStream import MessageStream
+from .client_helper import Constants, find_request, calculate_block_checksums
 
 
 class Client:
     """
     Class representing a Client connected to the main socket of a file server
     """
-    def __init__(self, address, client_socket, context):
+    def __init__(self, address, client_socket, context, streams: int = Constants.DEFAULT_STREAMS, compression: str = None):
         self.__socket = client_socket
+        self.__stream = MessageStream(client_socket)
         self.__server_address = address
         self.__context = context
+        self.__streams = streams
+        self.__tls_session = None
+        self.__channel = None
+        self.__channel_supported = True
+        self.__channel_lock = threading.Lock()
+        self.__list_supported = True
+        self.__checksums = {}
         self.__prompt = Constants.prompt(address)
         if os.name == 'posix':
             os.chdir(os.getenv("HOME", default="/"))
 
-        self.__REMOTE_COMMANDS = ['pwd', 'cd', 'ls', 'mkdir']
-        self.__COMMANDS = {'lpwd': self.lpwd, 'lls': self.lls, 'help': self.show_help, 'clear': self.clear,
+        self.__REMOTE_COMMANDS = ['pwd', 'cd', 'mkdir']
+        self.__COMMANDS = {'ls': self.ls, 'lpwd': self.lpwd, 'lls': self.lls, 'help': self.show_help, 'clear': self.clear,
                            'c': self.clear, 'exit': self.disconnect, 'x': self.disconnect}
-        self.__COMMANDS_ARGS = {'lcd': self.lcd, 'lls': self.lls, 'lmkdir': self.lmkdir, 'get': self.get, 'put': self.put}
+        self.__COMMANDS_ARGS = {'ls': self.ls, 'find': self.find, 'lcd': self.lcd, 'lls': self.lls, 'lmkdir': self.lmkdir, 'get': self.get, 'put': self.put,
+                                'sync': self.sync}
+        self.negotiate_protocol()
+        self.__tls_session = client_socket.session
+        if compression is not None:
+            self.negotiate_compression(compression)
+
+    def negotiate_protocol(self) -> None:
+        """
+        Asks the server to switch to the framed (length-prefixed) protocol. Older servers answer with an
+        error, and the client keeps sending and reading unframed messages with them
+
+        :return: None
+        """
+        self.__stream.send({"command": "protocol", "argument": Constants.FRAMED_PROTOCOL_VERSION})
+        response = self.receive_response()
+        self.__stream.framed = int(response["status_code"]) == Constants.OK_STATUS_CODE
+
+    def negotiate_compression(self, compression: str) -> None:
+        """
+        Asks the server to compress this session's transfers. If the server doesn't support it, its answer is
+        shown and transfers aren't compressed
+
+        :param compression: String with the codec and, optionally, the level, like "zlib" or "lzma:9"
+        :return: None
+        """
+        self.__stream.send({"command": "compression", "argument": compression})
+        response = self.receive_response()
+        if int(response["status_code"]) != Constants.OK_STATUS_CODE:
+            self.show_response(response)
+
+    def receive_response(self) -> dict:
+        """
+        Waits for the next complete message from the server
+
+        :return: Dictionary representing the json-formatted message from the server
+        """
+        response = self.__stream.receive()
+        if response is None:
+            raise ConnectionResetError(Constants.CONNECTION_CLOSED)
+        return response
 
     def run(self) -> None:
         """
@@ -32,21 +82,131 @@ class Client:
         :return: None
         """
         while True:
-            user_input = input(self.__prompt).split()
-            if not user_input:
+            command, argument = self.parse_command(input(self.__prompt))
+            if command is not None:
+                self.execute(command, argument)
+
+    def run_batch(self, lines) -> None:
+        """
+        Non-interactive mode. Executes the commands read from a file (or stdin), one per line. Consecutive
+        remote commands, ls, get, put and sync included, are sent to the server as a single batch message, so a script
+        pays one round trip per group of commands instead of one per command. Local commands run in order,
+        once the commands before them were answered
+
+        :param lines: iterable of strings, each one a command as it would be typed in the prompt
+        :return: None
+        """
+        pending = []
+        for line in lines:
+            command, argument = self.parse_command(line)
+            if command is None:
                 continue
-            has_argument = len(user_input) >= 2
-            command = user_input[0]
-            argument = " ".join(user_input[1:]) if has_argument else None
-
-            if command in self.__REMOTE_COMMANDS:
-                self.communicate(command, argument)
-            elif command in self.__COMMANDS and argument is None:
-                self.__COMMANDS[command]()
-            elif command in self.__COMMANDS_ARGS and argument:
-                self.__COMMANDS_ARGS[command](argument)
+            is_valid_put = command in ('put', 'sync') and argument and os.path.isfile(argument)
+            is_single_get = command == 'get' and argument and not self.split_recursive(argument)[0]
+            if command == 'ls' and self.__stream.framed and self.__list_supported:
+                pending.append({"id": len(pending), **self.list_request(argument)})
+            elif is_valid_put:
+                pending.append({"id": len(pending), **self.upload_request(command, argument)})
+            elif command in self.__REMOTE_COMMANDS or is_single_get:
+                pending.append({"id": len(pending), "command": command, "argument": argument})
             else:
-                print(Constants.INVALID_COMMAND)
+                self.send_batch(pending)
+                pending = []
+                self.execute(command, argument)
+                continue
+            if len(pending) == Constants.BATCH_SIZE:
+                self.send_batch(pending)
+                pending = []
+        self.send_batch(pending)
+
+    def send_batch(self, commands: list) -> None:
+        """
+        Sends a list of commands in a single batch message and handles the answers in order, starting the
+        transfers of the get, put and sync commands that were allowed. Servers that don't speak the framed
+        protocol don't know batches either, so with them commands are sent one by one
+
+        :param commands: List of dictionaries, each one representing a command message with an "id"
+        :return: None
+        """
+        if not commands:
+            return
+        if not self.__stream.framed:
+            for request in commands:
+                self.execute(request["command"], request["argument"])
+            return
+
+        self.__stream.send({"command": "batch", "argument": commands})
+        response = self.receive_response()
+        if int(response["status_code"]) != Constants.OK_STATUS_CODE:
+            self.show_response(response)
+            return
+
+        responses = {answer.get("id"): answer for answer in response["content"]}
+        for request in commands:
+            if request["command"] in ('get', 'put', 'sync'):
+                self.start_transfer(request, responses[request["id"]])
+            elif request["command"] == 'list':
+                self.show_listing(request["argument"], responses[request["id"]])
+            else:
+                self.show_response(responses[request["id"]])
+
+    @staticmethod
+    def parse_command(line: str) -> tuple:
+        """
+        Splits a line typed by the user into command and argument
+
+        :param line: String with the command and its argument, if any
+        :return: a tuple with the command (None if the line is empty) and the argument (None if there isn't one)
+        """
+        user_input = line.split()
+        if not user_input:
+            return None, None
+        argument = " ".join(user_input[1:]) if len(user_input) >= 2 else None
+        return user_input[0], argument
+
+    @staticmethod
+    def list_request(argument: str = None) -> dict:
+        """
+        Formats a json message of a list request out of the argument of ls, which can start with the
+        long listing flag (ls -l dirname)
+
+        :param argument: String with the argument typed by the user, can be None
+        :return: Dictionary representing the json-formatted message to send
+        """
+        flag, _, rest = (argument or "").partition(" ")
+        details = flag == Constants.LONG_LIST_FLAG
+        path = rest.strip() if details else argument
+        return {"command": "list", "argument": {"path": path or None, "details": details}}
+
+    @staticmethod
+    def split_recursive(argument: str) -> tuple:
+        """
+        Checks if the argument of a get or put starts with the recursive flag (get -r dirname)
+
+        :param argument: String with the argument typed by the user
+        :return: a tuple with True if the flag is there, and the argument without the flag
+        """
+        flag, _, rest = argument.partition(" ")
+        if flag == Constants.RECURSIVE_FLAG and rest.strip():
+            return True, rest.strip()
+        return False, argument
+
+    def execute(self, command: str, argument: str) -> None:
+        """
+        Executes a single command, sending it to the server if it's a remote one
+
+        :param command: String representing the command
+        :param argument: String representing the argument of said command, can be None
+        :return: None
+        """
+        if command in self.__REMOTE_COMMANDS:
+            self.communicate(command, argument)
+        elif command in self.__COMMANDS and argument is None:
+            self.__COMMANDS[command]()
+        elif command in self.__COMMANDS_ARGS and argument:
+            self.__COMMANDS_ARGS[command](argument)
+        else:
+            print(Constants.INVALID_COMMAND)
 
     def communicate(self, command: str, argument: str) -> None:
         """
@@ -57,8 +217,8 @@ class Client:
         :return: None
         """
         data = {"command": command, "argument": argument}
-        self.__socket.send(json.dumps(data).encode())
-        response = json.loads(self.__socket.recv(Constants.BUFFER_SIZE).decode())
+        self.__stream.send(data)
+        response = self.receive_response()
         self.show_response(response)
 
     @staticmethod
@@ -79,50 +239,242 @@ class Client:
         if response['content']:
             print(response['content'])
 
-    def transfer(self, request: dict) -> None:
+    def transfer(self, request: dict, local_path: str = None, retry: bool = True) -> None:
         """
         Sends a transfer request to the server. If the answer has a 200 status code,
         it creates a FileManager instance and delegates the transfer to it, otherwise
         prints the answer to stdout
 
         :param request: Dictionary representing the json-formatted message to send
+        :param local_path: local directory of a recursive transfer, if it isn't the requested one
+        :param retry: if True, the transfer is asked for again if the server rejects its ticket
         :return: None
         """
-        self.__socket.send(json.dumps(request).encode())
-        response = json.loads(self.__socket.recv(Constants.BUFFER_SIZE).decode())
+        self.__stream.send(request)
+        response = self.receive_response()
+        self.start_transfer(request, response, local_path, retry)
 
+    def upload_request(self, command: str, filename: str) -> dict:
+        """
+        Formats a json message of a put or sync request that declares the size and the checksum of the file,
+        which the server binds to the transfer ticket. The checksums are kept until the transfer starts, so
+        the file isn't read again to upload it (see FileManager.prepare_upload())
+
+        :param command: either 'put' or 'sync'
+        :param filename: String representing the base name of the file to upload
+        :return: Dictionary representing the json-formatted message to send
+        """
+        sha256sum, block_digests = calculate_block_checksums(filename, Constants.TRANSFER_BLOCK_SIZE)
+        self.__checksums[filename] = (Constants.TRANSFER_BLOCK_SIZE, sha256sum, block_digests)
+        return {"command": command, "argument": filename, "filesize": os.path.getsize(filename),
+                "sha256sum": sha256sum}
+
+    def start_transfer(self, request: dict, response: dict, local_path: str = None, retry: bool = True) -> None:
+        """
+        Handles the server's answer to a transfer request. If it's allowed, it connects to the transfer port
+        and delegates the transfer to a FileManager, otherwise prints the answer to stdout. Downloads that
+        come with block checksums are delegated to a ParallelDownload instead, using several streams, and
+        recursive transfers to a TreeTransfer, which uses the same number of streams. A transfer whose ticket
+        the server rejects, because it expired while the transfers before it ran, is asked for again once
+
+        :param request: Dictionary representing the json-formatted transfer request that was sent
+        :param response: Dictionary representing the json-formatted answer of the server
+        :param local_path: local directory of a recursive transfer. By default, the directory with the same name
+        :param retry: if True, the transfer is asked for again if the server rejects its ticket
+        :return: None
+        """
+        checksums = self.__checksums.get(request["argument"]) if request["command"] in ('put', 'sync') else None
         if int(response["status_code"]) == Constants.ERROR_STATUS_CODE:
             self.show_response(response)
         elif int(response["status_code"]) == Constants.OK_STATUS_CODE:
-            transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            transfer_socket = self.__context.wrap_socket(transfer_socket)
-            transfer_socket.connect((self.__server_address, response["transfer_port"]))
-            transfer = FileManager(transfer_socket, response)
-            thread_name = Constants.thread_name(operation=request['command'], filename=request['argument'])
-            thread = threading.Thread(target=transfer.begin, name=thread_name)
-            thread.start()
-            thread.join()
+            # imported the first time they're needed, so sessions that don't use them don't pay for the import
+            from .ParallelDownload import ParallelDownload
+            from .TreeTransfer import TreeTransfer
+            if response["operation"] in ("get_tree", "put_tree"):
+                local_path = local_path or os.path.basename(os.path.normpath(request["argument"]))
+                TreeTransfer(response, self.open_transfer_stream, self.__streams, local_path).begin()
+                return
+            if response["operation"] == "get" and response.get("block_digests") and self.__streams > 1:
+                transfer = ParallelDownload(response, self.open_transfer_socket, self.__streams)
+                transfer.begin()
+            else:
+                transfer_socket = self.open_transfer_stream(response["transfer_port"], response["token"])
+                transfer = FileManager(transfer_socket, response, checksums)
+                thread_name = Constants.thread_name(operation=request['command'], filename=request['argument'])
+                thread = threading.Thread(target=transfer.begin, name=thread_name)
+                thread.start()
+                thread.join()
+                transfer_socket.close()
+            if transfer.rejected and retry:
+                print(Constants.ASKING_AGAIN)
+                self.transfer(request, local_path, retry=False)
+                return
+            if transfer.rejected:
+                print(f"{Constants.ERROR_COLOR}{Constants.TRANSFER_REJECTED}{Constants.RESET_COLOR}")
+        if checksums is not None:
+            del self.__checksums[request["argument"]]
+
+    def open_transfer_socket(self, transfer_port: int):
+        """
+        Opens a new TLS connection to the server's transfers socket. The TLS session of the main connection
+        is resumed, so the handshake skips the certificate exchange and the key agreement
+
+        :param transfer_port: port where the server is listening for transfers
+        :return: connected SSLSocket
+        """
+        transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        transfer_socket = self.__context.wrap_socket(transfer_socket, session=self.__tls_session)
+        transfer_socket.connect((self.__server_address, transfer_port))
+        return transfer_socket
+
+    def open_transfer_stream(self, transfer_port: int, token: str):
+        """
+        Opens a stream in the session's transfer channel, a single long-lived transfer connection that
+        carries every transfer, opening the channel first if there isn't one. Servers that don't support
+        channels, and channels that already carry CHANNEL_MAX_STREAMS streams, get a new transfer connection
+
+        :param transfer_port: port where the server is listening for transfers
+        :param token: security token of the transfer metadata
+        :return: a ChannelStream or a connected SSLSocket, both used the same way
+        """
+        with self.__channel_lock:
+            if self.__channel_supported and (self.__channel is None or self.__channel.closed):
+                self.__channel = self.open_channel(transfer_port, token)
+                self.__channel_supported = self.__channel is not None
+            stream = self.__channel.open_stream() if self.__channel is not None else None
+        return stream if stream is not None else self.open_transfer_socket(transfer_port)
+
+    def open_channel(self, transfer_port: int, token: str):
+        """
+        Asks the server to turn a new transfer connection into a transfer channel. Older servers just close
+        the connection
+
+        :param transfer_port: port where the server is listening for transfers
+        :param token: security token of the transfer metadata
+        :return: a TransferChannel, or None if the server doesn't support them
+        """
+        channel_socket = self.open_transfer_socket(transfer_port)
+        channel_socket.settimeout(Constants.TRANSFER_TIMEOUT_SECONDS)
+        try:
+            channel_socket.sendall(json.dumps({"operation": "channel", "token": token}).encode())
+            if channel_socket.recv(len(Constants.READY_FLAG)) == Constants.READY_FLAG:
+                channel_socket.settimeout(None)
+                return TransferChannel(channel_socket)
+        except OSError:
+            pass
+        channel_socket.close()
+        return None
+
+    def ls(self, argument: str = None) -> None:
+        """
+        Lists a directory of the server, or its current working directory if none is given. Entries are
+        printed as the pages of the listing arrive. Servers that don't know the list command get a plain ls,
+        without the long listing
+
+        :param argument: String representing the directory to list, optionally preceded by the long
+        listing flag (-l). None by default
+        :return: None
+        """
+        request = self.list_request(argument)
+        if not self.__stream.framed or not self.__list_supported:
+            self.communicate('ls', request["argument"]["path"])
+            return
+        self.__stream.send(request)
+        self.show_listing(request["argument"], self.receive_response())
+
+    def show_listing(self, list_argument: dict, response: dict) -> None:
+        """
+        Prints the answer to a list request, reading the rest of its pages from the server until the
+        last one. With the long listing, each entry is printed with its type, size and modification time
+
+        :param list_argument: Dictionary with the "path" and "details" of the list request
+        :param response: Dictionary representing the first json-formatted page of the listing
+        :return: None
+        """
+        if int(response["status_code"]) != Constants.OK_STATUS_CODE:
+            if response["status_message"] == Constants.SERVER_INVALID_COMMAND:
+                self.__list_supported = False
+                self.communicate('ls', list_argument["path"])
+            else:
+                self.show_response(response)
+            return
+
+        print(f"{Constants.OK_COLOR}{response['status_code']}: {response['status_message']}{Constants.RESET_COLOR}\n")
+        while True:
+            for name, entry_type, size, mtime in response["content"]:
+                print(Constants.list_entry(name, entry_type, size, mtime) if list_argument["details"] else name)
+            if not response["more"]:
+                break
+            response = self.receive_response()
+
+    def find(self, argument: str) -> None:
+        """
+        Asks the server for the files and directories matching a pattern, and prints them with their type,
+        size and modification time
+
+        :param argument: String with the pattern, optionally followed by the directory to search and the
+        -size, -mtime and -limit filters
+        :return: None
+        """
+        try:
+            request = {"command": "find", "argument": find_request(argument)}
+        except ValueError:
+            print(Constants.FIND_USAGE)
+            return
+        self.__stream.send(request)
+        response = self.receive_response()
+        if int(response["status_code"]) != Constants.OK_STATUS_CODE:
+            self.show_response(response)
+            return
+
+        print(f"{Constants.OK_COLOR}{response['status_code']}: {response['status_message']}{Constants.RESET_COLOR}\n")
+        for path, entry_type, size, mtime in response["content"]:
+            print(Constants.list_entry(path, entry_type, size, mtime))
+        if response["more"]:
+            print(Constants.FIND_MORE_RESULTS)
 
     def get(self, filename: str) -> None:
         """
-        Formats a json message of a get request, and calls transfer() method with it
+        Formats a json message of a get request, and calls transfer() method with it. With the
+        recursive flag (get -r dirname), it asks for the whole directory instead
 
         :param filename: String representing the base name of the file to download
         :return: None
         """
-        request = {"command": "get", "argument": filename}
+        recursive, filename = self.split_recursive(filename)
+        request = {"command": "get_tree" if recursive else "get", "argument": filename}
         self.transfer(request)
 
     def put(self, filename: str) -> None:
         """
-        Formats a json message of a put request, and calls transfer() method with it
+        Formats a json message of a put request, and calls transfer() method with it. With the
+        recursive flag (put -r dirname), it uploads the whole directory instead, to a directory with the same
+        name in the server's current working directory
+
+        :param filename: String representing the base name of the file to upload
+        :return: None
+        """
+        recursive, filename = self.split_recursive(filename)
+        if recursive and os.path.isdir(filename):
+            request = {"command": "put_tree", "argument": os.path.basename(os.path.normpath(filename))}
+            self.transfer(request, local_path=filename)
+        elif recursive:
+            print(Constants.DIRECTORY_NOT_FOUND)
+        elif os.path.isfile(filename):
+            self.transfer(self.upload_request("put", filename))
+        else:
+            print(Constants.FILE_NOT_FOUND)
+
+    def sync(self, filename: str) -> None:
+        """
+        Formats a json message of a sync request, and calls transfer() method with it. If the server
+        already has the file, it answers with a delta transfer, otherwise with a regular upload
 
         :param filename: String representing the base name of the file to upload
         :return: None
         """
         if os.path.isfile(filename):
-            request = {"command": "put", "argument": filename}
-            self.transfer(request)
+            self.transfer(self.upload_request("sync", filename))
         else:
             print(Constants.FILE_NOT_FOUND)
 
@@ -193,6 +545,8 @@ class Client:
 
         :return: None
         """
+        if self.__channel is not None:
+            self.__channel.close()
         self.__socket.close()
         print(Constants.DISCONNECTED_MESSAGE)
         exit(0)
@@ -0,0 +1,118 @@
+import zlib
+import struct
+import hashlib
+from .client_helper import Constants
+
+
+class DeltaEncoder:
+    """
+    Class computing, rsync style, the delta between a local file and the copy the server has, out of the
+    signature the server sent: an adler32 weak checksum and a sha256 strong checksum of each block of its copy.
+
+    Blocks of the local file are first compared where they are, which is cheap (zlib computes the weak
+    checksum, and the strong one is only calculated when the weak one matches), so blocks that didn't move
+    cost almost nothing. When a block doesn't match, the weak checksum is rolled byte by byte over the
+    next block to find where the server's blocks continue, so data inserted or removed in the middle of the
+    file doesn't turn the rest of it into literal data. Rolling is the slow part, so after DELTA_ROLLING_BLOCKS
+    blocks in a row without a match, it's only tried once every DELTA_ROLLING_BLOCKS blocks.
+
+    The delta is produced as the instructions DeltaPatcher applies on the server: runs of blocks to copy from
+    its copy and literal data
+    """
+    HEADER = struct.Struct(Constants.SIGNATURE_HEADER)
+    ENTRY = struct.Struct(Constants.SIGNATURE_ENTRY)
+    COPY = struct.Struct("!II")
+    LENGTH = struct.Struct("!I")
+    ADLER_MODULUS = 65521
+
+    def __init__(self, signature: bytes):
+        _, self.block_size, count = self.HEADER.unpack_from(signature)
+        self.copied = 0
+        self.literal = 0
+        self.__weak = set()
+        self.__strong = {}
+        entries = signature[self.HEADER.size:self.HEADER.size + count * self.ENTRY.size]
+        for index, (weak, strong) in enumerate(self.ENTRY.iter_unpack(entries)):
+            self.__weak.add(weak)
+            self.__strong.setdefault(strong, index)
+
+    @classmethod
+    def signature_size(cls, header: bytes) -> int:
+        """
+        :param header: the first HEADER.size bytes of a signature
+        :return: size in bytes of the whole signature
+        """
+        _, _, count = cls.HEADER.unpack(header)
+        return cls.HEADER.size + count * cls.ENTRY.size
+
+    def instructions(self, data):
+        """
+        Generator of the delta instructions that rebuild data out of the server's copy
+
+        :param data: contents of the local file, bytes or an mmap
+        :return: generator of bytes, each one an instruction
+        """
+        block_size = self.block_size
+        position = literal_start = misses = 0
+        run = None
+        while position + block_size <= len(data):
+            match = self.__match(data, position)
+            if match is None and (misses < Constants.DELTA_ROLLING_BLOCKS or misses % Constants.DELTA_ROLLING_BLOCKS == 0):
+                match = self.__search(data, position)
+            if match is None:
+                misses += 1
+                position += block_size
+                if position - literal_start >= Constants.DELTA_LITERAL_FLUSH:
+                    yield from self.__flush(run, data, literal_start, position)
+                    run, literal_start = None, position
+                continue
+
+            match_position, index = match
+            if match_position > literal_start or (run is not None and run[0] + run[1] != index):
+                yield from self.__flush(run, data, literal_start, match_position)
+                run = None
+            run = [run[0], run[1] + 1] if run is not None else [index, 1]
+            position = literal_start = match_position + block_size
+            misses = 0
+
+        yield from self.__flush(run, data, literal_start, len(data))
+        yield Constants.DELTA_END
+
+    def __match(self, data, position: int):
+        window = data[position:position + self.block_size]
+        if zlib.adler32(window) not in self.__weak:
+            return None
+        index = self.__strong.get(hashlib.sha256(window).digest())
+        return None if index is None else (position, index)
+
+    def __search(self, data, position: int):
+        """
+        Rolls the adler32 checksum of the block at position one byte at a time, over the next block
+
+        :return: a tuple (position, block index) of the first block of the server found, or None
+        """
+        block_size = self.block_size
+        window = data[position:position + 2 * block_size]
+        weak = zlib.adler32(window[:block_size])
+        a, b = weak & 0xffff, weak >> 16
+        for start in range(1, len(window) - block_size + 1):
+            removed, added = window[start - 1], window[start + block_size - 1]
+            a = (a - removed + added) % self.ADLER_MODULUS
+            b = (b - block_size * removed + a - 1) % self.ADLER_MODULUS
+            if (b << 16 | a) in self.__weak:
+                index = self.__strong.get(hashlib.sha256(window[start:start + block_size]).digest())
+                if index is not None:
+                    return position + start, index
+        return None
+
+    def __flush(self, run, data, start: int, end: int):
+        """
+        Yields the pending run of blocks to copy, if any, and then the literal data between start and end
+        """
+        if run is not None:
+            self.copied += run[1] * self.block_size
+            yield Constants.DELTA_COPY + self.COPY.pack(*run)
+        for offset in range(start, end, Constants.DELTA_MAX_LITERAL):
+            chunk = data[offset:min(offset + Constants.DELTA_MAX_LITERAL, end)]
+            self.literal += len(chunk)
+            yield Constants.DELTA_DATA + self.LENGTH.pack(len(chunk)) + chunk
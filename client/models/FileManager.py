@@ -1,94 +1,278 @@
 import os
 import json
-import tqdm
+import mmap
 from socket import timeout
-from .client_helper import Constants, calculate_checksum
+from .client_helper import Constants, calculate_checksum, calculate_block_checksums, blocks_checksum, \
+    compressor, BoundedDecompressor, is_compressible, wait_for_admission, progress_bar, DECOMPRESSION_ERRORS, \
+    TransferRejected
+from .PartialFile import PartialFile
+from .DeltaEncoder import DeltaEncoder
 
 
 class FileManager:
     """
     Class representing a file transfer from the client point of view. An instance of this
     class is created each time that the client request for a file transfer. It will connect to the
-    server's transfers socket, send the transfer metadata and start uploading/downloading the file
+    server's transfers socket, send the transfer metadata and start uploading/downloading the file.
+    Uploads can come with the checksums the client calculated to declare them, a tuple (block_size, sha256sum,
+    block_digests). If the server rejects the transfer ticket, rejected is set, so the client can ask again
     """
-    def __init__(self, transfer_socket, transfer_metadata):
+    def __init__(self, transfer_socket, transfer_metadata, checksums: tuple = None):
         self.__transfer_socket = transfer_socket
         self.__transfer_metadata = transfer_metadata
+        self.__checksums = checksums
+        self.rejected = False
 
     def begin(self) -> None:
         """
         Main class method, it will establish connection with the socket, and delegate the transfer
-        to the send_file() or receive_file() method depending on transfer type.
+        to the send_file(), get_file() or send_delta() method depending on transfer type. Downloads go to a
+        PartialFile, and if a previous download of the same file was interrupted, only the blocks
+        that are missing are asked for. Uploads resume where the server says a previous upload of
+        the same file stopped, and aren't sent at all if the server answers the dedup flag, meaning it
+        already had a file with the same content. Servers that queue transfers answer with their queue
+        flags first (see send_request()), or the rejected flag if the ticket expired, which sets rejected
 
         :return: None
         """
+        try:
+            self.start()
+        except TransferRejected:
+            self.__transfer_socket.close()
+            self.rejected = True
+
+    def start(self) -> None:
+        """
+        Starts the transfer, see begin()
+
+        :return: None
+        """
+        filename = os.path.basename(self.__transfer_metadata["absolute_path"])
         if self.__transfer_metadata["operation"] == "put":
-            self.__transfer_metadata["sha256sum"] = calculate_checksum(os.path.basename(self.__transfer_metadata["absolute_path"]))
-            self.__transfer_socket.send(json.dumps(self.__transfer_metadata).encode())
-            self.__transfer_socket.recv(8)
-            self.send_file()
+            offset = self.prepare_upload(filename)
+            self.send_request(resume=offset, dedup=True)
+            if self.__transfer_socket.recv(len(Constants.READY_FLAG)) == Constants.DEDUP_FLAG:
+                self.__transfer_socket.close()
+                print(Constants.FILE_DEDUPLICATED)
+                return
+            self.send_file(offset)
             print(Constants.FILE_UPLOADED)
         elif self.__transfer_metadata["operation"] == "get":
-            self.__transfer_socket.send(json.dumps(self.__transfer_metadata).encode())
-            self.get_file()
+            partial = PartialFile(filename, self.__transfer_metadata["sha256sum"], int(self.__transfer_metadata["filesize"]),
+                                  self.__transfer_metadata.get("block_size") or Constants.CHECKSUM_BLOCK_SIZE,
+                                  self.__transfer_metadata.get("block_digests"))
+            offset = partial.open(resume="blocks_sha256sum" in self.__transfer_metadata)
+            if offset > 0:
+                print(Constants.RESUMING_TRANSFER, offset)
+            try:
+                self.send_request(offset=offset)
+            except TransferRejected:
+                partial.close()
+                raise
+            self.get_file(partial, offset)
+        elif self.__transfer_metadata["operation"] == "delta":
+            self.__transfer_metadata["sha256sum"] = self.__checksums[1] if self.__checksums else \
+                calculate_checksum(filename, use_mmap=True)
+            self.__transfer_metadata["filesize"] = os.path.getsize(filename)
+            self.send_request()
+            self.send_delta(filename)
+
+    def prepare_upload(self, filename: str) -> int:
+        """
+        Calculates the checksums of the file to upload. If the server sent the block size it uses, the
+        block checksums are calculated in the same read, so the server can verify a resumed upload.
+        If the session negotiated compression, a sample of the file is compressed first, and the upload
+        isn't compressed if the sample doesn't shrink enough. The checksums the client already calculated
+        to declare the upload in the put request are reused if they were calculated with the same block size
+
+        :param filename: name of the file to upload
+        :return: offset where the upload starts, which is only not 0 if the server has a partial upload
+        of this same file
+        """
+        self.__transfer_metadata["filesize"] = os.path.getsize(filename)
+        block_size = self.__transfer_metadata.get("block_size")
+        offset = 0
+        if not block_size:
+            self.__transfer_metadata["sha256sum"] = calculate_checksum(filename)
+        else:
+            if self.__checksums is not None and self.__checksums[0] == block_size:
+                sha256sum, block_digests = self.__checksums[1:]
+            else:
+                sha256sum, block_digests = calculate_block_checksums(filename, block_size)
+            self.__transfer_metadata["sha256sum"] = sha256sum
+            self.__transfer_metadata["blocks_sha256sum"] = blocks_checksum(block_digests)
+            partial = self.__transfer_metadata.get("partial")
+            if partial is not None and partial["sha256sum"] == sha256sum:
+                offset = partial["offset"]
+                print(Constants.RESUMING_TRANSFER, offset)
+
+        codec = self.__transfer_metadata.get("codec")
+        if codec is not None and not is_compressible(filename, codec, self.__transfer_metadata.get("level"), offset):
+            self.__transfer_metadata["codec"] = self.__transfer_metadata["level"] = None
+        return offset
+
+    def transfer_request(self, **extra) -> dict:
+        """
+        Builds the transfer request sent to the transfers socket out of the transfer metadata. Fields the
+        transfers socket doesn't need, like block checksums, are left out to keep the request small
+
+        :param extra: fields to add to the request, like the offset where the transfer starts
+        :return: Dictionary with the transfer request
+        """
+        request = {key: self.__transfer_metadata.get(key) for key in Constants.TRANSFER_REQUEST_FIELDS}
+        request["queue"] = bool(self.__transfer_metadata.get("queue_flags"))
+        request.update(extra)
+        return request
 
-    def send_file(self):
+    def send_request(self, **extra) -> None:
+        """
+        Sends the transfer request and, if the server queues transfers, waits until the transfer is admitted
+
+        :param extra: fields to add to the request, see transfer_request()
+        :return: None
+        """
+        self.__transfer_socket.send(json.dumps(self.transfer_request(**extra)).encode())
+        if self.__transfer_metadata.get("queue_flags") and wait_for_admission(self.__transfer_socket):
+            print(Constants.TRANSFER_QUEUED)
+
+    def send_file(self, offset: int = 0):
         """
         Handles a file send to the server's transfers socket. It will open the file in binary-read mode,
         read chunks of 4096 bytes and send them to the server, while updating a progress bar on stdout.
         When it's done reading the file and sending it, it will close the connection and exit.
         This will send an EOF to the server side after he receives the last byte of the file.
+        If the transfer is compressed, the chunks go through the codec's compressor before being sent
 
+        :param offset: position of the file where the upload starts
         :return: None
         """
         filename = os.path.basename(self.__transfer_metadata["absolute_path"])
         filesize = os.path.getsize(filename)
+        codec = self.__transfer_metadata.get("codec")
+        engine = compressor(codec, self.__transfer_metadata.get("level")) if codec is not None else None
+        wire_bytes = 0
 
-        progress = tqdm.tqdm(range(filesize), f"Sending {filename}", unit="B", unit_scale=True, unit_divisor=1024)
+        progress = progress_bar(f"Sending {filename}", filesize, initial=offset)
         with open(filename, "rb") as f:
+            f.seek(offset)
             while True:
                 bytes_read = f.read(Constants.FILE_BUFFER_SIZE)
                 if not bytes_read:
+                    if engine is not None:
+                        tail = engine.flush()
+                        self.__transfer_socket.sendall(tail)
+                        wire_bytes += len(tail)
                     progress.close()
                     self.__transfer_socket.close()
                     break
 
-                self.__transfer_socket.sendall(bytes_read)
+                data = engine.compress(bytes_read) if engine is not None else bytes_read
+                self.__transfer_socket.sendall(data)
+                wire_bytes += len(data)
                 progress.update(len(bytes_read))
+        if engine is not None:
+            print(Constants.COMPRESSION_SAVED.format(codec, wire_bytes, filesize - offset))
 
-    def get_file(self) -> None:
+    def get_file(self, partial: PartialFile, offset: int = 0) -> None:
         """
-        Handles a file receive from the server's transfers socket. It will open the file in binary-write
-        mode, read chunks of 4096 bytes from the server's socket and write them to the file while
-        updating a progress bar on stdout. When EOF is reached (server is done transmitting)
-        it will flush the file and exit
+        Handles a file receive from the server's transfers socket. It will receive chunks into a buffer
+        of RECEIVE_BUFFER_SIZE bytes, reused for every chunk, and write them to the partial file, which
+        is preallocated, while updating a progress bar on stdout. The checksums are updated with each chunk, so the file doesn't need to be read again
+        to verify it. If the connection is closed or times out before the whole file arrived, the
+        partial file is kept so the download can be resumed. Otherwise, the file is verified and moved
+        to its final name. Compressed transfers are decompressed as they arrive, a bounded piece at a time (see
+        BoundedDecompressor), checksums are always calculated over the original bytes
 
+        :param partial: PartialFile where the file is written
+        :param offset: position of the file where the download starts
         :return: None
         """
         filesize = int(self.__transfer_metadata["filesize"])
         filename = os.path.basename(self.__transfer_metadata["absolute_path"])
         self.__transfer_socket.settimeout(Constants.TRANSFER_TIMEOUT_SECONDS)
 
-        progress = tqdm.tqdm(range(filesize), f"Receiving {filename}", unit="B", unit_scale=True, unit_divisor=1024)
-        with open(filename, "wb") as file:
+        codec = self.__transfer_metadata.get("codec")
+        engine = BoundedDecompressor(codec, filesize - offset) if codec is not None else None
+        wire_bytes = 0
+
+        buffer = memoryview(bytearray(Constants.receive_buffer_size()))
+        progress = progress_bar(f"Receiving {filename}", filesize, initial=offset)
+        try:
             while True:
-                try:
-                    bytes_read = self.__transfer_socket.recv(Constants.FILE_BUFFER_SIZE)
-                    if not bytes_read:
-                        break
-                    file.write(bytes_read)
-                    progress.update(len(bytes_read))
-                except timeout:
+                size = self.__transfer_socket.recv_into(buffer)
+                if not size:
+                    break
+                wire_bytes += size
+                pieces = engine.decompress(buffer[:size]) if engine is not None else (buffer[:size],)
+                if not self.write_pieces(partial, pieces, progress):
                     break
-            progress.close()
+        except (timeout,) + DECOMPRESSION_ERRORS:  # socket errors are OSError too
+            pass
+        progress.close()
+        if engine is not None:
+            print(Constants.COMPRESSION_SAVED.format(codec, wire_bytes, filesize - offset))
 
-        print(Constants.CALCULATING_CHECKSUM, end='')
-        is_authentic = calculate_checksum(filename) == self.__transfer_metadata["sha256sum"]
+        if not partial.is_complete():
+            partial.close()
+            print(Constants.TRANSFER_INTERRUPTED)
+            return
 
-        if is_authentic:
+        print(Constants.CALCULATING_CHECKSUM, end='')
+        if partial.commit(self.__transfer_metadata.get("blocks_sha256sum")):
             print(Constants.OK_MESSAGE)
             print(Constants.FILE_DOWNLOADED)
-
         else:
             print(Constants.INVALID_CHECKSUM)
-            os.remove(filename)
+
+    @staticmethod
+    def write_pieces(partial: PartialFile, pieces, progress) -> bool:
+        """
+        Writes the pieces of a chunk received, decompressed or not, to the partial file, updating the progress bar
+
+        :return: False if a piece goes beyond the file size or completes a block that doesn't match its checksum
+        """
+        for piece in pieces:
+            if not partial.write(piece):
+                return False
+            progress.update(len(piece))
+        return True
+
+    def send_delta(self, filename: str) -> None:
+        """
+        Handles a delta upload. It reads the signature of the server's copy of the file and sends the delta
+        computed by a DeltaEncoder, buffered in STREAM_BUFFER_SIZE bytes writes, then closes the connection
+
+        :param filename: name of the file to upload
+        :return: None
+        """
+        header = self.receive_exactly(DeltaEncoder.HEADER.size)
+        encoder = DeltaEncoder(header + self.receive_exactly(DeltaEncoder.signature_size(header) - len(header)))
+
+        with open(filename, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b""
+            buffer = bytearray()
+            for instruction in encoder.instructions(data):
+                buffer += instruction
+                if len(buffer) >= Constants.STREAM_BUFFER_SIZE:
+                    self.__transfer_socket.sendall(buffer)
+                    buffer.clear()
+            self.__transfer_socket.sendall(buffer)
+            if data:
+                data.close()
+        self.__transfer_socket.close()
+        print(Constants.DELTA_SENT.format(encoder.literal, encoder.copied))
+        print(Constants.FILE_UPLOADED)
+
+    def receive_exactly(self, size: int) -> bytes:
+        """
+        :param size: number of bytes to read from the transfers socket
+        :return: the bytes read
+        :raises ConnectionResetError: if the server closes the connection before sending them
+        """
+        data = bytearray()
+        while len(data) < size:
+            bytes_read = self.__transfer_socket.recv(min(size - len(data), Constants.STREAM_BUFFER_SIZE))
+            if not bytes_read:
+                raise ConnectionResetError(Constants.CONNECTION_CLOSED)
+            data += bytes_read
+        return bytes(data)
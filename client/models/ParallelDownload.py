@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+import threading
+from queue import Queue, Empty
+from socket import timeout
+from .client_helper import Constants, BoundedDecompressor, wait_for_admission, progress_bar, DECOMPRESSION_ERRORS, \
+    TransferRejected
+from .PartialFile import PartialFile
+
+
+class ParallelDownload:
+    """
+    Class representing a get transfer split in byte ranges that are downloaded through several transfer
+    connections at the same time, so a single TCP stream doesn't limit the throughput on high-latency links.
+
+    The file is written to a PartialFile, preallocated, and each range is written in place with os.pwrite().
+    Ranges are made of whole blocks, and every block is verified against the block checksums the server sent
+    in the transfer metadata and confirmed in the partial file manifest, so the file doesn't need to be read
+    again at the end. A range whose connection fails or whose blocks don't match is downloaded again, up to
+    RANGE_RETRIES times. If some ranges still fail, the partial file is kept, and downloading the file again
+    only asks for the blocks that weren't confirmed. If the server rejects the ticket, the download stops and
+    rejected is set, so the client can ask for it again.
+    """
+    def __init__(self, transfer_metadata: dict, open_transfer_socket, streams: int):
+        self.__transfer_metadata = transfer_metadata
+        self.__open_transfer_socket = open_transfer_socket
+        self.__streams = streams
+        self.__filesize = int(transfer_metadata["filesize"])
+        self.__block_size = int(transfer_metadata["block_size"])
+        self.__block_digests = transfer_metadata["block_digests"]
+        self.__partial = None
+        self.__progress = None
+        self.__progress_lock = threading.Lock()
+        self.__failed = False
+        self.rejected = False
+
+    def begin(self) -> None:
+        """
+        Main class method. It plans the ranges out of the blocks that aren't confirmed yet, starts one thread
+        per stream and, when they're done, moves the file to its final name if every block was confirmed
+
+        :return: None
+        """
+        filename = os.path.basename(self.__transfer_metadata["absolute_path"])
+        self.__partial = PartialFile(filename, self.__transfer_metadata["sha256sum"], self.__filesize, self.__block_size, self.__block_digests)
+        self.__partial.open()
+        pending = Queue()
+        for offset, length in self.plan_ranges(self.__partial.missing_blocks()):
+            pending.put((offset, length, 0))
+        if self.__partial.confirmed_size() > 0:
+            print(Constants.RESUMING_TRANSFER, self.__partial.confirmed_size())
+
+        self.__progress = progress_bar(f"Receiving {filename} ({self.__streams} streams)", self.__filesize,
+                                       initial=self.__partial.confirmed_size())
+        try:
+            workers = [threading.Thread(target=self.worker, args=(self.__partial.fileno(), pending))
+                       for _ in range(min(self.__streams, pending.qsize()))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            self.__progress.close()
+
+        if self.rejected:
+            self.__partial.close()
+        elif not self.__partial.is_complete():
+            self.__partial.close()
+            print(Constants.TRANSFER_INTERRUPTED)
+        elif self.__partial.commit():
+            print(Constants.BLOCKS_VERIFIED.format(len(self.__block_digests)))
+            print(Constants.FILE_DOWNLOADED)
+        else:
+            print(Constants.INVALID_CHECKSUM)
+
+    def plan_ranges(self, missing_blocks: list) -> list:
+        """
+        Groups the missing blocks in ranges of consecutive blocks, at most RANGE_BLOCKS long
+
+        :param missing_blocks: sorted list of indexes of the blocks to download
+        :return: list of (offset, length) tuples
+        """
+        ranges = []
+        start = previous = None
+        for index in missing_blocks + [None]:
+            if start is not None and (index != previous + 1 or index - start == Constants.RANGE_BLOCKS):
+                end = min((previous + 1) * self.__block_size, self.__filesize)
+                ranges.append((start * self.__block_size, end - start * self.__block_size))
+                start = None
+            if start is None:
+                start = index
+            previous = index
+        return ranges
+
+    def worker(self, file_descriptor: int, pending: Queue) -> None:
+        """
+        Takes ranges from the queue and downloads them until the queue is empty. When a range fails, the
+        part that wasn't confirmed is put back in the queue, while it has retries left
+
+        :param file_descriptor: descriptor of the preallocated file, open for writing
+        :param pending: Queue of (offset, length, attempts) tuples
+        :return: None
+        """
+        while not self.__failed:
+            try:
+                offset, length, attempts = pending.get_nowait()
+            except Empty:
+                return
+            confirmed = self.download_range(file_descriptor, offset, length)
+            if confirmed == length:
+                continue
+            if confirmed > 0:
+                pending.put((offset + confirmed, length - confirmed, attempts))
+            elif attempts + 1 < Constants.RANGE_RETRIES:
+                pending.put((offset, length, attempts + 1))
+            else:
+                self.__failed = True
+
+    def download_range(self, file_descriptor: int, offset: int, length: int) -> bool:
+        """
+        Downloads a single byte range through a new transfer connection, writing it in place and verifying
+        each of its blocks. If the transfer is compressed, each range is a compressed stream of its own
+
+        :param file_descriptor: descriptor of the preallocated file, open for writing
+        :param offset: position of the range in the file, a multiple of the block size
+        :param length: length of the range in bytes
+        :return: number of bytes at the start of the range whose blocks were received and confirmed
+        """
+        request = {key: self.__transfer_metadata.get(key) for key in Constants.TRANSFER_REQUEST_FIELDS}
+        request.update(offset=offset, length=length, queue=bool(self.__transfer_metadata.get("queue_flags")))
+        engine = BoundedDecompressor(request["codec"], length) if request.get("codec") is not None else None
+        received = 0
+        try:
+            with self.__open_transfer_socket(self.__transfer_metadata["transfer_port"]) as transfer_socket:
+                transfer_socket.settimeout(Constants.TRANSFER_TIMEOUT_SECONDS)
+                transfer_socket.sendall(json.dumps(request).encode())
+                if request.get("queue"):
+                    wait_for_admission(transfer_socket)
+                block_checksum = {"sha256": hashlib.sha256()}
+                buffer = memoryview(bytearray(Constants.RANGE_BUFFER_SIZE))
+                while received < length:
+                    size = transfer_socket.recv_into(buffer, Constants.RANGE_BUFFER_SIZE if engine else min(Constants.RANGE_BUFFER_SIZE, length - received))
+                    if not size:
+                        break
+                    pieces = engine.decompress(buffer[:size]) if engine is not None else (buffer[:size],)
+                    written, verified = self.__write(file_descriptor, pieces, offset + received, block_checksum)
+                    received += written
+                    if not verified:
+                        break
+        except TransferRejected:
+            self.rejected = self.__failed = True
+        except (timeout,) + DECOMPRESSION_ERRORS:
+            pass
+
+        if received == length:
+            return length
+        confirmed = received // self.__block_size * self.__block_size
+        self.__update_progress(confirmed - received)
+        return confirmed
+
+    def __write(self, file_descriptor: int, pieces, position: int, block_checksum: dict) -> tuple:
+        """
+        Writes pieces of a range at position, verifying them (see __verify())
+
+        :return: a tuple with the number of bytes written and verified, and False if a block didn't match its checksum
+        """
+        written = 0
+        for piece in pieces:
+            os.pwrite(file_descriptor, piece, position + written)
+            if not self.__verify(piece, position + written, block_checksum):
+                return written, False
+            written += len(piece)
+            self.__update_progress(len(piece))
+        return written, True
+
+    def __verify(self, data: bytes, position: int, block_checksum: dict) -> bool:
+        """
+        Feeds data to the checksum of the block being received and, every time a block is completed,
+        compares it with the server's block checksum, confirms it and starts a new one for the next block
+        """
+        view = memoryview(data)
+        while view:
+            block_end = min((position // self.__block_size + 1) * self.__block_size, self.__filesize)
+            piece = view[:block_end - position]
+            block_checksum["sha256"].update(piece)
+            position += len(piece)
+            view = view[len(piece):]
+            if position == block_end:
+                block_index = (position - 1) // self.__block_size
+                if block_checksum["sha256"].hexdigest() != self.__block_digests[block_index]:
+                    return False
+                self.__partial.confirm(block_index, self.__block_digests[block_index])
+                block_checksum["sha256"] = hashlib.sha256()
+        return True
+
+    def __update_progress(self, amount: int) -> None:
+        with self.__progress_lock:
+            self.__progress.update(amount)
@@ -0,0 +1,258 @@
+import os
+import json
+import hashlib
+import threading
+from .client_helper import Constants, blocks_checksum
+
+
+class PartialFile:
+    """
+    Class representing a file that is being received. Data is written to "<file>.part" and every block of
+    block_size bytes that is completely written is recorded, with its sha256 checksum, in a sidecar manifest
+    "<file>.part.manifest". If the transfer is interrupted both are kept, and a later transfer of the same
+    file (same checksum, size and block size) starts from the first block that isn't in the manifest.
+    When the size is known, the partial file is preallocated as soon as it's opened (see preallocate()).
+
+    The manifest is append-only: a json header line with the file's checksum, size and block size, and a
+    "<index> <checksum>" line per confirmed block, so confirming a block costs a single small write.
+    Once every block is confirmed, the file is verified and renamed to its final path. Only the blocks
+    received in this transfer are hashed: if it started from the beginning, the whole-file checksum is
+    compared, and if it was resumed, the checksum of the list of block checksums (see blocks_checksum())
+    is compared with the one calculated by the sender. If the sender's block checksums are known, each
+    block is verified as soon as it's complete instead.
+
+    Downloads use it as is. The server side keeps its own copy of this class for uploads
+    """
+    def __init__(self, path: str, sha256sum: str, filesize: int, block_size: int, block_digests: list = None):
+        self.path = path
+        self.part_path = path + Constants.PARTIAL_SUFFIX
+        self.manifest_path = self.part_path + Constants.MANIFEST_SUFFIX
+        self.__sha256sum = sha256sum
+        self.__filesize = filesize
+        self.__block_size = block_size
+        self.__expected_digests = block_digests
+        self.__blocks = [None] * -(-filesize // block_size) if filesize is not None else []
+        self.__file = None
+        self.__manifest = None
+        self.__position = 0
+        self.__checksum = None
+        self.__block_checksum = hashlib.sha256()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def resume_point(cls, path: str):
+        """
+        Checks if there's an interrupted transfer of the given file
+
+        :param path: final path of the file
+        :return: a tuple with the checksum of the file being transferred and the offset where the transfer
+        can be resumed, or None if there's nothing to resume
+        """
+        manifest = cls.read_manifest(path + Constants.PARTIAL_SUFFIX + Constants.MANIFEST_SUFFIX)
+        if manifest is None or manifest[0].get("filesize") is None:
+            return None
+        header = manifest[0]
+        partial = cls(path, header["sha256sum"], header["filesize"], header["block_size"])
+        partial.load(manifest)
+        offset = partial.resume_offset()
+        return (header["sha256sum"], offset) if offset > 0 else None
+
+    @staticmethod
+    def read_manifest(manifest_path: str):
+        """
+        :param manifest_path: path to the manifest
+        :return: a tuple with the manifest header and a dictionary {block index: checksum} with the confirmed
+        blocks, or None if there's no manifest or it can't be read. A last line cut by a crash is ignored
+        """
+        try:
+            with open(manifest_path) as manifest:
+                header = json.loads(manifest.readline())
+                blocks = {}
+                for line in manifest:
+                    fields = line.split()
+                    if line.endswith("\n") and len(fields) == 2:
+                        blocks[int(fields[0])] = fields[1]
+            return header, blocks
+        except (OSError, ValueError):
+            return None
+
+    def header(self) -> dict:
+        return {"sha256sum": self.__sha256sum, "filesize": self.__filesize, "block_size": self.__block_size}
+
+    def load(self, manifest: tuple) -> bool:
+        """
+        Takes the confirmed blocks of a previous transfer, if the manifest belongs to this same file. Blocks
+        beyond the end of the partial file or that don't match the expected block checksums are dropped
+
+        :param manifest: tuple returned by read_manifest()
+        :return: True if the manifest belongs to this file
+        """
+        if manifest is None or manifest[0] != self.header() or not os.path.isfile(self.part_path):
+            return False
+        part_size = os.path.getsize(self.part_path)
+        for index, digest in manifest[1].items():
+            if 0 <= index < len(self.__blocks) and self.__block_end(index) <= part_size and \
+                    (self.__expected_digests is None or self.__expected_digests[index] == digest):
+                self.__blocks[index] = digest
+        return True
+
+    def open(self, resume: bool = True) -> int:
+        """
+        Opens the partial file and its manifest. If resume is True and there's a manifest of this same file,
+        its confirmed blocks are kept, otherwise both start empty. The manifest is rewritten with the blocks
+        kept, so it doesn't grow across interruptions
+
+        :param resume: whether a previous partial file can be reused
+        :return: offset of the first block that isn't confirmed, where a sequential transfer should start
+        """
+        resumed = resume and self.__filesize is not None and self.load(self.read_manifest(self.manifest_path))
+        self.__file = open(self.part_path, "r+b" if resumed else "wb")
+        self.preallocate()
+        self.__manifest = open(self.manifest_path, "w")
+        self.__manifest.write(json.dumps(self.header()) + "\n")
+        self.__manifest.writelines(f"{index} {digest}\n" for index, digest in enumerate(self.__blocks) if digest is not None)
+        self.__manifest.flush()
+        offset = self.resume_offset()
+        self.seek(offset)
+        return offset
+
+    def preallocate(self) -> None:
+        """
+        Reserves the space of the whole file with posix_fallocate(), so it's written to blocks allocated at once
+        instead of growing a write at a time, which fragments it on disk. Where that isn't available, the file
+        is just extended to its size, sparse. Data already in the file is kept
+
+        :return: None
+        """
+        if not self.__filesize:
+            return
+        try:
+            os.posix_fallocate(self.__file.fileno(), 0, self.__filesize)
+        except (AttributeError, OSError):
+            os.ftruncate(self.__file.fileno(), self.__filesize)
+
+    def resume_offset(self) -> int:
+        if None in self.__blocks:
+            return self.__blocks.index(None) * self.__block_size
+        return self.__filesize or 0
+
+    def missing_blocks(self) -> list:
+        return [index for index, digest in enumerate(self.__blocks) if digest is None]
+
+    def confirmed_size(self) -> int:
+        return sum(self.__block_end(index) - index * self.__block_size for index, digest in enumerate(self.__blocks) if digest is not None)
+
+    def fileno(self) -> int:
+        return self.__file.fileno()
+
+    def seek(self, offset: int) -> None:
+        """
+        Moves the sequential write position to offset, which must be at a block boundary before the first
+        block that isn't confirmed. The whole-file checksum can only be calculated if writing starts at 0
+
+        :param offset: position in the file
+        :return: None
+        :raises ValueError: if the offset isn't valid for this partial file
+        """
+        if not isinstance(offset, int) or offset < 0 or offset > self.resume_offset() or \
+                (offset % self.__block_size and offset != self.resume_offset()):
+            raise ValueError(Constants.INVALID_RESUME)
+        self.__file.seek(offset)
+        self.__position = offset
+        self.__block_checksum = hashlib.sha256()
+        self.__checksum = hashlib.sha256() if offset == 0 else None
+
+    def write(self, data: bytes) -> bool:
+        """
+        Writes data at the sequential write position, confirming every block it completes
+
+        :param data: bytes received
+        :return: False if data goes beyond the file size or a completed block doesn't match its expected
+        checksum (the block isn't confirmed), True otherwise
+        """
+        if self.__filesize is None:
+            self.__file.write(data)
+            self.__checksum.update(data)
+            return True
+        if self.__position + len(data) > self.__filesize:
+            return False
+
+        self.__file.write(data)
+        if self.__checksum is not None:
+            self.__checksum.update(data)
+        view = memoryview(data)
+        while view:
+            index = self.__position // self.__block_size
+            piece = view[:self.__block_end(index) - self.__position]
+            self.__block_checksum.update(piece)
+            self.__position += len(piece)
+            view = view[len(piece):]
+            if self.__position == self.__block_end(index):
+                digest = self.__block_checksum.hexdigest()
+                self.__block_checksum = hashlib.sha256()
+                if self.__expected_digests is not None and self.__expected_digests[index] != digest:
+                    return False
+                self.confirm(index, digest)
+        return True
+
+    def confirm(self, index: int, digest: str) -> None:
+        """
+        Records a block as confirmed. The file is flushed first, so the manifest never lists a block whose
+        data is still in a Python buffer. Safe to call from several threads writing with os.pwrite()
+
+        :param index: index of the block
+        :param digest: sha256 checksum of the block
+        :return: None
+        """
+        with self.__lock:
+            self.__file.flush()
+            self.__blocks[index] = digest
+            self.__manifest.write(f"{index} {digest}\n")
+            self.__manifest.flush()
+
+    def is_complete(self) -> bool:
+        return None not in self.__blocks
+
+    def commit(self, blocks_sha256sum: str = None) -> bool:
+        """
+        Verifies the complete file and renames it to its final path. If it isn't authentic, the partial
+        file and its manifest are removed
+
+        :param blocks_sha256sum: checksum of the sender's list of block checksums, needed if the transfer
+        was resumed and the block checksums weren't known
+        :return: True if the file is authentic
+        """
+        self.close()
+        if self.__expected_digests is not None:
+            is_authentic = self.__blocks == self.__expected_digests
+        elif self.__checksum is not None:
+            is_authentic = self.__checksum.hexdigest() == self.__sha256sum
+        else:
+            is_authentic = blocks_sha256sum is not None and blocks_checksum(self.__blocks) == blocks_sha256sum
+
+        if is_authentic:
+            os.replace(self.part_path, self.path)
+            os.remove(self.manifest_path)
+        else:
+            self.discard()
+        return is_authentic
+
+    def block_digests(self) -> list:
+        return list(self.__blocks)
+
+    def close(self) -> None:
+        """
+        Closes the partial file and its manifest, keeping both so the transfer can be resumed
+        """
+        for file in (self.__file, self.__manifest):
+            if file is not None:
+                file.close()
+
+    def discard(self) -> None:
+        self.close()
+        for path in (self.part_path, self.manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __block_end(self, index: int) -> int:
+        return min((index + 1) * self.__block_size, self.__filesize)
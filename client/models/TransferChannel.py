@@ -0,0 +1,181 @@
+import queue
+import socket
+import struct
+import threading
+from .client_helper import Constants
+
+
+class ChannelStream:
+    """
+    Class representing a single file stream carried by a TransferChannel. It looks like a socket to the code
+    using it (recv, recv_into, send, sendall, settimeout and close), so FileManager and TreeTransfer can use a stream
+    exactly like a transfer connection of their own.
+
+    Received data is queued by the channel as it arrives, up to CHANNEL_STREAM_FRAMES frames. If the stream
+    isn't read and its queue stays full for CHANNEL_STALL_SECONDS, the channel gives up on it and closes it,
+    so a stuck stream can't block the others
+    """
+    def __init__(self, channel, stream_id: int):
+        self.stream_id = stream_id
+        self.__channel = channel
+        self.__incoming = queue.Queue(maxsize=Constants.CHANNEL_STREAM_FRAMES)
+        self.__pending = memoryview(b"")
+        self.__timeout = None
+        self.__eof = False
+        self.__closed = False
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Queues data received for this stream, empty bytes meaning the other side closed it
+
+        :return: False if the stream was stalled and had to be closed
+        """
+        try:
+            self.__incoming.put(data, timeout=Constants.CHANNEL_STALL_SECONDS)
+            return True
+        except queue.Full:
+            self.close()
+            return False
+
+    def recv(self, size: int) -> bytes:
+        """
+        :param size: maximum amount of bytes to return
+        :return: received bytes, or empty bytes once the other side closed the stream
+        :raises socket.timeout: if nothing arrives before the stream's timeout
+        """
+        return bytes(self.__take(size))
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        """
+        Like recv(), but copies the bytes into buffer instead of returning new ones
+
+        :param buffer: writable bytes-like object, like a bytearray or a memoryview of one
+        :param nbytes: maximum amount of bytes to copy, 0 for the size of buffer
+        :return: number of bytes copied, 0 once the other side closed the stream
+        :raises socket.timeout: if nothing arrives before the stream's timeout
+        """
+        view = self.__take(nbytes or len(buffer))
+        buffer[:len(view)] = view
+        return len(view)
+
+    def send(self, data) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data) -> None:
+        if self.__closed:
+            raise BrokenPipeError()
+        view = memoryview(data)
+        for offset in range(0, len(view), Constants.CHANNEL_MAX_FRAME):
+            self.__channel.send_frame(self.stream_id, Constants.CHANNEL_DATA, view[offset:offset + Constants.CHANNEL_MAX_FRAME])
+
+    def settimeout(self, timeout) -> None:
+        self.__timeout = timeout
+
+    def close(self) -> None:
+        if not self.__closed:
+            self.__closed = True
+            self.__channel.close_stream(self.stream_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __take(self, size: int) -> memoryview:
+        """
+        :return: view of at most size bytes of the frame being read, waiting for the next frame if it was
+        read completely. The frame isn't copied until the caller does
+        """
+        if not self.__pending and not self.__eof:
+            try:
+                data = self.__incoming.get(timeout=self.__timeout)
+            except queue.Empty:
+                raise socket.timeout()
+            self.__eof = not data
+            self.__pending = memoryview(data)
+        view, self.__pending = self.__pending[:size], self.__pending[size:]
+        return view
+
+
+class TransferChannel:
+    """
+    Class representing the client side of a long-lived transfer connection that carries many file streams,
+    so transfers don't pay a TCP and TLS handshake each. Every stream is opened with a CHANNEL_OPEN frame and
+    then works like a transfer connection of its own: the transfer request goes first, then the file. Data is
+    sent in CHANNEL_DATA frames, at most CHANNEL_MAX_FRAME bytes each, and CHANNEL_CLOSE closes a stream.
+    Each frame has a 9 bytes header with the stream id (4 bytes), the frame type (1 byte) and the payload
+    length (4 bytes), all big-endian.
+
+    A thread reads the connection and queues the data of each stream, so several transfers (the packs of a
+    directory transfer, for instance) can share it at the same time. If the connection is closed, every open
+    stream reads EOF and the channel is marked as closed, so the client can open a new one
+    """
+    HEADER = struct.Struct(Constants.CHANNEL_HEADER)
+
+    def __init__(self, channel_socket):
+        self.closed = False
+        self.__socket = channel_socket
+        self.__streams = {}
+        self.__next_id = 1
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        threading.Thread(target=self.__read, daemon=True).start()
+
+    def open_stream(self):
+        """
+        :return: a new stream, which can be used like a connected socket, or None if the channel already
+        carries CHANNEL_MAX_STREAMS streams
+        :raises ConnectionResetError: if the channel was closed
+        """
+        with self.__lock:
+            if self.closed:
+                raise ConnectionResetError(Constants.CONNECTION_CLOSED)
+            if len(self.__streams) >= Constants.CHANNEL_MAX_STREAMS:
+                return None
+            stream = self.__streams[self.__next_id] = ChannelStream(self, self.__next_id)
+            self.__next_id += 1
+        self.send_frame(stream.stream_id, Constants.CHANNEL_OPEN)
+        return stream
+
+    def send_frame(self, stream_id: int, frame_type: bytes, payload=b"") -> None:
+        with self.__send_lock:
+            self.__socket.sendall(self.HEADER.pack(stream_id, frame_type, len(payload)) + bytes(payload))
+
+    def close_stream(self, stream_id: int) -> None:
+        with self.__lock:
+            self.__streams.pop(stream_id, None)
+        try:
+            self.send_frame(stream_id, Constants.CHANNEL_CLOSE)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        self.__socket.close()
+
+    def __read(self) -> None:
+        buffer = bytearray()
+        try:
+            while True:
+                data = self.__socket.recv(Constants.STREAM_BUFFER_SIZE)
+                if not data:
+                    break
+                buffer += data
+                while len(buffer) >= self.HEADER.size:
+                    stream_id, frame_type, length = self.HEADER.unpack_from(buffer)
+                    if len(buffer) < self.HEADER.size + length:
+                        break
+                    payload = bytes(buffer[self.HEADER.size:self.HEADER.size + length])
+                    del buffer[:self.HEADER.size + length]
+                    with self.__lock:
+                        stream = self.__streams.get(stream_id)
+                    if stream is not None and (payload or frame_type == Constants.CHANNEL_CLOSE):
+                        stream.feed(payload if frame_type == Constants.CHANNEL_DATA else b"")
+        except OSError:
+            pass
+        with self.__lock:
+            self.closed = True
+            streams, self.__streams = list(self.__streams.values()), {}
+        for stream in streams:
+            stream.feed(b"")
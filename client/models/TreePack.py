@@ -0,0 +1,202 @@
+import os
+import struct
+import hashlib
+from .client_helper import Constants, tree_path
+
+
+class PackSender:
+    """
+    Class producing the stream of a pack: several files of a directory sent one after the other through a
+    single transfer connection. For each file, in the order of the pack manifest, the stream has:
+    - an entry header: a status byte (PACK_FILE_OK or PACK_FILE_MISSING) and the file size, as 8 bytes
+    big-endian integer
+    - the contents of the file, exactly that many bytes
+    - the sha256 digest of the contents (32 bytes), if the file was there
+
+    Headers and small files are buffered together, so packing thousands of small files doesn't mean
+    thousands of tiny TLS records. If a file shrinks while it's read, it's padded so the stream stays in
+    sync, and its digest, calculated on what was actually read, makes the receiver reject it.
+    It doesn't do any I/O on sockets, the caller sends the chunks and reads the counters to report progress
+    """
+    ENTRY = struct.Struct(Constants.PACK_ENTRY)
+
+    def __init__(self, root: str, files: list):
+        self.root = root
+        self.files = files
+        self.sent_files = 0
+        self.sent_bytes = 0
+
+    def chunks(self):
+        """
+        Generator of the pack stream
+
+        :return: generator of bytes, at least STREAM_BUFFER_SIZE long except the last one
+        :raises ValueError: if a path of the manifest isn't inside the root directory
+        """
+        buffer = bytearray()
+        for relative_path in self.files:
+            try:
+                file = open(tree_path(self.root, relative_path), "rb")
+            except OSError:
+                buffer += self.ENTRY.pack(Constants.PACK_FILE_MISSING, 0)
+                continue
+            with file:
+                size = os.fstat(file.fileno()).st_size
+                buffer += self.ENTRY.pack(Constants.PACK_FILE_OK, size)
+                checksum = hashlib.sha256()
+                remaining = size
+                while remaining:
+                    data = file.read(min(remaining, Constants.RANGE_BUFFER_SIZE))
+                    if data:
+                        checksum.update(data)
+                    else:
+                        data = bytes(min(remaining, Constants.RANGE_BUFFER_SIZE))
+                    remaining -= len(data)
+                    self.sent_bytes += len(data)
+                    if len(buffer) + len(data) < Constants.STREAM_BUFFER_SIZE:
+                        buffer += data
+                        continue
+                    if buffer:
+                        yield bytes(buffer)
+                        buffer.clear()
+                    yield data
+                buffer += checksum.digest()
+                self.sent_files += 1
+            if len(buffer) >= Constants.STREAM_BUFFER_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+
+class PackReceiver:
+    """
+    Class writing the files of a pack stream (see PackSender) as it's received. Each file is written to
+    "<file>.part" and renamed to its final path once its digest matches, so a file is never left half
+    written under its real name. The directories listed in the manifest are created first, so empty
+    directories are transferred too.
+
+    Downloads overwrite local files, like a regular get does, so they use overwrite=True. Otherwise files
+    that already exist are skipped and their contents are dropped. Files that are missing on the server,
+    can't be written or don't match their digest are listed in failed, with the reason
+    """
+    ENTRY = struct.Struct(Constants.PACK_ENTRY)
+
+    def __init__(self, root: str, files: list, directories: list = (), overwrite: bool = False):
+        self.root = root
+        self.files = files
+        self.directories = directories
+        self.overwrite = overwrite
+        self.received_files = 0
+        self.received_bytes = 0
+        self.failed = []
+        self.finished = not files
+        self.__buffer = bytearray()
+        self.__index = 0
+        self.__remaining = None
+        self.__file = None
+        self.__path = None
+        self.__checksum = None
+        self.__skip_reason = None
+
+    def open(self) -> None:
+        """
+        Creates the root directory and the directories of the manifest
+
+        :raises ValueError: if a path of the manifest isn't inside the root directory
+        """
+        os.makedirs(self.root, exist_ok=True)
+        for relative_path in self.directories:
+            os.makedirs(tree_path(self.root, relative_path), exist_ok=True)
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Adds data received and writes every part of it that is complete
+
+        :param data: bytes received
+        :return: True once every file of the manifest was received
+        :raises ValueError: if a path of the manifest isn't inside the root directory or an entry is bad formed
+        """
+        self.__buffer += data
+        while self.__buffer and not self.finished:
+            if self.__remaining is None:
+                if len(self.__buffer) < self.ENTRY.size:
+                    break
+                status, size = self.ENTRY.unpack_from(self.__buffer)
+                del self.__buffer[:self.ENTRY.size]
+                self.__start(status, size)
+            elif self.__remaining > 0:
+                data = self.__buffer[:self.__remaining]
+                del self.__buffer[:len(data)]
+                self.__remaining -= len(data)
+                self.received_bytes += len(data)
+                self.__checksum.update(data)
+                if self.__file is not None:
+                    self.__file.write(data)
+            else:
+                if len(self.__buffer) < Constants.PACK_DIGEST_SIZE:
+                    break
+                digest = bytes(self.__buffer[:Constants.PACK_DIGEST_SIZE])
+                del self.__buffer[:Constants.PACK_DIGEST_SIZE]
+                self.__finish(digest)
+        return self.finished
+
+    def close(self) -> None:
+        """
+        Removes the file that was being written, if the stream ended in the middle of it
+        """
+        if self.__file is not None:
+            self.__file.close()
+            os.remove(self.__path + Constants.PARTIAL_SUFFIX)
+            self.__file = None
+
+    def pending_files(self) -> list:
+        """
+        :return: paths of the manifest whose entry wasn't completely received
+        """
+        return self.files[self.__index:]
+
+    def __start(self, status: int, size: int) -> None:
+        relative_path = self.files[self.__index]
+        self.__path = tree_path(self.root, relative_path)
+        if status == Constants.PACK_FILE_MISSING:
+            self.failed.append((relative_path, Constants.FILE_NOT_FOUND))
+            self.__next()
+            return
+        if status != Constants.PACK_FILE_OK:
+            raise ValueError(Constants.INVALID_PACK)
+        self.__remaining = size
+        self.__checksum = hashlib.sha256()
+        self.__skip_reason = None
+        if not self.overwrite and os.path.lexists(self.__path):
+            self.__skip_reason = Constants.FILE_EXISTS
+            return
+        try:
+            os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+            self.__file = open(self.__path + Constants.PARTIAL_SUFFIX, "wb")
+        except OSError as error:
+            self.__skip_reason = error.strerror
+
+    def __finish(self, digest: bytes) -> None:
+        relative_path = self.files[self.__index]
+        if self.__file is None:
+            self.failed.append((relative_path, self.__skip_reason))
+        elif digest != self.__checksum.digest():
+            self.close()
+            self.failed.append((relative_path, Constants.CHECKSUM_MISMATCH))
+        else:
+            self.__file.close()
+            self.__file = None
+            try:
+                os.replace(self.__path + Constants.PARTIAL_SUFFIX, self.__path)
+                self.received_files += 1
+            except OSError as error:
+                os.remove(self.__path + Constants.PARTIAL_SUFFIX)
+                self.failed.append((relative_path, error.strerror))
+        self.__next()
+
+    def __next(self) -> None:
+        self.__remaining = None
+        self.__index += 1
+        self.finished = self.__index == len(self.files)
+
@@ -0,0 +1,215 @@
+import os
+import json
+import threading
+from queue import Queue, Empty
+from socket import timeout
+from .client_helper import Constants, walk_tree, tree_path, wait_for_admission, progress_bar
+from .TreePack import PackSender, PackReceiver
+
+
+class TreeTransfer:
+    """
+    Class representing a recursive get or put of a directory. Instead of a transfer per file, which means a
+    request, a checksum pass and a transfer stream for each one, the files are grouped in packs:
+    up to PACK_MAX_FILES files and PACK_MAX_BYTES bytes are sent one after the other through a single transfer
+    connection, each one followed by its sha256 digest, calculated while it's sent (see PackSender). Files
+    bigger than PACK_MAX_BYTES get a pack of their own.
+
+    Packs are scheduled in a bounded pool of threads, one per stream, biggest packs first so a big file
+    doesn't end up alone at the end. Progress is reported for the whole tree in a single progress bar.
+    Files that fail, because they don't match their digest, can't be written, or the connection of their
+    pack died, are listed at the end. A directory upload doesn't send the files the server already has, so
+    running it again after a failure only sends the files that are missing
+    """
+    def __init__(self, transfer_metadata: dict, open_transfer_stream, streams: int, local_root: str):
+        self.__transfer_metadata = transfer_metadata
+        self.__open_transfer_stream = open_transfer_stream
+        self.__streams = streams
+        self.__local_root = local_root
+        self.__progress = None
+        self.__lock = threading.Lock()
+        self.__transferred = 0
+        self.__skipped = 0
+        self.__failed = []
+
+    def begin(self) -> None:
+        """
+        Main class method. It lists the tree (the server already did it for downloads), plans the packs, runs
+        them in the pool of streams and prints a summary
+
+        :return: None
+        """
+        if self.__transfer_metadata["operation"] == "get_tree":
+            directories, files = self.__transfer_metadata["directories"], self.__transfer_metadata["files"]
+            try:
+                os.makedirs(self.__local_root, exist_ok=True)
+                for directory in directories:
+                    os.makedirs(tree_path(self.__local_root, directory), exist_ok=True)
+            except (OSError, ValueError) as error:
+                print(error)
+                return
+        else:
+            directories, files = walk_tree(self.__local_root)
+
+        pending = Queue()
+        for index, pack in enumerate(self.plan_packs(files)):
+            pending.put((pack, directories if index == 0 else []))
+        if pending.empty() and self.__transfer_metadata["operation"] == "put_tree":
+            pending.put(([], directories))
+
+        total_size = sum(size for _, size in files)
+        description = f"{'Receiving' if self.__transfer_metadata['operation'] == 'get_tree' else 'Sending'} " \
+                      f"{os.path.basename(os.path.normpath(self.__local_root))} ({len(files)} files)"
+        self.__progress = progress_bar(description, total_size)
+        try:
+            workers = [threading.Thread(target=self.worker, args=(pending,)) for _ in range(min(self.__streams, pending.qsize()))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            self.__progress.close()
+
+        print(Constants.TREE_TRANSFERRED.format(self.__transferred, len(files)))
+        if self.__skipped:
+            print(Constants.TREE_SKIPPED.format(self.__skipped))
+        for path, reason in self.__failed[:Constants.TREE_MAX_REPORTED]:
+            print(Constants.TREE_FAILED.format(path, reason))
+        if len(self.__failed) > Constants.TREE_MAX_REPORTED:
+            print(Constants.TREE_MORE_FAILED.format(len(self.__failed) - Constants.TREE_MAX_REPORTED))
+
+    @staticmethod
+    def plan_packs(files: list) -> list:
+        """
+        Groups files in packs of at most PACK_MAX_FILES files and PACK_MAX_BYTES bytes. Files that are
+        bigger than that are alone in their pack
+
+        :param files: list of [path, size] of the files to transfer
+        :return: list of packs, each one a list of [path, size], sorted by size, biggest first
+        """
+        packs = []
+        pack, pack_size = [], 0
+        for path, size in files:
+            if size >= Constants.PACK_MAX_BYTES:
+                packs.append(([[path, size]], size))
+                continue
+            if len(pack) == Constants.PACK_MAX_FILES or pack_size + size > Constants.PACK_MAX_BYTES:
+                packs.append((pack, pack_size))
+                pack, pack_size = [], 0
+            pack.append([path, size])
+            pack_size += size
+        if pack:
+            packs.append((pack, pack_size))
+        return [pack for pack, _ in sorted(packs, key=lambda planned: planned[1], reverse=True)]
+
+    def worker(self, pending: Queue) -> None:
+        """
+        Takes packs from the queue and transfers them until the queue is empty
+
+        :param pending: Queue of (pack, directories) tuples
+        :return: None
+        """
+        while True:
+            try:
+                pack, directories = pending.get_nowait()
+            except Empty:
+                return
+            if self.__transfer_metadata["operation"] == "get_tree":
+                self.receive_pack([path for path, _ in pack])
+            else:
+                self.send_pack(pack, directories)
+
+    def open_pack(self, manifest: dict):
+        """
+        Opens a transfer stream (see Client.open_transfer_stream()), sends the transfer request and, once the
+        server is ready, the manifest of the pack, which can be too big to go in the request
+
+        :param manifest: Dictionary with the "files" of the pack and the "directories" to create
+        :return: the transfer stream, a ChannelStream or a connected SSLSocket
+        """
+        data = json.dumps(manifest).encode()
+        request = {key: self.__transfer_metadata.get(key) for key in ("operation", "absolute_path", "token")}
+        request["queue"] = bool(self.__transfer_metadata.get("queue_flags"))
+        request["manifest_size"] = len(data)
+        transfer_socket = self.__open_transfer_stream(self.__transfer_metadata["transfer_port"], self.__transfer_metadata["token"])
+        transfer_socket.settimeout(Constants.TRANSFER_TIMEOUT_SECONDS)
+        transfer_socket.sendall(json.dumps(request).encode())
+        if request["queue"]:
+            wait_for_admission(transfer_socket)
+        transfer_socket.recv(len(Constants.READY_FLAG))
+        transfer_socket.sendall(data)
+        return transfer_socket
+
+    def receive_pack(self, files: list) -> None:
+        """
+        Downloads a pack, writing each file in the local directory as soon as it's complete and verified
+
+        :param files: paths of the files of the pack
+        :return: None
+        """
+        receiver = PackReceiver(self.__local_root, files, overwrite=True)
+        try:
+            with self.open_pack({"files": files}) as transfer_socket:
+                while not receiver.finished:
+                    received = receiver.received_bytes
+                    bytes_read = transfer_socket.recv(Constants.RANGE_BUFFER_SIZE)
+                    if not bytes_read:
+                        break
+                    receiver.feed(bytes_read)
+                    self.__update_progress(receiver.received_bytes - received)
+        except (OSError, timeout, ValueError):
+            pass
+        finally:
+            receiver.close()
+        self.__finish_pack(receiver.received_files, 0, receiver.failed + [(path, Constants.TREE_INTERRUPTED) for path in receiver.pending_files()])
+
+    def send_pack(self, pack: list, directories: list) -> None:
+        """
+        Uploads a pack and reads the server's summary of the files it stored. Right after the manifest, the
+        server answers a byte per file, b"1" for the files it already has, which are left out of the stream
+
+        :param pack: list of [path, size] of the files of the pack
+        :param directories: directories the server has to create, only sent with the first pack
+        :return: None
+        """
+        files = [path for path, _ in pack]
+        summary = None
+        try:
+            with self.open_pack({"files": files, "directories": directories}) as transfer_socket:
+                existing = bytearray()
+                while len(existing) < len(files):
+                    bytes_read = transfer_socket.recv(len(files) - len(existing))
+                    if not bytes_read:
+                        raise ConnectionResetError(Constants.CONNECTION_CLOSED)
+                    existing += bytes_read
+                self.__update_progress(sum(size for (_, size), exists in zip(pack, existing) if exists == ord("1")))
+                sender = PackSender(self.__local_root, [path for path, exists in zip(files, existing) if exists != ord("1")])
+                reported = 0
+                for chunk in sender.chunks():
+                    transfer_socket.sendall(chunk)
+                    self.__update_progress(sender.sent_bytes - reported)
+                    reported = sender.sent_bytes
+                response = bytearray()
+                while True:
+                    bytes_read = transfer_socket.recv(Constants.STREAM_BUFFER_SIZE)
+                    if not bytes_read:
+                        break
+                    response += bytes_read
+                summary = json.loads(response.decode())
+        except (OSError, timeout, ValueError):
+            pass
+
+        if summary is None:
+            self.__finish_pack(0, 0, [(path, Constants.TREE_INTERRUPTED) for path in files])
+        else:
+            self.__finish_pack(summary["received"], summary["skipped"], [tuple(failure) for failure in summary["failed"]])
+
+    def __finish_pack(self, transferred: int, skipped: int, failed: list) -> None:
+        with self.__lock:
+            self.__transferred += transferred
+            self.__skipped += skipped
+            self.__failed += failed
+
+    def __update_progress(self, amount: int) -> None:
+        with self.__lock:
+            self.__progress.update(amount)
@@ -1,12 +1,22 @@
 import hashlib
+import mmap
+import os
+import sys
+import time
+import zlib
+import bz2
+import lzma
 
 
 class Constants:
     OPT_LEN_ERROR = "Error: Expected 2 options [-a | --address] and [-p | --port]"
     OPT_VALUE_ERROR = "Error: Port must be an integer bigger than 1024"
+    STREAMS_VALUE_ERROR = "Error: Streams must be a positive integer"
+    COMPRESSION_VALUE_ERROR = "Error: Compression must be zlib, bz2 or lzma, optionally followed by a level from 1 to 9 (zlib:6)"
     CONNECTION_REFUSED_ERROR = "There's not a file server in the given (address, port) pair"
     CERT_NOT_FOUND = "Certificate not found"
     MISSING_DOTENV = "Missing .env file with PATH_TO_CERT variable"
+    STARTUP_STEP = "startup: {:<14}{:>9.2f} ms"
 
     PROMPT_COLOR = "\033[1;36m"
     OK_COLOR = "\033[0;92m"
@@ -19,29 +29,117 @@ class Constants:
     INVALID_COMMAND = "Command not recognized. Use 'help' to show available commands"
 
     BUFFER_SIZE = 4096
+    STREAM_BUFFER_SIZE = 64 * 1024
+    RECEIVE_BUFFER_SIZE = 256 * 1024
+    DECOMPRESSION_CHUNK_SIZE = 256 * 1024
+    DECOMPRESSED_TOO_BIG = "Decompressed data is bigger than the file"
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+    FRAMED_PROTOCOL_VERSION = "2"
+    BATCH_SIZE = 500
     FILE_BUFFER_SIZE = 4096
+    CHECKSUM_BLOCK_SIZE = 1024 * 1024
+    TRANSFER_BLOCK_SIZE = 4 * 1024 * 1024
     TRANSFER_TIMEOUT_SECONDS = 4
+    READY_FLAG = b'10101010'
+    DEDUP_FLAG = b'01010101'
+    REJECTED_FLAG = b'11001100'
+    QUEUED_FLAG = b'11110000'
+    ADMITTED_FLAG = b'00001111'
+    CHANNEL_HEADER = "!IcI"
+    CHANNEL_OPEN = b"O"
+    CHANNEL_DATA = b"D"
+    CHANNEL_CLOSE = b"C"
+    CHANNEL_MAX_FRAME = 256 * 1024
+    CHANNEL_MAX_STREAMS = 64
+    CHANNEL_STREAM_FRAMES = 32
+    CHANNEL_STALL_SECONDS = 30
+    TRANSFER_REQUEST_FIELDS = ("operation", "absolute_path", "filesize", "token", "sha256sum", "blocks_sha256sum",
+                               "codec", "level")
+    PARTIAL_SUFFIX = ".part"
+    MANIFEST_SUFFIX = ".manifest"
+    CODECS = ("zlib", "bz2", "lzma")
+    COMPRESSION_LEVELS = range(1, 10)
+    COMPRESSION_SAMPLE_SIZE = 256 * 1024
+    COMPRESSION_MIN_SIZE = 4096
+    COMPRESSION_MAX_RATIO = 0.9
+    DELTA_ROLLING_BLOCKS = 16
+    DELTA_LITERAL_FLUSH = 1024 * 1024
+    DELTA_MAX_LITERAL = 1024 * 1024
+    DELTA_COPY = b"C"
+    DELTA_DATA = b"D"
+    DELTA_END = b"E"
+    SIGNATURE_HEADER = "!QII"
+    SIGNATURE_ENTRY = "!I32s"
+    DEFAULT_STREAMS = 4
+    RANGE_BLOCKS = 8
+    RANGE_BUFFER_SIZE = 64 * 1024
+    RANGE_RETRIES = 3
+    RECURSIVE_FLAG = "-r"
+    LONG_LIST_FLAG = "-l"
+    LIST_TIME_FORMAT = "%Y-%m-%d %H:%M"
+    FIND_SIZE_UNITS = {"k": 1024, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    FIND_OPTIONS = ("-size", "-mtime", "-limit")
+    SECONDS_PER_DAY = 24 * 60 * 60
+    PACK_ENTRY = "!BQ"
+    PACK_FILE_OK = 0
+    PACK_FILE_MISSING = 1
+    PACK_DIGEST_SIZE = 32
+    PACK_MAX_FILES = 1000
+    PACK_MAX_BYTES = 64 * 1024 * 1024
+    TREE_MAX_REPORTED = 20
 
     CALCULATING_CHECKSUM = "Calculating checksum..."
     OK_MESSAGE = "OK"
     INVALID_CHECKSUM = "CORRUPTED FILE\nDownload failed. Try again"
     FILE_UPLOADED = "File successfully uploaded"
+    TRANSFER_QUEUED = "The server is busy, the transfer is queued..."
+    TRANSFER_REJECTED = "The server rejected the transfer ticket"
+    ASKING_AGAIN = "The transfer ticket expired, asking the server for the transfer again..."
+    FILE_DEDUPLICATED = "File successfully uploaded (the server already had its content, nothing was sent)"
     FILE_DOWNLOADED = "File successfully downloaded"
+    BLOCKS_VERIFIED = "{} blocks verified"
+    TRANSFER_INTERRUPTED = "Transfer interrupted. Run the same command again to resume it"
+    RESUMING_TRANSFER = "Resuming transfer at"
+    DELTA_SENT = "Sent {} bytes of changed data, reused {} bytes the server already had"
+    COMPRESSION_SAVED = "Compressed with {}: {} bytes went through the network instead of {}"
+    INVALID_RESUME = "Transfers can only be resumed at a confirmed block boundary"
+    TREE_TRANSFERRED = "{} of {} files transferred"
+    TREE_SKIPPED = "{} files were already on the server and weren't sent"
+    TREE_FAILED = "Failed: {} ({})"
+    TREE_MORE_FAILED = "... and {} more"
+    TREE_INTERRUPTED = "interrupted"
 
     FILE_NOT_FOUND = "No such file"
+    FILE_EXISTS = "File already exists"
+    CHECKSUM_MISMATCH = "Checksum doesn't match"
+    INVALID_PACK = "Bad formed pack entry"
+    INVALID_TREE_PATH = "Paths in a directory transfer must be relative and stay inside the directory"
     DIRECTORY_NOT_FOUND = "No such directory"
     DIRECTORY_EXISTS = "Directory already exists"
     DISCONNECTED_MESSAGE = "Disconnected from file-server"
+    MESSAGE_TOO_BIG = "Message exceeds the maximum message size"
+    CONNECTION_CLOSED = "Connection closed by the server"
+    SERVER_INVALID_COMMAND = "Invalid command or argument(s)"
+    FIND_USAGE = "Usage: find <pattern> [route] [-size +N|-N] [-mtime -days|+days] [-limit N]"
+    FIND_MORE_RESULTS = "There are more results, narrow the search or use -limit to see them"
     HELP_COMMANDS = {
         "help": "show this message",
         "pwd": "show server's current working directory (remote)",
         "lpwd": "show your current working directory (local)",
         "ls     [route]": "list files and directories (remote)",
+        "ls -l  [route]": "list files and directories with their type, size and modification time (remote)",
         "lls    [route]": "list files and directories (local)",
         "cd     <route>": "change server's current working directory (remote)",
         "lcd    <route>": "change your current working directory (local)",
         "get    <filename>": "download [filename] from the server (remote)",
+        "get -r <dirname>": "download [dirname] and everything inside it (remote)",
         "put    <filename>": "upload [filename] to the server (remote)",
+        "put -r <dirname>": "upload [dirname] and everything inside it (remote)",
+        "sync   <filename>": "upload [filename], sending only what changed if the server has it (remote)",
+        "find   <pattern> [route]": "search files and directories matching pattern (*, ?, [...]) inside route (remote)",
+        "  -size +N | -N": "at least / at most N bytes, N can end in k, M or G",
+        "  -mtime -D | +D": "modified less / more than D days ago",
+        "  -limit N": "show at most N results (1000 by default)",
         "lmkdir <dirname>": "create a directory (local)",
         "mkdir  <dirname>": "create a directory (remote)",
         "exit": "close the connection and leave the program"
@@ -66,12 +164,303 @@ class Constants:
     def connected_message(address, port):
         return f"Connected to File Server at {address} on port {port}"
 
+    @staticmethod
+    def list_entry(name, entry_type, size, mtime):
+        return f"{entry_type} {size:>12} {time.strftime(Constants.LIST_TIME_FORMAT, time.localtime(mtime))} {name}"
+
+    @staticmethod
+    def receive_buffer_size():
+        return int(os.getenv("RECEIVE_BUFFER_SIZE") or Constants.RECEIVE_BUFFER_SIZE)
+
     @staticmethod
     def thread_name(operation, filename):
         return f"Thr[{operation}]-{filename}"   # Thr[put]-Rute.pdf
 
 
-def calculate_checksum(filepath):
+class SilentProgress:
+    """
+    Progress bar that doesn't show anything, used instead of tqdm when there's nobody to see it
+    """
+    def update(self, amount: int) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def progress_bar(description: str, total: int, initial: int = 0):
+    """
+    Creates the progress bar of a transfer, in bytes. tqdm is imported here, the first time a bar is shown,
+    since it takes most of the client's import time. When stderr isn't a terminal (cron jobs, output sent to
+    a file) there's no bar to show, and tqdm isn't imported at all
+
+    :param description: text shown before the bar, like "Receiving file.txt"
+    :param total: number of bytes of the transfer
+    :param initial: number of bytes already transferred, for resumed transfers
+    :return: a tqdm progress bar, or a SilentProgress
+    """
+    if not sys.stderr.isatty():
+        return SilentProgress()
+    import tqdm
+    return tqdm.tqdm(total=total, desc=description, unit="B", unit_scale=True, unit_divisor=1024, initial=initial)
+
+
+def calculate_checksum(filepath, use_mmap: bool = False) -> str:
+    """
+    Calculates the sha256 checksum of the given file, reading it in blocks of CHECKSUM_BLOCK_SIZE bytes
+    so memory usage doesn't depend on the file size
+
+    :param filepath: path to the file to hash
+    :param use_mmap: if True, the file is memory-mapped and hashed through a memoryview instead of being
+    read into Python buffers
+    :return: hex digest of the file
+    """
+    checksum = hashlib.sha256()
     with open(filepath, 'rb') as file:
-        checksum = hashlib.sha256(file.read())
-        return checksum.hexdigest()
+        if use_mmap and os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for start in range(0, len(view), Constants.CHECKSUM_BLOCK_SIZE):
+                    checksum.update(view[start:start + Constants.CHECKSUM_BLOCK_SIZE])
+        else:
+            buffer = bytearray(Constants.CHECKSUM_BLOCK_SIZE)
+            with memoryview(buffer) as view:
+                while True:
+                    bytes_read = file.readinto(view)
+                    if not bytes_read:
+                        break
+                    checksum.update(view[:bytes_read])
+    return checksum.hexdigest()
+
+
+def calculate_block_checksums(filepath, block_size: int) -> tuple:
+    """
+    Calculates, in a single read of the file, its sha256 checksum and the sha256 checksum of every block of
+    block_size bytes
+
+    :param filepath: path to the file to hash
+    :param block_size: size of the blocks in bytes (the last block can be shorter)
+    :return: a tuple with the hex digest of the file and the list of hex digests of its blocks
+    """
+    checksum = hashlib.sha256()
+    block_digests = []
+    buffer = bytearray(block_size)
+    with open(filepath, 'rb') as file, memoryview(buffer) as view:
+        while True:
+            bytes_read = file.readinto(view)
+            if not bytes_read:
+                break
+            checksum.update(view[:bytes_read])
+            block_digests.append(hashlib.sha256(view[:bytes_read]).hexdigest())
+    return checksum.hexdigest(), block_digests
+
+
+def blocks_checksum(block_digests: list) -> str:
+    """
+    Calculates the sha256 checksum of a list of block checksums, the one the server compares to verify a
+    resumed upload
+
+    :param block_digests: list of hex digests of the file blocks
+    :return: hex digest of the list
+    """
+    return hashlib.sha256("".join(block_digests).encode()).hexdigest()
+
+
+def compressor(codec: str, level: int):
+    """
+    :return: a streaming compressor of the given codec, with compress() and flush() methods
+    """
+    if codec == "zlib":
+        return zlib.compressobj(level)
+    if codec == "bz2":
+        return bz2.BZ2Compressor(level)
+    return lzma.LZMACompressor(preset=level)
+
+
+DECOMPRESSION_ERRORS = (EOFError, OSError, zlib.error, lzma.LZMAError)
+
+
+def decompressor(codec: str):
+    """
+    :return: a streaming decompressor of the given codec, with a decompress() method
+    """
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+
+class BoundedDecompressor:
+    """
+    Streaming decompressor whose output is bounded. The codec and the data come from the other side of the
+    connection, and a few hundred bytes of bz2 can inflate to hundreds of MiB, so data is never inflated all at
+    once: each piece is at most DECOMPRESSION_CHUNK_SIZE bytes, and the whole output at most limit bytes, the
+    size that is expected
+    """
+    def __init__(self, codec: str, limit: int):
+        self.__engine = decompressor(codec)
+        self.__remaining = limit
+
+    def decompress(self, data):
+        """
+        Decompresses data, piece by piece. zlib keeps the input it didn't use in unconsumed_tail, bz2 and lzma
+        keep it inside and are called again with no input until they need more
+
+        :param data: compressed bytes received
+        :return: generator of the decompressed pieces
+        :raises EOFError: if the output goes beyond the limit
+        """
+        while True:
+            max_length = min(self.__remaining + 1, Constants.DECOMPRESSION_CHUNK_SIZE)
+            piece = self.__engine.decompress(data, max_length)
+            if len(piece) > self.__remaining:
+                raise EOFError(Constants.DECOMPRESSED_TOO_BIG)
+            self.__remaining -= len(piece)
+            if piece:
+                yield piece
+            if hasattr(self.__engine, "unconsumed_tail"):
+                data = self.__engine.unconsumed_tail
+                if not data and len(piece) < max_length:
+                    return
+            else:
+                data = b""
+                if self.__engine.eof or self.__engine.needs_input:
+                    return
+
+
+def is_compressible(filepath, codec: str, level: int, offset: int = 0) -> bool:
+    """
+    Compresses a sample of the file, its first COMPRESSION_SAMPLE_SIZE bytes from offset, to tell if
+    compressing an upload is worth the CPU
+
+    :param filepath: path to the file
+    :param codec: codec that would be used
+    :param level: compression level that would be used
+    :param offset: position of the file where the upload starts
+    :return: True if the sample shrinks to COMPRESSION_MAX_RATIO of its size or less
+    """
+    with open(filepath, 'rb') as file:
+        file.seek(offset)
+        sample = file.read(Constants.COMPRESSION_SAMPLE_SIZE)
+    if len(sample) < Constants.COMPRESSION_MIN_SIZE:
+        return False
+    engine = compressor(codec, level)
+    compressed_size = len(engine.compress(sample)) + len(engine.flush())
+    return compressed_size <= len(sample) * Constants.COMPRESSION_MAX_RATIO
+
+
+class TransferRejected(ConnectionError):
+    """
+    Raised when the server answers a transfer request with the rejected flag, because its ticket expired or
+    was already used. The transfer can be asked for again, with a new ticket
+    """
+    def __init__(self):
+        super().__init__(Constants.TRANSFER_REJECTED)
+
+
+def wait_for_admission(transfer_socket) -> bool:
+    """
+    Reads the flags a server that queues transfers sends right after a transfer request with "queue": the
+    queued flag every few seconds while the transfer waits, and the admitted flag once it can start. Servers
+    that support it have "queue_flags" in the transfer metadata. It can't have the same name as the request
+    field, since older clients send the metadata back as their transfer request. If the ticket isn't valid
+    anymore, the server sends the rejected flag instead
+
+    :param transfer_socket: transfer connection or ChannelStream where the transfer request was sent
+    :return: True if the transfer had to wait in the queue
+    :raises TransferRejected: if the server rejected the transfer ticket
+    """
+    queued = False
+    while True:
+        flag = b""
+        while len(flag) < len(Constants.ADMITTED_FLAG):
+            bytes_read = transfer_socket.recv(len(Constants.ADMITTED_FLAG) - len(flag))
+            if not bytes_read:
+                return queued
+            flag += bytes_read
+        if flag == Constants.REJECTED_FLAG:
+            raise TransferRejected()
+        if flag != Constants.QUEUED_FLAG:
+            return queued
+        queued = True
+
+
+def walk_tree(root: str) -> tuple:
+    """
+    Lists every directory and regular file under root, using os.scandir() so the type and size of each
+    entry mostly come from the directory listing itself. Symbolic links to directories aren't followed
+
+    :param root: path to the directory
+    :return: a tuple with the list of directories and the list of [path, size] of the files, both with paths
+    relative to root and sorted
+    """
+    directories, files = [], []
+    pending = [""]
+    while pending:
+        relative_directory = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative_directory))
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_directory, entry.name)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(relative_path)
+                        pending.append(relative_path)
+                    elif entry.is_file():
+                        files.append([relative_path, entry.stat().st_size])
+                except OSError:
+                    continue
+    return sorted(directories), sorted(files)
+
+
+def find_request(argument: str) -> dict:
+    """
+    Parses the argument of the find command, the pattern, optionally followed by the directory to search and
+    find(1)-like filters: -size +N (at least N bytes) or -N (at most), -mtime -D (modified less than D days ago)
+    or +D (more), and -limit N
+
+    :param argument: String with the argument typed by the user
+    :return: Dictionary representing the argument of the json-formatted find request
+    :raises ValueError: if the argument doesn't follow the usage
+    """
+    words = argument.split()
+    request = {"pattern": words.pop(0), "path": None}
+    if words and words[0] not in Constants.FIND_OPTIONS:
+        request["path"] = words.pop(0)
+    if len(words) % 2:
+        raise ValueError(Constants.FIND_USAGE)
+    for option, value in zip(words[::2], words[1::2]):
+        sign, number = (value[0], value[1:]) if value[0] in "+-" else ("+", value)
+        if option == "-size":
+            multiplier = Constants.FIND_SIZE_UNITS.get(number[-1:], 1)
+            size = int(float(number.rstrip("".join(Constants.FIND_SIZE_UNITS))) * multiplier)
+            request["min_size" if sign == "+" else "max_size"] = size
+        elif option == "-mtime":
+            age = int(float(number) * Constants.SECONDS_PER_DAY)
+            request["min_age" if sign == "+" else "max_age"] = age
+        elif option == "-limit" and sign == "+":
+            request["limit"] = int(number)
+        else:
+            raise ValueError(Constants.FIND_USAGE)
+    return request
+
+
+def tree_path(root: str, relative_path: str) -> str:
+    """
+    Checks a path sent by the server, so a directory download can't write outside of its directory
+
+    :param root: path to the directory being transferred
+    :param relative_path: path of a file or directory inside it
+    :return: the path of relative_path inside root
+    :raises ValueError: if relative_path is absolute or leaves root
+    """
+    if not isinstance(relative_path, str) or not relative_path or os.path.isabs(relative_path):
+        raise ValueError(Constants.INVALID_TREE_PATH)
+    path = os.path.normpath(os.path.join(root, relative_path))
+    if os.path.commonpath([os.path.abspath(root), os.path.abspath(path)]) != os.path.abspath(root) or \
+            os.path.abspath(path) == os.path.abspath(root):
+        raise ValueError(Constants.INVALID_TREE_PATH)
+    return path
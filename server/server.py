@@ -6,15 +6,16 @@ import socket
 import src
 import os
 import multiprocessing
+import asyncio
 import threading
 import signal
-import secrets
 import ssl
 from dotenv import load_dotenv
 import time
 
 
 PROCESSES_LIST = []
+CHECKSUM_CACHE = None
 
 
 def load_cert() -> None:
@@ -42,6 +43,11 @@ def handle_close(s, frame) -> None:
     :return: None
     """
     print(src.Constants.EXITING)
+    if CHECKSUM_CACHE is not None:
+        CHECKSUM_CACHE.flush()
+        if multiprocessing.parent_process() is None:
+            print(src.Constants.checksum_cache_stats(CHECKSUM_CACHE.stats()))
+    src.EVENT_LOG.stop()
     exit(0)
 
 
@@ -59,96 +65,207 @@ def joiner() -> None:
             PROCESSES_LIST.remove(p)
 
 
-def read_ports() -> tuple:
+def refresh_path_index(path_index) -> None:
     """
-    Reads command-line options looking for ports numbers to run the server in, in case that one
-    or both ports are missing, it will use default ones (8080 for main connection and 3000 for transfers)
+    Recurrent background task that brings the path index up to date (see PathIndex.refresh()), so find
+    commands are answered from it right away. The first refresh, which can take long on a big tree, starts
+    right after the server does
 
-    :return: a tuple with two integer values (the main port and the transfer port)
+    :param path_index: PathIndex instance of the served directory
     """
-    (opt, arg) = getopt.getopt(sys.argv[1:], 'p:t:', ['port=', 'transfer-port='])
-    port, transfer_port = 8080, 3000
+    while True:
+        path_index.refresh()
+        time.sleep(src.Constants.PATH_INDEX_REFRESH_SECONDS)
 
-    for (option, argument) in opt:
-        if option == '-p' or option == '--port':
-            port = int(argument)
-        elif option == '-t' or option == '--transfer-port':
-            transfer_port = int(argument)
 
-    if port < 1024 or transfer_port < 1024:
-        raise ConnectionRefusedError(src.Constants.RESERVED_PORTS)
+def expire_partial_files(path_index) -> None:
+    """
+    Recurrent background task that removes the partial files of abandoned uploads (see PartialFile.expire()).
+    They're looked for in the path index, whose modification times can be older than the real ones, so the
+    files it finds are checked again before they're removed
 
-    assert port != transfer_port
-    return port, transfer_port
+    :param path_index: PathIndex instance of the served directory
+    """
+    suffix = src.Constants.PARTIAL_SUFFIX + src.Constants.MANIFEST_SUFFIX
+    while True:
+        time.sleep(src.Constants.PARTIAL_EXPIRY_INTERVAL_SECONDS)
+        try:
+            manifests, _ = path_index.search(path_index.root, f"*{suffix}",
+                                             max_mtime=int(time.time() - src.Constants.PARTIAL_EXPIRY_SECONDS),
+                                             limit=src.Constants.PARTIAL_EXPIRY_BATCH)
+        except ValueError:
+            continue
+        removed = src.PartialFile.expire([path[:-len(suffix)] for path, _, _, _ in manifests])
+        if removed:
+            src.EVENT_LOG.event("expired", f"{removed} {src.Constants.PARTIAL_FILES_EXPIRED}", "YELLOW", files=removed)
 
 
-def perform_handshake(accepted_socket: ssl.SSLSocket) -> None:
+def read_options() -> dict:
+    """
+    Reads command-line options looking for ports numbers to run the server in and the server mode. In case that
+    one or both ports are missing, it will use default ones (8080 for main connection and 3000 for transfers).
+    Mode can be 'process' (default, a process per client and a thread per transfer), 'async' (a single
+    asyncio event loop serving every connection) or 'prefork' (a pool of asyncio workers sharing both ports
+    with SO_REUSEPORT, as many as cores unless -w/--workers is given). At most -c/--max-transfers transfers
+    (32 by default) run at the same time, and -r/--client-rate limits each client to a number of bytes per
+    second, like 512K or 10M (unlimited by default). If -s/--metrics-port is given, the metrics are served
+    in that port of the loopback interface. Logs are printed as colored text, or json with -f/--log-format json,
+    and -l/--log-file also writes them, in json, to a rotated file. -y/--fsync says how uploads are flushed to disk
+    when they're put in place: 'none' (default), 'commit', 'group' or 'syncfs' (see Committer). -d/--root is the
+    directory clients are served, and kept inside of ($HOME by default)
+
+    :return: a dictionary with the main port, the transfer port, the server mode, the number of workers, the
+    maximum number of transfers, the client rate, the metrics port, the log format, the log file, the fsync policy
+    and the served root
+    """
+    (opt, arg) = getopt.getopt(sys.argv[1:], 'p:t:m:w:c:r:s:f:l:y:d:', ['port=', 'transfer-port=', 'mode=', 'workers=',
+                                                                         'max-transfers=', 'client-rate=', 'metrics-port=',
+                                                                         'log-format=', 'log-file=', 'fsync=', 'root='])
+    options = {"port": 8080, "transfer_port": 3000, "mode": src.Constants.PROCESS_MODE, "workers": os.cpu_count() or 1,
+               "max_transfers": src.Constants.TRANSFER_MAX_ACTIVE, "client_rate": None, "metrics_port": None,
+               "log_format": src.Constants.LOG_TEXT, "log_file": None, "fsync": src.Constants.FSYNC_NONE,
+               "root": os.getenv("HOME", default="/home")}
+
+    for (option, argument) in opt:
+        if option == '-p' or option == '--port':
+            options["port"] = int(argument)
+        elif option == '-t' or option == '--transfer-port':
+            options["transfer_port"] = int(argument)
+        elif option == '-m' or option == '--mode':
+            options["mode"] = argument
+        elif option == '-w' or option == '--workers':
+            options["workers"] = int(argument)
+        elif option == '-c' or option == '--max-transfers':
+            options["max_transfers"] = int(argument)
+        elif option == '-r' or option == '--client-rate':
+            options["client_rate"] = src.parse_rate(argument)
+        elif option == '-s' or option == '--metrics-port':
+            options["metrics_port"] = int(argument)
+        elif option == '-f' or option == '--log-format':
+            options["log_format"] = argument
+        elif option == '-l' or option == '--log-file':
+            options["log_file"] = argument
+        elif option == '-y' or option == '--fsync':
+            options["fsync"] = argument
+        elif option == '-d' or option == '--root':
+            options["root"] = argument
+
+    if options["port"] < 1024 or options["transfer_port"] < 1024:
+        raise ConnectionRefusedError(src.Constants.RESERVED_PORTS)
+    if options["mode"] not in src.Constants.SERVER_MODES:
+        raise ValueError(src.Constants.INVALID_MODE)
+    if options["workers"] < 1:
+        raise ValueError(src.Constants.WORKERS_VALUE_ERROR)
+    if options["max_transfers"] < 1:
+        raise ValueError(src.Constants.MAX_TRANSFERS_VALUE_ERROR)
+    if options["metrics_port"] is not None and options["metrics_port"] < 1:
+        raise ValueError(src.Constants.METRICS_PORT_VALUE_ERROR)
+    if options["log_format"] not in src.Constants.LOG_FORMATS:
+        raise ValueError(src.Constants.LOG_FORMAT_ERROR)
+    if options["fsync"] not in src.Constants.FSYNC_POLICIES:
+        raise ValueError(src.Constants.FSYNC_POLICY_ERROR)
+    if not os.path.isdir(options["root"]):
+        raise ValueError(src.Constants.ROOT_NOT_A_DIRECTORY)
+
+    assert options["port"] != options["transfer_port"]
+    return options
+
+
+def perform_handshake(accepted_socket: ssl.SSLSocket, port: str) -> None:
     """
     Tries to perform a TLS handshake, if handshake don't succeed in 10 seconds, it closes the
-    connection
+    connection. The time of successful handshakes is recorded in the metrics
 
     :param accepted_socket: SSLSocket object wrapping an accepted client socket
+    :param port: "main" or "transfer", the port where the connection was accepted
     :return: None
     """
     accepted_socket.settimeout(src.Constants.HANDSHAKE_TIMEOUT_SECONDS)
     try:
+        started = time.perf_counter()
         accepted_socket.do_handshake()
+        src.METRICS.observe(src.Constants.HANDSHAKE_DURATION, time.perf_counter() - started, port)
         accepted_socket.settimeout(None)
     except (socket.timeout, ssl.SSLError, OSError):
         accepted_socket.close()
         exit(0)
 
 
-def attend_client(client_socket, address: str, SESSION_TOKEN: str, transfers_port: int) -> None:
+def attend_client(client_socket, address: str, tickets, transfers_port: int, checksum_cache, directory_index,
+                  path_index, root) -> None:
     """
     Handler for a client connection to the main port. It creates a Connection instance and call
     its start() method
 
     :param client_socket: socket object returned by accept() method of server main socket
     :param address: tuple representing client's address and port, also returned by accept() method
-    :param SESSION_TOKEN: server security token. Client needs it to request file transfers
+    :param tickets: TicketTable instance where the transfers the client is allowed are issued
     :param transfers_port: port number where server is listening for transfers. Client needs it to request
     file transfers
+    :param checksum_cache: ChecksumCache instance used to answer the checksum of requested files
+    :param directory_index: DirectoryIndex instance used to answer ls and list commands
+    :param path_index: PathIndex instance used to answer find commands
+    :param root: ServedRoot instance the client is kept inside of
     :return: None
     """
-    perform_handshake(client_socket)
-    src.print_colored(color="GREEN", message=f"{src.Constants.date_time()} Got a connection from {address}")
-    conn = src.Connection(client_socket, address, SESSION_TOKEN, transfers_port)
+    # answers are written at once, so Nagle would only hold them back (asyncio sets it on its sockets too)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    perform_handshake(client_socket, "main")
+    src.METRICS.inc(src.Constants.ACTIVE_CONNECTIONS, label="main")
+    conn = src.Connection(client_socket, address, tickets, transfers_port, checksum_cache, directory_index, path_index, root)
+    src.EVENT_LOG.event("connected", f"Got a connection from {address}", "GREEN", client=address, session=conn.session_id)
     try:
         conn.start()
     except ConnectionResetError:
         pass
-    src.print_colored(color="RED", message=f"{src.Constants.date_time()} Client {address} disconnected")
+    finally:
+        src.METRICS.dec(src.Constants.ACTIVE_CONNECTIONS, label="main")
+        checksum_cache.flush()
+    src.EVENT_LOG.event("disconnected", f"Client {address} disconnected", "RED", client=address, session=conn.session_id)
 
 
-def attend_transfer(client_socket, address: str, SESSION_TOKEN: str) -> None:
+def attend_transfer(client_socket, address: str, tickets, checksum_cache, content_store, scheduler, committer, root) -> None:
     """
     Handler for a client connection to the transfer port. It creates a Transfer instance and call
     its begin method. This function ends when said transfer is done
 
     :param client_socket: socket object returned by accept() method of server transfer socket
     :param address: tuple representing client's address and port, also returned by accept() method
-    :param SESSION_TOKEN: Server security token. Transfer instance will request the client for a
-    token and compare it with this one before sending or receiving any file
+    :param tickets: TicketTable instance. Transfer instance will redeem the ticket the client sends before
+    sending or receiving any file, and transfer what the ticket allows
+    :param checksum_cache: ChecksumCache instance that is updated when a file is received
+    :param content_store: ContentStore instance used to deduplicate uploads, None if it's disabled
+    :param scheduler: TransferScheduler instance the transfer waits for a slot of
+    :param committer: Committer instance that puts received files in place
+    :param root: ServedRoot instance the paths of the transfers must still be inside of
     :return: None
     """
-    perform_handshake(client_socket)
+    perform_handshake(client_socket, "transfer")
+    src.METRICS.inc(src.Constants.ACTIVE_CONNECTIONS, label="transfer")
     try:
-        transfer = src.Transfer(client_socket, address, SESSION_TOKEN)
+        transfer = src.Transfer(client_socket, address, tickets, checksum_cache, content_store, scheduler, committer, root)
         transfer.begin()
     except ConnectionResetError:
         pass
+    finally:
+        src.METRICS.dec(src.Constants.ACTIVE_CONNECTIONS, label="transfer")
 
 
-def listen_for_transfers(transfer_socket, transfer_port: int, SESSION_TOKEN: str) -> None:
+def listen_for_transfers(transfer_socket, transfer_port: int, tickets, checksum_cache, content_store,
+                         scheduler, committer, root) -> None:
     """
     Server's listen_for_ever method for file transfers. When a Client is connected, it delegates
     the job to the attend_transfer method
 
     :param transfer_socket: socket object where the server is going to listen for transfers
     :param transfer_port: port number of associated with the given socket.
-    :param SESSION_TOKEN: Server security token. It needs to be passed to the connection handler,
+    :param tickets: TicketTable instance. It needs to be passed to the connection handler,
     in this case, attend_transfer()
+    :param checksum_cache: ChecksumCache instance, also passed to attend_transfer()
+    :param content_store: ContentStore instance or None, also passed to attend_transfer()
+    :param scheduler: TransferScheduler instance, also passed to attend_transfer()
+    :param committer: Committer instance, also passed to attend_transfer()
+    :param root: ServedRoot instance, also passed to attend_transfer()
     :return: None
     """
     print(f"{src.Constants.LISTENING_TRANSFERS} {transfer_port}")
@@ -156,7 +273,8 @@ def listen_for_transfers(transfer_socket, transfer_port: int, SESSION_TOKEN: str
     while True:
         try:
             client_socket, address = transfer_socket.accept()
-            thr = threading.Thread(target=attend_transfer, args=(client_socket, address, SESSION_TOKEN))
+            thr = threading.Thread(target=attend_transfer, args=(client_socket, address, tickets, checksum_cache, content_store,
+                                                                   scheduler, committer, root))
             thr.start()
             del client_socket
         except (ssl.SSLError, OSError, Exception):
@@ -167,22 +285,66 @@ def main() -> None:
     """
     Main server function, it will:
     - create both main and transfers sockets
-    - generate a random security token
+    - create the table of transfer tickets, shared by every process
+    - open the checksum cache shared by all the connections, and create the directory index
+    - open the served root, and the path index of it, which is kept up to date in the background
+    - start writing the logs of every process to the sinks
+    - serve the metrics, if a metrics port was given
     - delegate the transfer's server_for_ever to listen_for_transfers() function
     - act as a listen_for_ever for server's main socket.
+    In async mode, both sockets are served by an AsyncServer event loop instead, and in prefork mode
+    by a PreforkServer pool of AsyncServer workers.
 
     :return: None
     """
-    local_address = socket.gethostbyname(socket.getfqdn() + ".local")
-    main_port, transfer_port = read_ports()
-    SESSION_TOKEN = secrets.token_urlsafe(64)
+    global CHECKSUM_CACHE
+    try:
+        local_address = socket.gethostbyname(socket.getfqdn() + ".local")
+    except socket.gaierror:
+        local_address = socket.gethostbyname(socket.gethostname())
+    options = read_options()
+    main_port, transfer_port = options["port"], options["transfer_port"]
+    src.EVENT_LOG.start(options["log_format"], options["log_file"])
+    tickets = src.TicketTable()
+    CHECKSUM_CACHE = src.ChecksumCache(src.Constants.checksum_cache_path())
+    directory_index = src.DirectoryIndex()
+    root = src.ServedRoot(options["root"])
+    print(f"{src.Constants.SERVING_ROOT} {root.path}")
+    path_index = src.PathIndex(src.Constants.path_index_path(), root.path)
+    threading.Thread(target=refresh_path_index, args=(path_index,), daemon=True).start()
+    threading.Thread(target=expire_partial_files, args=(path_index,), daemon=True).start()
+    content_store_path = src.Constants.content_store_path()
+    committer = src.Committer(options["fsync"])
+    content_store = src.ContentStore(content_store_path, CHECKSUM_CACHE, committer) if content_store_path is not None else None
+    if content_store is not None:
+        threading.Thread(target=content_store.collect, daemon=True).start()
+    scheduler = src.TransferScheduler(options["max_transfers"], options["client_rate"])
+    if options["metrics_port"] is not None:
+        src.serve_metrics(options["metrics_port"])
+        print(f"{src.Constants.METRICS_STARTED} {src.Constants.METRICS_HOST}:{options['metrics_port']}{src.Constants.METRICS_PATH}")
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
     try:
         context.load_cert_chain(os.getenv("PATH_TO_CERT"))
     except ssl.SSLError:
         print(src.Constants.INVALID_CERT_CHAIN)
         exit()
 
+    if options["mode"] == src.Constants.ASYNC_MODE:
+        print(f"{src.Constants.SERVED_STARTED} {local_address}")
+        print(f"{src.Constants.LISTENING_MAIN} {main_port}")
+        server = src.AsyncServer(context, main_port, transfer_port, tickets, CHECKSUM_CACHE, directory_index, path_index,
+                                 content_store, scheduler, committer, root)
+        asyncio.run(server.serve_forever())
+        return
+    elif options["mode"] == src.Constants.PREFORK_MODE:
+        print(f"{src.Constants.SERVED_STARTED} {local_address}")
+        print(f"{src.Constants.LISTENING_MAIN} {main_port}")
+        server = src.PreforkServer(context, main_port, transfer_port, tickets, CHECKSUM_CACHE, directory_index,
+                                   path_index, content_store, scheduler, committer, root, options["workers"])
+        server.serve_forever()
+        return
+
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(('', main_port))
@@ -195,14 +357,17 @@ def main() -> None:
 
     print(f"{src.Constants.SERVED_STARTED} {local_address}")
     print(f"{src.Constants.LISTENING_MAIN} {main_port}")
-    threading.Thread(target=listen_for_transfers, args=(transfer_socket, transfer_port, SESSION_TOKEN), daemon=True).start()
+    threading.Thread(target=listen_for_transfers, args=(transfer_socket, transfer_port, tickets, CHECKSUM_CACHE, content_store,
+                                                                    scheduler, committer, root),
+                     daemon=True).start()
     print('Waiting for connections...')
     server_socket.listen(5)
 
     while True:
         try:
             client_socket, address = server_socket.accept()
-            process = multiprocessing.Process(target=attend_client, args=(client_socket, address, SESSION_TOKEN, transfer_port))
+            process = multiprocessing.Process(target=attend_client, args=(client_socket, address, tickets, transfer_port,
+                                                                          CHECKSUM_CACHE, directory_index, path_index, root))
             process.start()
             PROCESSES_LIST.append(process)
             del client_socket
@@ -0,0 +1,550 @@
+import ssl
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .Connection import Connection
+from .Transfer import Transfer
+from .TransferScheduler import TransferTicket
+from .TransferChannel import TransferChannel
+from .TransferProtocol import TransferAdmission, FileDownload, FileUpload, DeltaUpload, PackDownload, PackUpload, manifest_size
+from .MessageStream import ProtocolError
+from .Metrics import METRICS
+from .EventLog import EVENT_LOG
+from .server_helper import Constants, compressor
+
+
+class StreamSocket:
+    """
+    Minimal socket-like wrapper around an asyncio StreamWriter. Connection only needs send(), and it calls
+    it from the command thread, so the write is handed over to the event loop instead of done directly
+    """
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.__writer = writer
+        self.__loop = loop
+
+    def send(self, data: bytes) -> int:
+        self.__loop.call_soon_threadsafe(self.__writer.write, data)
+        return len(data)
+
+    def sendall(self, data: bytes) -> None:
+        self.send(data)
+
+
+class AsyncServer:
+    """
+    Class representing the asyncio flavour of the server. A single event loop accepts both main and transfer
+    connections, performs the TLS handshakes and serves the Connection command protocol and the Transfer
+    streams as coroutines, instead of forking a process per client and starting a thread per transfer.
+
+    Commands run in a pool of COMMAND_THREADS threads, since they touch the disk. Each session keeps its own
+    working directory (see WorkingDirectory), so commands of different sessions can run at the same time, while
+    the commands of a session still run one after the other. Reading and writing the connections happens in the
+    event loop, and transfers speak the same protocol as the threaded Transfer (see TransferProtocol), whose
+    steps that touch the disk run in a thread.
+
+    With reuse_port, both listeners are opened with SO_REUSEPORT, so several processes (see PreforkServer)
+    can each own a listener on the same ports and let the kernel spread the connections between them.
+
+    Connections are accepted as plain TCP and upgraded to TLS by their handler, so the handshake can be timed
+    for the metrics, where asyncio supports it (Python 3.11+). Older versions let the listeners do it.
+    """
+    def __init__(self, context, main_port: int, transfer_port: int, tickets, checksum_cache, directory_index,
+                 path_index, content_store, scheduler, committer, root, reuse_port: bool = False):
+        self.__context = context
+        self.__main_port = main_port
+        self.__transfer_port = transfer_port
+        self.__tickets = tickets
+        self.__checksum_cache = checksum_cache
+        self.__directory_index = directory_index
+        self.__path_index = path_index
+        self.__content_store = content_store
+        self.__scheduler = scheduler
+        self.__committer = committer
+        self.__root = root
+        self.__reuse_port = reuse_port
+        self.__upgrade_tls = hasattr(asyncio.StreamWriter, "start_tls")
+        self.__command_executor = ThreadPoolExecutor(max_workers=Constants.COMMAND_THREADS, thread_name_prefix="commands")
+        self.__servers = []
+        self.__active_tasks = set()
+
+    async def start(self) -> None:
+        """
+        Opens both listeners and starts accepting connections in the running event loop
+
+        :return: None
+        """
+        tls = {} if self.__upgrade_tls else {"ssl": self.__context, "ssl_handshake_timeout": Constants.HANDSHAKE_TIMEOUT_SECONDS}
+        for handler, port in ((self.attend_client, self.__main_port), (self.attend_transfer, self.__transfer_port)):
+            server = await asyncio.start_server(handler, port=port, reuse_address=True, reuse_port=self.__reuse_port or None,
+                                                backlog=Constants.ASYNC_BACKLOG, **tls)
+            self.__servers.append(server)
+
+    async def handshake(self, writer: asyncio.StreamWriter, port: str) -> bool:
+        """
+        Coroutine equivalent of server.perform_handshake(). It upgrades an accepted connection to TLS and
+        records how long it took. Nothing is done if the listener did the handshake already
+
+        :param writer: StreamWriter of the accepted connection
+        :param port: "main" or "transfer", the port where the connection was accepted
+        :return: False if the handshake failed and the connection was closed
+        """
+        if not self.__upgrade_tls:
+            return True
+        started = time.perf_counter()
+        try:
+            await writer.start_tls(self.__context, ssl_handshake_timeout=Constants.HANDSHAKE_TIMEOUT_SECONDS)
+        except (ssl.SSLError, OSError, asyncio.TimeoutError):
+            writer.close()
+            return False
+        METRICS.observe(Constants.HANDSHAKE_DURATION, time.perf_counter() - started, port)
+        return True
+
+    async def serve_forever(self) -> None:
+        """
+        Starts listening in both ports and serves connections until the process is stopped
+
+        :return: None
+        """
+        await self.start()
+        print(f"{Constants.LISTENING_TRANSFERS} {self.__transfer_port}")
+        print('Waiting for connections...')
+        await asyncio.gather(*(server.serve_forever() for server in self.__servers))
+
+    async def shutdown(self, timeout: float) -> None:
+        """
+        Stops accepting connections and waits up to timeout seconds for the active sessions and transfers
+        to finish. The ones still running after that are cancelled when the event loop is closed
+
+        :param timeout: maximum number of seconds to wait
+        :return: None
+        """
+        for server in self.__servers:
+            server.close()
+        if self.__active_tasks:
+            await asyncio.wait(self.__active_tasks, timeout=timeout)
+
+    async def attend_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Coroutine equivalent of server.attend_client(). It creates a Connection instance that answers through
+        the event loop, reads the client's data and hands it to Connection.feed()
+
+        :param reader: StreamReader of the accepted connection
+        :param writer: StreamWriter of the accepted connection
+        :return: None
+        """
+        address = writer.get_extra_info("peername")
+        if not await self.handshake(writer, "main"):
+            return
+        METRICS.inc(Constants.ACTIVE_CONNECTIONS, label="main")
+        self.__active_tasks.add(asyncio.current_task())
+        stream_socket = StreamSocket(writer, asyncio.get_running_loop())
+        connection = None
+        try:
+            connection = Connection(stream_socket, address, self.__tickets, self.__transfer_port, self.__checksum_cache,
+                                    self.__directory_index, self.__path_index, self.__root)
+            EVENT_LOG.event("connected", f"Got a connection from {address}", "GREEN", client=address, session=connection.session_id)
+            while True:
+                client_data = await reader.read(Constants.STREAM_BUFFER_SIZE)
+                if not client_data:
+                    break
+                await asyncio.get_running_loop().run_in_executor(self.__command_executor, connection.feed, client_data)
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError, ProtocolError):
+            pass
+        finally:
+            writer.close()
+            self.__active_tasks.discard(asyncio.current_task())
+            METRICS.dec(Constants.ACTIVE_CONNECTIONS, label="main")
+        if connection is not None:
+            EVENT_LOG.event("disconnected", f"Client {address} disconnected", "RED", client=address, session=connection.session_id)
+
+    async def attend_transfer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Coroutine equivalent of Transfer.begin(). It redeems the ticket of the request and, if valid, waits for a
+        slot of the scheduler and sends or receives the file depending on what the ticket allows
+
+        :param reader: StreamReader of the accepted connection
+        :param writer: StreamWriter of the accepted connection
+        :return: None
+        """
+        address = writer.get_extra_info("peername")
+        if not await self.handshake(writer, "transfer"):
+            return
+        METRICS.inc(Constants.ACTIVE_CONNECTIONS, label="transfer")
+        self.__active_tasks.add(asyncio.current_task())
+        try:
+            transfer_datagram = await asyncio.wait_for(reader.read(Constants.BUFFER_SIZE), Constants.TRANSFERS_TIMEOUT_SECONDS)
+            transfer_request = json.loads(transfer_datagram.decode())
+            if transfer_request.get("operation") == "channel":
+                if not self.__tickets.check(transfer_request.get("token")):
+                    self.reject(writer, transfer_request, address)
+                    return
+                await self.serve_channel(reader, writer, address)
+                return
+            ticket_fields = self.__tickets.redeem(transfer_request.get("token"))
+            if ticket_fields is None:
+                self.reject(writer, transfer_request, address)
+                return
+            transfer_request.update(ticket_fields)
+            if not self.__root.encloses(transfer_request["absolute_path"]):
+                self.reject(writer, transfer_request, address, Constants.OUTSIDE_ROOT)
+                return
+            ticket = await self.wait_for_slot(writer, transfer_request, address)
+            if ticket is None:
+                return
+            started = time.perf_counter()
+            try:
+                if transfer_request["operation"] == "get":
+                    await self.send_file(writer, transfer_request, address, ticket)
+                elif transfer_request["operation"] == "put":
+                    await self.receive_file(reader, writer, transfer_request, address, ticket)
+                elif transfer_request["operation"] == "delta":
+                    await self.receive_delta(reader, writer, transfer_request, address, ticket)
+                elif transfer_request["operation"] == "get_tree":
+                    await self.send_pack(reader, writer, transfer_request, address, ticket)
+                elif transfer_request["operation"] == "put_tree":
+                    await self.receive_pack(reader, writer, transfer_request, address, ticket)
+            finally:
+                self.__scheduler.release(ticket)
+                METRICS.observe(Constants.TRANSFER_DURATION, time.perf_counter() - started, transfer_request["operation"])
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, json.decoder.JSONDecodeError, ValueError, AttributeError,
+                KeyError, OSError):
+            pass
+        finally:
+            writer.close()
+            self.__active_tasks.discard(asyncio.current_task())
+            METRICS.dec(Constants.ACTIVE_CONNECTIONS, label="transfer")
+
+    @staticmethod
+    def reject(writer: asyncio.StreamWriter, transfer_request: dict, address,
+               reason: str = Constants.INVALID_TICKET) -> None:
+        """
+        Equivalent of Transfer.reject(), the connection is closed by attend_transfer(), which flushes the flag
+        """
+        EVENT_LOG.event("rejected", f"REJECTED transfer from {address}, {reason}", "RED", logging.WARNING, client=address,
+                        reason=reason)
+        if transfer_request.get("queue"):
+            writer.write(Constants.REJECTED_FLAG)
+
+    async def wait_for_slot(self, writer: asyncio.StreamWriter, transfer_request: dict, address):
+        """
+        Coroutine equivalent of Transfer.wait_for_slot()
+
+        :param writer: StreamWriter of the transfer connection
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :param address: client's address, for logging purposes
+        :return: the TransferTicket of the admitted transfer, or None if it was given up on
+        """
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def on_admit() -> None:
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(None))
+
+        admission = TransferAdmission(self.__scheduler, address, transfer_request, on_admit)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(admitted), Constants.TRANSFER_QUEUE_NOTICE_SECONDS)
+                    break
+                except asyncio.TimeoutError:
+                    writer.write(admission.notice())
+                    await writer.drain()
+            writer.write(admission.admit())
+            await writer.drain()
+        except (OSError, asyncio.CancelledError) as error:  # TimeoutError too
+            admission.give_up()
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            return None
+        return admission.ticket
+
+    @staticmethod
+    async def receive_chunk(reader: asyncio.StreamReader, ticket: TransferTicket, size: int, operation: str) -> bytes:
+        """
+        Coroutine equivalent of Transfer.receive_chunk(), operation is the label of the bytes in the metrics
+        """
+        data = await asyncio.wait_for(reader.read(ticket.limit(size)), Constants.TRANSFERS_TIMEOUT_SECONDS)
+        METRICS.inc(Constants.BYTES_RECEIVED, len(data), operation)
+        ticket.received += len(data)
+        delay = ticket.delay(len(data))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return data
+
+    @staticmethod
+    async def receive_into(reader: asyncio.StreamReader, ticket: TransferTicket, buffer: memoryview, operation: str) -> int:
+        """
+        Coroutine equivalent of Transfer.receive_into(). StreamReader can't read into a buffer, so what it gives is
+        copied into buffer, which is reused for every chunk, like the threaded Transfer does
+
+        :param reader: StreamReader of the transfer connection
+        :param ticket: TransferTicket of the transfer
+        :param buffer: writable memoryview, the maximum amount of bytes to receive is its size
+        :param operation: label of the bytes in the metrics
+        :return: number of bytes received, 0 once the client closed the connection
+        """
+        data = await AsyncServer.receive_chunk(reader, ticket, len(buffer), operation)
+        buffer[:len(data)] = data
+        return len(data)
+
+    @staticmethod
+    async def send_chunk(writer: asyncio.StreamWriter, ticket: TransferTicket, data, operation: str) -> None:
+        """
+        Coroutine equivalent of Transfer.send_chunk(), operation is the label of the bytes in the metrics
+        """
+        view = memoryview(data)
+        while view:
+            size = ticket.limit(len(view))
+            delay = ticket.delay(size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            writer.write(bytes(view[:size]))
+            await writer.drain()
+            METRICS.inc(Constants.BYTES_SENT, size, operation)
+            ticket.sent += size
+            view = view[size:]
+
+    async def send_file(self, writer: asyncio.StreamWriter, transfer_request: dict, address, ticket: TransferTicket) -> None:
+        """
+        Sends the requested file (see FileDownload) with loop.sendfile(). TLS transports can't use os.sendfile(),
+        so asyncio falls back to reading the file in a thread and writing it with flow control. If the request
+        has a "codec", chunks are read and compressed in a thread and written with flow control instead. Rate
+        limited clients get the file in the chunks their ticket allows, a loop.sendfile() call per chunk
+
+        :param writer: StreamWriter of the transfer connection
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :param address: client's address, for logging purposes
+        :param ticket: TransferTicket of the transfer
+        :return: None
+        """
+        download = FileDownload(transfer_request, address, ticket)
+        offset, length = download.offset, download.length
+        loop = asyncio.get_running_loop()
+        with open(download.path, "rb") as file:
+            if download.compression is None and not ticket.limited:
+                sent = await loop.sendfile(writer.transport, file, offset, length)
+                METRICS.inc(Constants.BYTES_SENT, sent, "get")
+                ticket.sent += sent
+                download.finish(sent, sent, "asyncio")
+                return
+            if download.compression is None:
+                sent = 0
+                while length is None or sent < length:
+                    size = ticket.limit(Constants.SEND_BUFFER_SIZE if length is None else min(Constants.SEND_BUFFER_SIZE, length - sent))
+                    delay = ticket.delay(size)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    count = await loop.sendfile(writer.transport, file, offset + sent, size)
+                    if not count:
+                        break
+                    sent += count
+                    METRICS.inc(Constants.BYTES_SENT, count, "get")
+                    ticket.sent += count
+                download.finish(sent, sent, "asyncio, rate limited")
+                return
+
+            engine = compressor(*download.compression)
+            file.seek(offset)
+            sent = wire_bytes = 0
+            while length is None or sent < length:
+                size = ticket.limit(Constants.SEND_BUFFER_SIZE if length is None else min(Constants.SEND_BUFFER_SIZE, length - sent))
+                bytes_read, data = await loop.run_in_executor(None, self.__read_compressed, file, engine, size)
+                if not bytes_read:
+                    break
+                delay = ticket.delay(bytes_read)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                sent += bytes_read
+                wire_bytes += len(data)
+                writer.write(data)
+                await writer.drain()
+                METRICS.inc(Constants.BYTES_SENT, len(data), "get")
+                ticket.sent += len(data)
+            data = engine.flush()
+            wire_bytes += len(data)
+            writer.write(data)
+            await writer.drain()
+            METRICS.inc(Constants.BYTES_SENT, len(data), "get")
+            ticket.sent += len(data)
+        download.finish(sent, wire_bytes, f"asyncio, {download.compression[0]}")
+
+    @staticmethod
+    def __read_compressed(file, engine, size: int) -> tuple:
+        data = file.read(size)
+        return len(data), engine.compress(data)
+
+    async def receive_file(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, transfer_request: dict, address,
+                           ticket: TransferTicket) -> None:
+        """
+        Coroutine equivalent of Transfer.receive_file(). Everything that touches the disk (the content store, the
+        partial file, which hashes what it writes, and the commit) runs in a thread
+
+        :param reader: StreamReader of the transfer connection
+        :param writer: StreamWriter of the transfer connection
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :param address: client's address, for logging purposes
+        :param ticket: TransferTicket of the transfer
+        :return: None
+        """
+        upload = FileUpload(transfer_request, address, ticket, self.__checksum_cache, self.__content_store, self.__committer)
+        if not upload.prepare():
+            return
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, upload.deduplicate):
+            writer.write(Constants.DEDUP_FLAG)
+            await writer.drain()
+            return
+        if not await loop.run_in_executor(None, upload.open):
+            return
+
+        buffer = memoryview(bytearray(Constants.receive_buffer_size()))
+        try:
+            writer.write(Constants.READY_FLAG)
+            await writer.drain()
+            while True:
+                size = await self.receive_into(reader, ticket, buffer, "put")
+                if not size or not await loop.run_in_executor(None, upload.feed, buffer[:size]):
+                    break
+        except (asyncio.TimeoutError, OSError):
+            pass
+        await loop.run_in_executor(None, upload.finish)
+
+    async def receive_delta(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, transfer_request: dict, address,
+                            ticket: TransferTicket) -> None:
+        """
+        Coroutine equivalent of Transfer.receive_delta(). The signature is calculated in a thread, since it reads
+        the whole file, and so is the delta applied
+
+        :param reader: StreamReader of the transfer connection
+        :param writer: StreamWriter of the transfer connection
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :param address: client's address, for logging purposes
+        :param ticket: TransferTicket of the transfer
+        :return: None
+        """
+        delta = DeltaUpload(transfer_request, address, ticket, self.__checksum_cache, self.__content_store, self.__committer)
+        if not delta.prepare():
+            return
+        loop = asyncio.get_running_loop()
+        signature = await loop.run_in_executor(None, delta.signature)
+        writer.write(signature)
+        await writer.drain()
+        METRICS.inc(Constants.BYTES_SENT, len(signature), "delta")
+        ticket.sent += len(signature)
+        await loop.run_in_executor(None, delta.open)
+        buffer = memoryview(bytearray(Constants.receive_buffer_size()))
+        try:
+            while True:
+                size = await self.receive_into(reader, ticket, buffer, "delta")
+                if not size or await loop.run_in_executor(None, delta.feed, buffer[:size]):
+                    break
+        except (asyncio.TimeoutError, OSError):
+            pass
+        await loop.run_in_executor(None, delta.finish)
+
+    @staticmethod
+    async def receive_manifest(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, transfer_request: dict) -> bytes:
+        """
+        Coroutine equivalent of Transfer.receive_manifest()
+
+        :return: the json-formatted manifest
+        :raises ValueError: if the manifest size isn't valid
+        """
+        size = manifest_size(transfer_request)
+        writer.write(Constants.READY_FLAG)
+        await writer.drain()
+        return await asyncio.wait_for(reader.readexactly(size), Constants.TRANSFERS_TIMEOUT_SECONDS)
+
+    async def send_pack(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, transfer_request: dict, address,
+                        ticket: TransferTicket) -> None:
+        """
+        Coroutine equivalent of Transfer.send_pack(). Files are opened and read in a thread, a chunk at a time
+
+        :param reader: StreamReader of the transfer connection
+        :param writer: StreamWriter of the transfer connection
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :param address: client's address, for logging purposes
+        :param ticket: TransferTicket of the transfer
+        :return: None
+        """
+        pack = PackDownload(transfer_request, address, ticket)
+        pack.start(await self.receive_manifest(reader, writer, transfer_request))
+        chunks = pack.chunks()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                await self.send_chunk(writer, ticket, chunk, "get_tree")
+        except OSError:
+            pass
+        pack.finish("asyncio")
+
+    async def receive_pack(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, transfer_request: dict, address,
+                           ticket: TransferTicket) -> None:
+        """
+        Coroutine equivalent of Transfer.receive_pack(). The files are written, and put in place, in a thread
+
+        :param reader: StreamReader of the transfer connection
+        :param writer: StreamWriter of the transfer connection
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :param address: client's address, for logging purposes
+        :param ticket: TransferTicket of the transfer
+        :return: None
+        """
+        pack = PackUpload(transfer_request, address, ticket, self.__committer)
+        manifest = await self.receive_manifest(reader, writer, transfer_request)
+        loop = asyncio.get_running_loop()
+        writer.write(await loop.run_in_executor(None, pack.start, manifest))
+        buffer = memoryview(bytearray(Constants.receive_buffer_size()))
+        try:
+            while not pack.finished:
+                size = await self.receive_into(reader, ticket, buffer, "put_tree")
+                if not size or await loop.run_in_executor(None, pack.feed, buffer[:size]):
+                    break
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            summary = await loop.run_in_executor(None, pack.finish, "asyncio")
+        if summary:
+            writer.write(summary)
+            await writer.drain()
+
+    async def serve_channel(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address) -> None:
+        """
+        Coroutine equivalent of Transfer.serve_channel(). Frames are read in the event loop and handed to the
+        TransferChannel in a thread, since it can block while a stream is busy. Streams are served by a
+        threaded Transfer each, whose writes are passed back to the event loop and wait for the drain
+
+        :param reader: StreamReader of the transfer connection
+        :param writer: StreamWriter of the transfer connection
+        :param address: client's address, for logging purposes
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        lock = asyncio.Lock()
+
+        async def write(frame: bytes) -> None:
+            async with lock:
+                writer.write(frame)
+                await writer.drain()
+
+        channel = TransferChannel(lambda frame: asyncio.run_coroutine_threadsafe(write(frame), loop).result(),
+                                  lambda stream: Transfer(stream, address, self.__tickets, self.__checksum_cache,
+                                                                  self.__content_store, self.__scheduler, self.__committer,
+                                                                  self.__root).begin())
+        await write(Constants.READY_FLAG)
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.read(Constants.STREAM_BUFFER_SIZE), Constants.CHANNEL_IDLE_TIMEOUT_SECONDS)
+                if not data:
+                    break
+                await loop.run_in_executor(None, channel.feed, data)
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            await loop.run_in_executor(None, channel.shutdown)
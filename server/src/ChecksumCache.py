@@ -0,0 +1,265 @@
+import os
+import time
+import json
+import sqlite3
+import threading
+from collections import OrderedDict, Counter
+from .server_helper import Constants, calculate_checksum, calculate_block_checksums
+from .Metrics import METRICS
+
+
+class ChecksumCache:
+    """
+    Class representing a persistent cache of sha256 checksums of the files served. Entries are keyed by
+    (device, inode) and are only valid while the file keeps the same size and modification time, so an
+    unchanged file answers instantly and a modified one is hashed again. Besides the whole-file checksum,
+    an entry can also hold the checksums of the file blocks, used by range downloads.
+
+    The cache lives in a sqlite database, shared by every process of the server, with a small in-memory
+    LRU in front of it. When the database holds more than max_entries files, the least recently used
+    ones are evicted. Hits and misses are counted per process, and written to the database every
+    CHECKSUM_CACHE_FLUSH_SECONDS (see flush()) together with the time each entry was last used, so a hit
+    doesn't write to it. The time spent hashing on misses is recorded in the metrics.
+    """
+    def __init__(self, database_path: str, max_entries: int = Constants.CHECKSUM_CACHE_MAX_ENTRIES,
+                 memory_entries: int = Constants.CHECKSUM_CACHE_MEMORY_ENTRIES):
+        self.__database_path = database_path
+        self.__max_entries = max_entries
+        self.__memory_entries = memory_entries
+        self.__memory = OrderedDict()
+        self.__memory_lock = threading.Lock()
+        self.__local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.__pending = Counter()
+        self.__used = {}
+        self.__pending_pid = os.getpid()
+        self.__flushed = time.monotonic()
+        self.__count_lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+        with self.__connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS checksums (device INTEGER, inode INTEGER, size INTEGER, "
+                               "mtime_ns INTEGER, sha256sum TEXT, last_used REAL, PRIMARY KEY (device, inode))")
+            connection.execute("CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)")
+            connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            connection.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(checksums)")]
+            if "block_digests" not in columns:
+                connection.execute("ALTER TABLE checksums ADD COLUMN block_size INTEGER")
+                connection.execute("ALTER TABLE checksums ADD COLUMN block_digests TEXT")
+
+    def __connection(self) -> sqlite3.Connection:
+        """
+        sqlite connections can't be shared between threads nor survive a fork, so each thread of each
+        process opens its own one the first time it needs it
+        """
+        if getattr(self.__local, "pid", None) != os.getpid():
+            self.__local.connection = sqlite3.connect(self.__database_path, timeout=Constants.CHECKSUM_CACHE_TIMEOUT_SECONDS)
+            self.__local.connection.execute("PRAGMA journal_mode=WAL")
+            self.__local.pid = os.getpid()
+        return self.__local.connection
+
+    @staticmethod
+    def file_key(stat_result: os.stat_result) -> tuple:
+        return stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+    def checksum(self, filepath: str) -> str:
+        """
+        Returns the sha256 checksum of the given file, from the cache if the file didn't change since it
+        was hashed, or calculating it (and storing it) otherwise
+
+        :param filepath: path to the file
+        :return: hex digest of the file
+        """
+        key = self.file_key(os.stat(filepath))
+        entry = self.lookup(key)
+        if entry is not None:
+            self.__count("hits")
+            return entry[0]
+
+        self.__count("misses")
+        with METRICS.timer(Constants.CHECKSUM_DURATION, "file"):
+            sha256sum = calculate_checksum(filepath)
+        if self.file_key(os.stat(filepath)) == key:
+            self.store(key, sha256sum)
+        return sha256sum
+
+    def block_checksums(self, filepath: str, block_size: int = Constants.TRANSFER_BLOCK_SIZE) -> tuple:
+        """
+        Returns the sha256 checksum of the given file and the checksums of its blocks. If only the whole-file
+        checksum is cached, the file is read once to calculate both
+
+        :param filepath: path to the file
+        :param block_size: size of the blocks in bytes
+        :return: a tuple with the hex digest of the file and the list of hex digests of its blocks
+        """
+        key = self.file_key(os.stat(filepath))
+        entry = self.lookup(key)
+        if entry is not None and entry[1] == block_size:
+            self.__count("hits")
+            return entry[0], entry[2]
+
+        self.__count("misses")
+        with METRICS.timer(Constants.CHECKSUM_DURATION, "blocks"):
+            sha256sum, block_digests = calculate_block_checksums(filepath, block_size)
+        if self.file_key(os.stat(filepath)) == key:
+            self.store(key, sha256sum, block_size, block_digests)
+        return sha256sum, block_digests
+
+    def lookup(self, key: tuple):
+        """
+        :param key: tuple (device, inode, size, mtime_ns) as returned by file_key()
+        :return: the cached entry, a tuple (hex digest, block size, block digests) where the last two are None
+        if block checksums weren't calculated, or None if there's no valid entry for the key
+        """
+        with self.__memory_lock:
+            entry = self.__memory.get(key)
+            if entry is not None:
+                self.__memory.move_to_end(key)
+        if entry is not None:
+            self.__touch(key)
+            return entry
+
+        device, inode, size, mtime_ns = key
+        try:
+            with self.__connection() as connection:
+                row = connection.execute("SELECT sha256sum, block_size, block_digests FROM checksums WHERE device = ? "
+                                         "AND inode = ? AND size = ? AND mtime_ns = ?", (device, inode, size, mtime_ns)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+
+        entry = (row[0], row[1], json.loads(row[2]) if row[2] else None)
+        self.__remember(key, entry)
+        self.__touch(key)
+        return entry
+
+    def store(self, key: tuple, sha256sum: str, block_size: int = None, block_digests: list = None) -> None:
+        """
+        Stores the checksum of a file, replacing any previous entry for the same inode and evicting the
+        least recently used entries if the cache is full
+
+        :param key: tuple (device, inode, size, mtime_ns) as returned by file_key()
+        :param sha256sum: hex digest of the file
+        :param block_size: size of the blocks, if block checksums were calculated
+        :param block_digests: list of hex digests of the file blocks, if they were calculated
+        :return: None
+        """
+        self.__remember(key, (sha256sum, block_size, block_digests))
+        try:
+            with self.__connection() as connection:
+                connection.execute("INSERT OR REPLACE INTO checksums (device, inode, size, mtime_ns, sha256sum, last_used, "
+                                   "block_size, block_digests) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   key + (sha256sum, time.time(), block_size, json.dumps(block_digests) if block_digests is not None else None))
+                connection.execute("DELETE FROM checksums WHERE rowid IN (SELECT rowid FROM checksums ORDER BY "
+                                   "last_used DESC LIMIT -1 OFFSET ?)", (self.__max_entries,))
+        except sqlite3.Error:
+            pass
+
+    def store_file(self, filepath: str, sha256sum: str, block_size: int = None, block_digests: list = None) -> None:
+        """
+        Stores the checksum of a file that was just written, so the first get doesn't need to hash it
+
+        :param filepath: path to the file
+        :param sha256sum: hex digest of the file
+        :param block_size: size of the blocks, if block checksums were calculated while writing it
+        :param block_digests: list of hex digests of the file blocks, if they were calculated
+        :return: None
+        """
+        self.store(self.file_key(os.stat(filepath)), sha256sum, block_size, block_digests)
+
+    def invalidate(self, filepath: str) -> None:
+        """
+        Drops any entry for the inode currently at filepath. Called when a file is going to be written
+
+        :param filepath: path to the file
+        :return: None
+        """
+        try:
+            stat_result = os.stat(filepath)
+        except FileNotFoundError:
+            return
+
+        with self.__memory_lock:
+            for key in [key for key in self.__memory if key[:2] == (stat_result.st_dev, stat_result.st_ino)]:
+                del self.__memory[key]
+        try:
+            with self.__connection() as connection:
+                connection.execute("DELETE FROM checksums WHERE device = ? AND inode = ?", (stat_result.st_dev, stat_result.st_ino))
+        except sqlite3.Error:
+            pass
+
+    def stats(self) -> dict:
+        """
+        :return: dictionary with this process hits and misses, the totals across all the server's
+        processes (as of their last flush, this one's included) and the number of files currently cached
+        """
+        self.flush()
+        stats = {"hits": self.hits, "misses": self.misses, "total_hits": None, "total_misses": None, "entries": None}
+        try:
+            with self.__connection() as connection:
+                counters = dict(connection.execute("SELECT name, value FROM counters").fetchall())
+                stats["total_hits"], stats["total_misses"] = counters["hits"], counters["misses"]
+                stats["entries"] = connection.execute("SELECT COUNT(*) FROM checksums").fetchone()[0]
+        except sqlite3.Error:
+            pass
+        return stats
+
+    def __remember(self, key: tuple, entry: tuple) -> None:
+        with self.__memory_lock:
+            self.__memory[key] = entry
+            self.__memory.move_to_end(key)
+            while len(self.__memory) > self.__memory_entries:
+                self.__memory.popitem(last=False)
+
+    def flush(self) -> None:
+        """
+        Adds the hits and misses this process counted since the last flush to the totals in the database, and
+        updates the last time the entries it used were used. If it isn't available, they're kept for the next one
+
+        :return: None
+        """
+        with self.__count_lock:
+            self.__check_process()
+            pending, self.__pending = self.__pending, Counter()
+            used, self.__used = self.__used, {}
+            self.__flushed = time.monotonic()
+        if not pending and not used:
+            return
+        try:
+            with self.__connection() as connection:
+                connection.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                       [(value, counter) for counter, value in pending.items()])
+                connection.executemany("UPDATE checksums SET last_used = ? WHERE device = ? AND inode = ?",
+                                       [(last_used, device, inode) for (device, inode), last_used in used.items()])
+        except sqlite3.Error:
+            with self.__count_lock:
+                self.__pending.update(pending)
+                self.__used = {**used, **self.__used}
+
+    def __check_process(self) -> None:
+        """
+        The counts and uses of a process that forks are copied to the child, but they're the parent's to flush,
+        so the child starts without them. Must be called with the count lock held
+        """
+        if self.__pending_pid != os.getpid():
+            self.__pending, self.__used, self.__pending_pid = Counter(), {}, os.getpid()
+
+    def __touch(self, key: tuple) -> None:
+        """
+        Records that the entry of key was used now, for the next flush()
+        """
+        with self.__count_lock:
+            self.__check_process()
+            self.__used[key[:2]] = time.time()
+
+    def __count(self, counter: str) -> None:
+        with self.__count_lock:
+            self.__check_process()
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.__pending[counter] += 1
+            flush = time.monotonic() - self.__flushed >= Constants.CHECKSUM_CACHE_FLUSH_SECONDS
+        if flush:
+            self.flush()
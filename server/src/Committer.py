@@ -0,0 +1,188 @@
+import os
+import time
+import ctypes
+import threading
+from .server_helper import Constants
+from .Metrics import METRICS
+
+
+def load_syncfs():
+    """
+    :return: the syncfs() function of the C library, which flushes a whole file system with a single call, or
+    None where there isn't one (it's Linux only)
+    """
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+
+SYNCFS = load_syncfs()
+
+
+class Committer:
+    """
+    Class representing how received files are put in place. Every upload is written to a temporary file in
+    the directory of its final path (a .part file, a .delta file...) and, once it's complete and verified,
+    renamed over its final path, so nobody ever sees it half written. The policy says what is done so the
+    rename survives a crash:
+    - none: nothing, the file is just renamed. The fastest, but after a power loss an upload that was reported
+    as received can be missing, or be there with missing data
+    - commit: the file is flushed to disk before it's renamed, and its directory after it, so an upload is only
+    reported as received once it's durable. Each upload waits for its flushes
+    - group: like commit, but uploads that commit at the same time are flushed together (group commit). A commit that
+    arrives while a flush is running waits for it to end, and then everything that queued in the meantime is
+    flushed together: an fsync() per file, and one per directory, however many files of the group it holds
+    - syncfs: like group, but the group is flushed with two syncfs() calls per file system (Linux only, elsewhere
+    it's the same as group). They flush every dirty file of the file system, not only the uploaded ones, so it's
+    only worth it on a file system where little else is written
+
+    Renames of a batch (see commit_all(), used by directory uploads) are flushed together with every policy
+    but none. It's safe to use from several threads
+    """
+    def __init__(self, policy: str = Constants.FSYNC_NONE):
+        self.policy = policy
+        self.__condition = threading.Condition()
+        self.__queue = []
+        self.__flushing = False
+
+    @property
+    def syncs(self) -> bool:
+        return self.policy != Constants.FSYNC_NONE
+
+    def commit(self, temporary_path: str, path: str) -> None:
+        """
+        Renames temporary_path over path, as durably as the policy says
+
+        :raises OSError: if the file couldn't be flushed or renamed
+        """
+        error = self.commit_all([(temporary_path, path)])[0]
+        if error is not None:
+            raise error
+
+    def commit_all(self, renames: list) -> list:
+        """
+        Renames several files, flushing them together
+
+        :param renames: list of tuples with a temporary path and the final path it's renamed to
+        :return: list with None for each file renamed, or the OSError that kept it from being renamed (or flushed)
+        """
+        started = time.perf_counter()
+        if self.policy == Constants.FSYNC_NONE:
+            errors = [self.replace(temporary_path, path) for temporary_path, path in renames]
+        elif self.policy in (Constants.FSYNC_GROUP, Constants.FSYNC_SYNCFS):
+            errors = self.__group_commit(renames)
+        else:
+            errors = self.flush(renames)
+        METRICS.observe(Constants.COMMIT_DURATION, time.perf_counter() - started)
+        return errors
+
+    def flush(self, renames: list) -> list:
+        """
+        Flushes the temporary files, renames them and flushes their directories, each directory once. A file that
+        can't be flushed isn't renamed
+
+        :param renames: list of tuples with a temporary path and the final path it's renamed to
+        :return: list with None or the OSError of each file, see commit_all()
+        """
+        METRICS.observe(Constants.COMMIT_BATCH_FILES, len(renames))
+        use_syncfs = self.policy == Constants.FSYNC_SYNCFS
+        errors = self.sync([temporary_path for temporary_path, _ in renames], use_syncfs)
+        errors = [error or self.replace(temporary_path, path) for (temporary_path, path), error in zip(renames, errors)]
+        directories = {}
+        for index, error in enumerate(errors):
+            if error is None:
+                directories.setdefault(os.path.dirname(os.path.abspath(renames[index][1])), []).append(index)
+        for indexes, error in zip(directories.values(), self.sync(list(directories), use_syncfs)):
+            for index in indexes:
+                errors[index] = error
+        return errors
+
+    @classmethod
+    def sync(cls, paths: list, use_syncfs: bool = False) -> list:
+        """
+        Flushes files or directories to disk, each one with fsync()
+
+        :param use_syncfs: flush several paths with a syncfs() per file system instead, when it's available. It
+        costs about the same as one fsync(), but flushes everything else written to the file system too
+        :return: list with None for each path flushed, or the OSError that kept it from being flushed
+        """
+        errors = [None] * len(paths)
+        if not use_syncfs or len(paths) <= 1 or SYNCFS is None:
+            return [cls.__sync(path, os.fsync) for path in paths]
+        devices = {}
+        for index, path in enumerate(paths):
+            try:
+                devices.setdefault(os.stat(path).st_dev, []).append(index)
+            except OSError as error:
+                errors[index] = error
+        for indexes in devices.values():
+            error = cls.__sync(paths[indexes[0]], cls.__syncfs)
+            for index in indexes:
+                errors[index] = error
+        return errors
+
+    @staticmethod
+    def replace(temporary_path: str, path: str):
+        """
+        :return: None if temporary_path was renamed to path, the OSError otherwise
+        """
+        try:
+            os.replace(temporary_path, path)
+            return None
+        except OSError as error:
+            return error
+
+    @staticmethod
+    def __sync(path: str, flush):
+        """
+        :param flush: function flushing a file descriptor, os.fsync or __syncfs
+        :return: None if path was flushed, the OSError otherwise
+        """
+        try:
+            descriptor = os.open(path, os.O_RDONLY)
+        except OSError as error:
+            return error
+        try:
+            flush(descriptor)
+            return None
+        except OSError as error:
+            return error
+        finally:
+            os.close(descriptor)
+
+    @staticmethod
+    def __syncfs(descriptor: int) -> None:
+        if SYNCFS(descriptor) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def __group_commit(self, renames: list) -> list:
+        """
+        Queues renames for the next flush. If no flush is running, this thread runs it right away, for everything
+        queued, otherwise it waits until one of the following flushes includes its renames
+        """
+        entry = {"renames": renames, "errors": None}
+        with self.__condition:
+            self.__queue.append(entry)
+            while entry["errors"] is None and self.__flushing:
+                self.__condition.wait()
+            if entry["errors"] is not None:
+                return entry["errors"]
+            self.__flushing = True
+            batch, self.__queue = self.__queue, []
+
+        errors = None
+        try:
+            errors = self.flush([rename for queued in batch for rename in queued["renames"]])
+        finally:
+            with self.__condition:
+                position = 0
+                for queued in batch:
+                    count = len(queued["renames"])
+                    queued["errors"] = errors[position:position + count] if errors is not None else \
+                        [OSError(Constants.COMMIT_FAILED)] * count
+                    position += count
+                self.__flushing = False
+                self.__condition.notify_all()
+        return entry["errors"]
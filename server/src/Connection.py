@@ -1,25 +1,46 @@
 import os
 import json
-from .server_helper import Constants, calculate_checksum
+import time
+import logging
+import secrets
+from .server_helper import Constants, blocks_checksum, transfer_codec, is_compressible, walk_tree
+from .PartialFile import PartialFile
+from .MessageStream import MessageStream, ProtocolError
+from .WorkingDirectory import WorkingDirectory
+from .Metrics import METRICS
+from .EventLog import EVENT_LOG
 
 
 class Connection:
     """
     Class representing a connection with a client from the server point of view. An instance of this
-    class is created each time a client connects to the main socket. It will change the current working directory
-    to the one stored on the server's system $HOME environment variable and start receiving commands, executing them,
-    and sending the answer, until the client is disconnected
+    class is created each time a client connects to the main socket. It starts at the served root and receives
+    commands, executing them, and sending the answer, until the client is disconnected. Each connection has its
+    own WorkingDirectory inside the root, instead of the process working directory, so any number of them can
+    share a process. Each connection has a random session id, which goes with everything it logs
     """
-    def __init__(self, client_socket, client_address, SESSION_TOKEN, transfers_port):
+    def __init__(self, client_socket, client_address, tickets, transfers_port, checksum_cache, directory_index, path_index,
+                 root):
         self.__client_socket = client_socket
+        self.__stream = MessageStream(client_socket)
         self.__client_address = client_address
-        self.__secret_token = SESSION_TOKEN
+        self.__tickets = tickets
+        self.__issued = []
         self.__transfers_port = transfers_port
-        if os.name == 'posix':
-            os.chdir(os.getenv("HOME", default="/home"))
+        self.__checksum_cache = checksum_cache
+        self.__directory_index = directory_index
+        self.__path_index = path_index
+        self.__request_id = None
+        self.__batch_responses = None
+        self.__compression = None
+        self.__working_directory = WorkingDirectory(root)
+        self.session_id = secrets.token_hex(Constants.SESSION_ID_BYTES)
 
         self.__COMMANDS = {'pwd': self.pwd, 'ls': self.ls}
-        self.__COMMANDS_ARGS = {'cd': self.cd, 'ls': self.ls, 'mkdir': self.mkdir, 'get': self.get, 'put': self.put}
+        self.__COMMANDS_ARGS = {'cd': self.cd, 'ls': self.ls, 'mkdir': self.mkdir, 'get': self.get, 'put': self.put,
+                                'sync': self.sync, 'protocol': self.protocol, 'batch': self.batch,
+                                'compression': self.compression, 'get_tree': self.get_tree, 'put_tree': self.put_tree,
+                                'list': self.list, 'find': self.find}
 
     def start(self) -> None:
         """
@@ -29,21 +50,74 @@ class Connection:
         :return: None
         """
         while True:
-            client_datagram = self.__client_socket.recv(Constants.BUFFER_SIZE).decode()
-            if not client_datagram:
+            client_data = self.__client_socket.recv(Constants.STREAM_BUFFER_SIZE)
+            if not client_data:
                 break
             try:
-                client_json = json.loads(client_datagram)
-                command, argument = client_json["command"], client_json["argument"]
+                self.feed(client_data)
+            except ProtocolError:
+                break
+
+    def feed(self, client_data: bytes) -> None:
+        """
+        Adds data received from the client to the message stream, and executes every command that
+        is complete. Used by start() and by the asyncio server, which does its own reading
+
+        :param client_data: bytes received from the client's socket
+        :raises ProtocolError: if the client broke the framing and the connection should be closed
+        :return: None
+        """
+        self.__stream.feed(client_data)
+        while True:
+            try:
+                client_json = self.__stream.next_message()
             except json.decoder.JSONDecodeError:
+                self.__request_id = None
                 self.send_response(Constants.ERROR_STATUS_CODE, Constants.BAD_FORMED_MESSAGE)
                 continue
+            if client_json is None:
+                break
+            self.dispatch(client_json)
+
+    def dispatch(self, client_json: dict) -> None:
+        """
+        Executes the command contained in a single message received from the client and sends the answer.
+        If the message has an "id", the answer carries the same "id", so pipelining clients can match them.
+        The time each command takes, answer included, is recorded in the metrics and logged, with the "id"
+
+        :param client_json: Dictionary representing the json-formatted message received from the client
+        :return: None
+        """
+        started = time.perf_counter()
+        # reset first, so a message that isn't a dictionary isn't answered with the id of the previous one
+        self.__request_id = None
+        try:
+            self.__request_id = client_json.get("id")
+            command, argument = client_json["command"], client_json["argument"]
+        except (KeyError, TypeError, AttributeError):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.BAD_FORMED_MESSAGE)
+            self.__record(Constants.INVALID_COMMAND_LABEL, started)
+            return
+        try:
             if command in self.__COMMANDS and argument is None:
                 self.__COMMANDS[command]()
+            elif command in ('put', 'sync') and argument:
+                # the size and checksum the client declares for the upload are bound to its ticket
+                self.__COMMANDS_ARGS[command](argument, client_json.get("filesize"), client_json.get("sha256sum"))
             elif command in self.__COMMANDS_ARGS and argument:
                 self.__COMMANDS_ARGS[command](argument)
             else:
                 self.send_response(Constants.ERROR_STATUS_CODE, Constants.INVALID_COMMAND)
+                command = Constants.INVALID_COMMAND_LABEL
+        except PermissionError as error:
+            self.send_response(Constants.ERROR_STATUS_CODE, error.strerror)
+        self.__record(command, started)
+
+    def __record(self, command: str, started: float) -> None:
+        seconds = time.perf_counter() - started
+        METRICS.observe(Constants.COMMAND_DURATION, seconds, command)
+        EVENT_LOG.event("command", f"{command} from {self.__client_address}", level=logging.DEBUG, session=self.session_id,
+                        request_id=self.__request_id, command=command, seconds=round(seconds, 6))
 
     def send_response(self, status_code: int, status_message: str, content: str = None) -> None:
         """
@@ -60,70 +134,269 @@ class Connection:
             "content": content
         }
 
-        self.__client_socket.send(json.dumps(response).encode())
+        self.respond(response)
+
+    def respond(self, response: dict) -> None:
+        """
+        Sends an answer to the client, tagged with the id of the request being answered if it had one.
+        While a batch is being executed, answers are collected instead, and sent all together by batch()
+
+        :param response: Dictionary representing the json-formatted answer
+        :return: None
+        """
+        if self.__request_id is not None:
+            response["id"] = self.__request_id
+        if self.__batch_responses is not None:
+            self.__batch_responses.append(response)
+        else:
+            self.__stream.send(response)
 
-    def allow_transfer(self, operation: str, absolute_path: str, filesize: int = None, sha256sum: str = None):
+    def allow_transfer(self, operation: str, absolute_path: str, filesize: int = None, sha256sum: str = None,
+                       blocks_sha256sum: str = None, block_digests: list = None, partial: tuple = None,
+                       compression: tuple = None, tree: tuple = None, upload: tuple = None):
         """
         Method called when a transfer request from the client is marked as valid by the server.
-        It will send the transfer's metadata in a json-formatted message to the client
+        It will send the transfer's metadata in a json-formatted message to the client, with the token of
+        a transfer ticket that binds the operation and the path (and the size and checksum of downloads, and of
+        the uploads the client declared them for) on the server side. Range downloads and directory transfers get
+        a ticket that can be used by each of their connections, the rest a single use one. A session can hold
+        TICKET_SESSION_QUOTA live tickets at most, so it can't take the whole table
 
         :param operation: either 'put' or 'get' depending if the client wants to upload or to download a file
         :param absolute_path: absolute path to the file in server's system
         :param filesize: if the file is in server's system and client wants to download it, this field
         will represent the size of that file in bytes
         :param sha256sum: sha256 file checksum, if the operation is put, it would be None
+        :param blocks_sha256sum: checksum of the list of block checksums of the file, used by the client to
+        verify a resumed download
+        :param block_digests: sha256 checksums of each TRANSFER_BLOCK_SIZE bytes block of the file, sent for big
+        files so the client can download byte ranges in parallel and verify each one on its own
+        :param partial: for uploads, a tuple (sha256sum, offset) describing an interrupted upload of the
+        same path that the client can resume
+        :param compression: tuple (codec, level) the transfer can be compressed with, None if it's not compressed
+        :param tree: for recursive downloads, a tuple with the directories and the [path, size] of the files
+        inside absolute_path, as returned by walk_tree()
+        :param upload: for uploads and delta transfers, a tuple (filesize, sha256sum) with the size and checksum the
+        client declared for the file it's going to send, None if it didn't (older clients)
 
         :return: None
         """
+        fields = {"operation": operation, "absolute_path": absolute_path}
+        if operation == "get":
+            fields.update(filesize=filesize, sha256sum=sha256sum)
+        elif upload is not None:
+            fields.update(filesize=upload[0], sha256sum=upload[1])
+        if len(self.__issued) >= Constants.TICKET_SESSION_QUOTA:
+            self.__issued = self.__tickets.live(self.__issued)
+            if len(self.__issued) >= Constants.TICKET_SESSION_QUOTA:
+                self.send_response(Constants.ERROR_STATUS_CODE, Constants.TICKET_QUOTA_EXCEEDED)
+                return
+        try:
+            token = self.__tickets.issue(fields, reusable=block_digests is not None or operation in ("get_tree", "put_tree"))
+        except ValueError as error:
+            self.send_response(Constants.ERROR_STATUS_CODE, str(error))
+            return
+        self.__issued.append(token)
         response = {
             "status_code": 200,
             "operation": operation,
             "absolute_path": absolute_path,
             "filesize": filesize,
-            "token": self.__secret_token,
+            "token": token,
             "transfer_port": self.__transfers_port,
-            "sha256sum": sha256sum
+            "sha256sum": sha256sum,
+            "block_size": Constants.TRANSFER_BLOCK_SIZE,
+            "queue_flags": True
         }
+        if blocks_sha256sum is not None:
+            response["blocks_sha256sum"] = blocks_sha256sum
+        if block_digests is not None:
+            response["block_digests"] = block_digests
+        if partial is not None:
+            response["partial"] = {"sha256sum": partial[0], "offset": partial[1]}
+        if compression is not None:
+            response["codec"], response["level"] = compression
+        if tree is not None:
+            response["directories"], response["files"] = tree
+
+        self.respond(response)
+
+    def protocol(self, version: str) -> None:
+        """
+        Negotiates the message framing. Connections start unframed, so older clients that never ask keep
+        working. If the client asks for the framed protocol, the answer is still sent unframed and every
+        message after it is length-prefixed
+
+        :param version: String representing the protocol version the client wants to use
+        :return: None
+        """
+        if version == Constants.FRAMED_PROTOCOL_VERSION and self.__batch_responses is None:
+            self.send_response(Constants.OK_STATUS_CODE, Constants.OK_MESSAGE, version)
+            self.__stream.framed = True
+        else:
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.UNSUPPORTED_PROTOCOL)
+
+    def compression(self, codec: str) -> None:
+        """
+        Negotiates the compression of this session's transfers. From now on, downloads are compressed with
+        the given codec unless a sample of the file shows it doesn't compress, and uploads can be compressed
+
+        :param codec: String with the codec and, optionally, the level, like "zlib" or "lzma:9"
+        :return: None
+        """
+        name, _, level = str(codec).partition(":")
+        try:
+            self.__compression = transfer_codec({"codec": name, "level": int(level) if level else None})
+        except ValueError:
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.INVALID_COMPRESSION)
+            return
+        self.send_response(Constants.OK_STATUS_CODE, Constants.COMPRESSION_ENABLED, f"{self.__compression[0]}:{self.__compression[1]}")
 
-        self.__client_socket.send(json.dumps(response).encode())
+    def batch(self, commands: list) -> None:
+        """
+        Executes a list of commands, in order, and sends all their answers in a single json-formatted message,
+        whose content is the list of answers. Each command has the same format as a regular message, and
+        can have an "id" as well
+
+        :param commands: List of dictionaries, each one representing a command message
+        :return: None
+        """
+        if not isinstance(commands, list) or len(commands) > Constants.MAX_BATCH_SIZE or self.__batch_responses is not None:
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.INVALID_BATCH.format(Constants.MAX_BATCH_SIZE))
+            return
+
+        batch_id = self.__request_id
+        self.__batch_responses = []
+        for client_json in commands:
+            self.dispatch(client_json)
+        responses, self.__batch_responses = self.__batch_responses, None
+        self.__request_id = batch_id
+        self.send_response(Constants.OK_STATUS_CODE, Constants.OK_MESSAGE, responses)
 
     def pwd(self) -> None:
         """
-        Checks for server's current working directory and sends the output to the client in a json-formatted message
+        Sends the session's working directory to the client in a json-formatted message, as a path inside
+        the served root, which is /
 
         :return: None
         """
-        working_directory = os.getcwd()
-        self.send_response(Constants.OK_STATUS_CODE, Constants.OK_MESSAGE, working_directory)
+        self.send_response(Constants.OK_STATUS_CODE, Constants.OK_MESSAGE, self.__working_directory.path)
 
     def ls(self, directory=None):
         """
         Lists the given directory or the current directory if none is given,
-        and sends the output to the client in a json-formatted message
+        and sends the output to the client in a json-formatted message. The listing comes from
+        the server's directory index, so it's only read again if the directory changed
 
         :param directory: String representing the directory to list. None by default
         :return: None
         """
         try:
-            output = os.listdir(directory) if directory else os.listdir()
+            entries = self.__directory_index.listing(self.__working_directory.absolute(directory or os.curdir))
+            output = [name for name, _, _, _ in entries]
             content = None if len(output) == 0 else "\n".join(output)
 
             self.send_response(Constants.OK_STATUS_CODE, Constants.OK_MESSAGE, content)
         except (FileNotFoundError, NotADirectoryError):
             self.send_response(Constants.ERROR_STATUS_CODE, Constants.DIRECTORY_DOESNT_EXISTS)
 
+    def list(self, request: dict) -> None:
+        """
+        Structured version of ls. The entries, sorted by name, are sent in pages of LIST_PAGE_SIZE entries, each one
+        a json-formatted message with the "offset" of its first entry, the "total" of entries of the directory
+        and "more", False in the last page, so big directories are streamed instead of sent in a single message.
+        Each entry is [name, type, size, mtime], size and mtime being None unless "details" is True.
+        Inside a batch, the whole listing is sent as a single answer
+
+        :param request: Dictionary with the "path" to list (None for the current directory) and, optionally,
+        the "offset" of the first entry, the "limit" of entries to send and "details"
+        :return: None
+        """
+        try:
+            path, offset, limit = request["path"], request.get("offset", 0), request.get("limit")
+            if not (path is None or isinstance(path, str)) or not isinstance(offset, int) or offset < 0 or \
+                    not (limit is None or isinstance(limit, int) and limit >= 0):
+                raise TypeError()
+        except (KeyError, TypeError, AttributeError):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.INVALID_LIST)
+            return
+        try:
+            entries = self.__directory_index.listing(self.__working_directory.absolute(path or os.curdir), bool(request.get("details")))
+        except (FileNotFoundError, NotADirectoryError):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.DIRECTORY_DOESNT_EXISTS)
+            return
+        except PermissionError as error:
+            self.send_response(Constants.ERROR_STATUS_CODE, error.strerror)
+            return
+
+        end = len(entries) if limit is None else min(len(entries), offset + limit)
+        page_size = Constants.LIST_PAGE_SIZE if self.__batch_responses is None else max(end - offset, 1)
+        for start in range(offset, max(end, offset + 1), page_size):
+            page_end = min(start + page_size, end)
+            self.respond({
+                "status_code": Constants.OK_STATUS_CODE,
+                "status_message": Constants.OK_MESSAGE,
+                "content": entries[start:page_end],
+                "offset": start,
+                "total": len(entries),
+                "more": page_end < end
+            })
+
+    def find(self, request: dict) -> None:
+        """
+        Looks for files and directories under a directory, answering from the server's path index as it is. It's
+        brought up to date in the background, every PATH_INDEX_REFRESH_SECONDS, so searches don't wait for it.
+        The answer's content is a list of [path, type, size, mtime], paths relative to the current working
+        directory and sorted, and "more" is True if there were more results than the limit
+
+        :param request: Dictionary with the glob "pattern" and, optionally, the "path" to search (None for the current
+        directory), "min_size" and "max_size" in bytes, "max_age" and "min_age" (time since the last modification)
+        in seconds and the "limit" of results (FIND_DEFAULT_LIMIT by default, FIND_MAX_LIMIT at most)
+        :return: None
+        """
+        try:
+            pattern, path, limit = request["pattern"], request.get("path"), request.get("limit", Constants.FIND_DEFAULT_LIMIT)
+            filters = [request.get(name) for name in ("min_size", "max_size", "max_age", "min_age")]
+            if not isinstance(pattern, str) or not pattern or not (path is None or isinstance(path, str)) or \
+                    not all(value is None or isinstance(value, int) and value >= 0 for value in filters + [limit]):
+                raise TypeError()
+        except (KeyError, TypeError, AttributeError):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.INVALID_FIND)
+            return
+        if not self.__working_directory.isdir(path or os.curdir):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.DIRECTORY_DOESNT_EXISTS)
+            return
+
+        min_size, max_size, max_age, min_age = filters
+        now = int(time.time())
+        try:
+            results, more = self.__path_index.search(self.__working_directory.absolute(path or os.curdir), pattern, min_size, max_size,
+                                                     None if max_age is None else now - max_age,
+                                                     None if min_age is None else now - min_age,
+                                                     min(limit, Constants.FIND_MAX_LIMIT))
+        except ValueError as error:
+            self.send_response(Constants.ERROR_STATUS_CODE, str(error))
+            return
+        working_directory = self.__working_directory.absolute()
+        self.respond({
+            "status_code": Constants.OK_STATUS_CODE,
+            "status_message": Constants.OK_MESSAGE,
+            "content": [[os.path.relpath(result[0], working_directory)] + result[1:] for result in results],
+            "more": more
+        })
+
     def cd(self, directory: str) -> None:
         """
-        Changes the current working directory to the given one if exists,
+        Changes the session's working directory to the given one if exists,
         and sends the output to the client in a json-formatted message
 
         :param directory: String representing the directory name
         :return: None
         """
-        if os.path.isdir(directory):
-            os.chdir(directory)
+        try:
+            self.__working_directory.chdir(directory)
             self.send_response(Constants.OK_STATUS_CODE, Constants.OK_MESSAGE)
-        else:
+        except (FileNotFoundError, NotADirectoryError):
             self.send_response(Constants.ERROR_STATUS_CODE, Constants.DIRECTORY_DOESNT_EXISTS)
 
     def mkdir(self, directory: str) -> None:
@@ -135,7 +408,7 @@ class Connection:
         :return: None
         """
         try:
-            os.mkdir(directory)
+            self.__working_directory.mkdir(directory)
             self.send_response(Constants.OK_STATUS_CODE, Constants.OK_MESSAGE)
         except FileExistsError:
             self.send_response(Constants.ERROR_STATUS_CODE, Constants.DIRECTORY_EXISTS)
@@ -143,29 +416,105 @@ class Connection:
     def get(self, filename: str) -> None:
         """
         Handles a get request from the client. Checks if the requested file exists
-        and sends the answer to the client in a json-formatted message
+        and sends the answer to the client in a json-formatted message. The file checksum
+        comes from the server's checksum cache, so it's only calculated if the file changed.
+        Clients using the framed protocol also get block checksums of big files, which
+        are too big for an unframed message. Every client gets the checksum of the list of
+        block checksums, which lets it verify a resumed download. If the session negotiated
+        compression and a sample of the file compresses, the answer says which codec to ask for
 
         :param filename: String representing the filename that client is asking for
         :return: None
         """
-        if not os.path.isfile(filename):
+        if not self.__working_directory.isfile(filename):
             self.send_response(Constants.ERROR_STATUS_CODE, Constants.FILE_DOESNT_EXISTS)
         else:
-            absolute_path = os.path.abspath(filename)
-            filesize = os.path.getsize(filename)
-            sha256sum = calculate_checksum(absolute_path)
-            self.allow_transfer(operation="get", absolute_path=absolute_path, filesize=filesize, sha256sum=sha256sum)
+            absolute_path = self.__working_directory.absolute(filename)
+            filesize = self.__working_directory.stat(filename).st_size
+            sha256sum, block_digests = self.__checksum_cache.block_checksums(absolute_path)
+            blocks_sha256sum = blocks_checksum(block_digests)
+            if not self.__stream.framed or filesize < Constants.BLOCK_DIGESTS_MIN_SIZE:
+                block_digests = None
+            compression = self.__compression
+            if compression is not None and not is_compressible(absolute_path, *compression):
+                compression = None
+            self.allow_transfer(operation="get", absolute_path=absolute_path, filesize=filesize, sha256sum=sha256sum,
+                                blocks_sha256sum=blocks_sha256sum, block_digests=block_digests, compression=compression)
 
-    def put(self, filename: str) -> None:
+    def put(self, filename: str, filesize: int = None, sha256sum: str = None) -> None:
         """
         Handles a put request from the client. Checks if the requested file doesn't exists
-        and sends the answer to the client in a json-formatted message
+        and sends the answer to the client in a json-formatted message. If a previous upload
+        of the same path was interrupted, the answer says where it can be resumed. If the session
+        negotiated compression, the answer has the codec the client may compress the file with
 
         :param filename: String representing the filename that client wants to upload
+        :param filesize: size of the file, as declared by the client in the put request. None if it didn't
+        :param sha256sum: sha256 checksum of the file, as declared by the client in the put request. None if it
+        didn't
+        :return: None
+        """
+        if self.__working_directory.isfile(filename):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.FILE_EXISTS)
+        else:
+            absolute_path = self.__working_directory.absolute(filename)
+            self.allow_transfer(operation="put", absolute_path=absolute_path, partial=PartialFile.resume_point(absolute_path),
+                                compression=self.__compression, upload=self.__declared(filesize, sha256sum))
+
+    def sync(self, filename: str, filesize: int = None, sha256sum: str = None) -> None:
+        """
+        Handles a sync request from the client, an upload that may replace a file. If the file doesn't
+        exist, it's handled as a put request. If it does, the transfer is allowed as a delta transfer,
+        where the client only sends the blocks that changed
+
+        :param filename: String representing the filename that client wants to upload
+        :param filesize: size of the new file, as declared by the client in the sync request. None if it didn't
+        :param sha256sum: sha256 checksum of the new file, as declared by the client. None if it didn't
+        :return: None
+        """
+        if not self.__working_directory.exists(filename):
+            self.put(filename, filesize, sha256sum)
+        elif not self.__working_directory.isfile(filename):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.FILE_DOESNT_EXISTS)
+        else:
+            self.allow_transfer(operation="delta", absolute_path=self.__working_directory.absolute(filename),
+                                filesize=self.__working_directory.stat(filename).st_size,
+                                upload=self.__declared(filesize, sha256sum))
+
+    @staticmethod
+    def __declared(filesize, sha256sum):
+        """
+        :return: the tuple (filesize, sha256sum) the client declared for an upload, or None if it didn't declare
+        both. They're checked when the transfer starts (see upload_size())
+        """
+        if filesize is None or sha256sum is None:
+            return None
+        return filesize, sha256sum
+
+    def get_tree(self, directory: str) -> None:
+        """
+        Handles a recursive get request from the client. The directory is walked once, and the answer lists
+        its directories and the path and size of each of its files, so the client can plan the packs it
+        downloads them in
+
+        :param directory: String representing the directory that client is asking for
+        :return: None
+        """
+        if not self.__working_directory.isdir(directory):
+            self.send_response(Constants.ERROR_STATUS_CODE, Constants.DIRECTORY_DOESNT_EXISTS)
+        else:
+            absolute_path = self.__working_directory.absolute(directory)
+            self.allow_transfer(operation="get_tree", absolute_path=absolute_path, tree=walk_tree(absolute_path))
+
+    def put_tree(self, directory: str) -> None:
+        """
+        Handles a recursive put request from the client. The directory may exist, in which case the files
+        it doesn't have yet are added to it
+
+        :param directory: String representing the directory that client wants to upload
         :return: None
         """
-        if os.path.isfile(filename):
+        if self.__working_directory.exists(directory) and not self.__working_directory.isdir(directory):
             self.send_response(Constants.ERROR_STATUS_CODE, Constants.FILE_EXISTS)
         else:
-            absolute_path = f"{os.getcwd()}/{filename}"
-            self.allow_transfer(operation="put", absolute_path=absolute_path)
+            self.allow_transfer(operation="put_tree", absolute_path=self.__working_directory.absolute(directory))
@@ -0,0 +1,143 @@
+import os
+import fcntl
+import string
+from .server_helper import Constants
+
+
+class ContentStore:
+    """
+    Class representing a content-addressed store of the files uploaded, so a file that the server already has,
+    anywhere, isn't uploaded again: an upload that announces a checksum the store knows is completed by putting
+    the stored copy in place, without receiving a single byte.
+
+    Each unique content is a blob, "<store>/objects/<first 2 hex digits>/<sha256>", which is a hardlink to the
+    first upload that had it. Blobs are only added for uploads whose whole-file checksum was verified by the
+    server, so a client can't store bytes under a checksum they don't have. The reference count of a blob is
+    its number of links minus the store's own: every file placed with a hardlink adds one, and every file
+    removed or replaced (uploads are always renamed over the old file, never written in place) takes one.
+    Blobs nobody references anymore are removed by collect().
+
+    Files are placed with a reflink (copy-on-write clone, btrfs and xfs) when the file system supports it,
+    since it doesn't share the inode, so editing the file in place doesn't change the others. Otherwise they're
+    hardlinked. Files edited in place by someone else would change the blob too, so the blob is verified with
+    the checksum cache before it's used (an unchanged blob is a cache hit), and dropped if it doesn't match.
+    The store must be in the same file system as the files served, since neither links nor reflinks can cross
+    file systems. When a file can't be placed, it's uploaded as usual. Placed files are put in place by the
+    committer, if one is given, like any other upload (see Committer)
+    """
+    FICLONE = 0x40049409
+
+    def __init__(self, path: str, checksum_cache, committer=None):
+        self.path = path
+        self.__checksum_cache = checksum_cache
+        self.__committer = committer
+        os.makedirs(os.path.join(path, Constants.CONTENT_STORE_OBJECTS), exist_ok=True)
+
+    def blob_path(self, sha256sum: str):
+        """
+        :return: path to the blob of the given checksum, or None if it isn't a valid sha256 checksum
+        """
+        if not isinstance(sha256sum, str) or len(sha256sum) != 64 or not set(sha256sum) <= set(string.hexdigits.lower()):
+            return None
+        return os.path.join(self.path, Constants.CONTENT_STORE_OBJECTS, sha256sum[:2], sha256sum)
+
+    def place(self, sha256sum: str, filesize: int, path: str) -> bool:
+        """
+        Puts a copy of the stored content with the given checksum in path, replacing whatever was there
+
+        :param sha256sum: checksum of the file being uploaded
+        :param filesize: size of the file being uploaded, None if the client didn't send it
+        :param path: final path of the file
+        :return: True if the file is in place, False if the store doesn't have it or it can't be placed
+        """
+        blob = self.blob_path(sha256sum)
+        if blob is None:
+            return False
+        try:
+            size = os.stat(blob).st_size
+        except OSError:
+            return False
+        if filesize is not None and size != filesize:
+            return False
+        if self.__checksum_cache.checksum(blob) != sha256sum:
+            self.__remove(blob)
+            return False
+
+        temporary_path = path + Constants.CONTENT_STORE_SUFFIX
+        self.__remove(temporary_path)
+        if not self.__clone(blob, temporary_path):
+            try:
+                os.link(blob, temporary_path)
+            except OSError:
+                return False
+        try:
+            if self.__committer is not None:
+                self.__committer.commit(temporary_path, path)
+            else:
+                os.replace(temporary_path, path)
+        except OSError:
+            self.__remove(temporary_path)
+            return False
+        return True
+
+    def ingest(self, path: str, sha256sum: str) -> None:
+        """
+        Adds a file that was just received to the store, if its content isn't there yet. Nothing happens if it
+        can't be linked, like when the store is in another file system
+
+        :param path: path to the file received
+        :param sha256sum: checksum of the file, calculated by the server while it was received
+        :return: None
+        """
+        blob = self.blob_path(sha256sum)
+        if blob is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.link(path, blob)
+        except OSError:
+            pass
+
+    def collect(self) -> tuple:
+        """
+        Removes the blobs that no file references anymore, the ones that only have the store's link
+
+        :return: a tuple with the number of blobs removed and the number of blobs kept
+        """
+        removed = kept = 0
+        objects = os.path.join(self.path, Constants.CONTENT_STORE_OBJECTS)
+        for directory in os.scandir(objects):
+            if not directory.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    if entry.stat(follow_symlinks=False).st_nlink > 1:
+                        kept += 1
+                        continue
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    continue
+        return removed, kept
+
+    @classmethod
+    def __clone(cls, source: str, destination: str) -> bool:
+        """
+        Makes a reflink of source, a copy that shares its data blocks until one of them is modified
+
+        :return: False if the file system doesn't support it
+        """
+        try:
+            with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+                fcntl.ioctl(destination_file.fileno(), cls.FICLONE, source_file.fileno())
+            return True
+        except OSError:
+            cls.__remove(destination)
+            return False
+
+    @staticmethod
+    def __remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,138 @@
+import os
+import stat
+import struct
+import hashlib
+import tempfile
+from .server_helper import Constants
+
+
+class DeltaPatcher:
+    """
+    Class rebuilding a file out of the delta sent by a client and the server's current copy of the file
+    (the basis). The delta is a stream of instructions:
+    - copy: DELTA_COPY followed by the index of the first block and the number of blocks to copy from the
+    basis, as two 4 bytes big-endian integers
+    - data: DELTA_DATA followed by a 4 bytes big-endian length and that many bytes of literal data
+    - end: DELTA_END, the delta is complete
+
+    It doesn't do any I/O on sockets: feed() takes the bytes as they're received, so both the threaded
+    Transfer and the asyncio server can use it. The new file is written next to the basis, to a temporary
+    "<file>.<random>.delta" of its own, so concurrent deltas of the same file don't write over each other, and
+    hashed while it's written. The client declares the size of the new file, and a delta that would write more
+    than that is refused right away, since a few bytes of copy instructions can repeat the basis any number of
+    times. It only replaces the basis, with an atomic rename, if it's complete, has the declared size and its
+    sha256 checksum matches the one sent by the client, so a failed or interrupted delta transfer leaves the
+    basis untouched.
+    """
+    COPY = struct.Struct("!II")
+    LENGTH = struct.Struct("!I")
+
+    def __init__(self, path: str, block_size: int, sha256sum: str, filesize: int):
+        self.path = path
+        self.temporary_path = None
+        self.copied = 0
+        self.literal = 0
+        self.finished = False
+        self.__block_size = block_size
+        self.__sha256sum = sha256sum
+        self.__filesize = filesize
+        self.__checksum = hashlib.sha256()
+        self.__buffer = bytearray()
+        self.__basis = None
+        self.__output = None
+
+    def open(self) -> None:
+        self.__basis = open(self.path, "rb")
+        descriptor, self.temporary_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                                           suffix=Constants.DELTA_SUFFIX, dir=os.path.dirname(self.path))
+        self.__output = os.fdopen(descriptor, "wb")
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Adds data received from the client and applies every instruction that is complete
+
+        :param data: bytes received
+        :return: True once the end instruction was received
+        :raises ValueError: if an instruction is bad formed, refers to blocks the basis doesn't have or makes the
+        file bigger than its declared size
+        """
+        self.__buffer += data
+        while self.__buffer and not self.finished:
+            opcode = bytes(self.__buffer[:1])
+            if opcode == Constants.DELTA_COPY:
+                if len(self.__buffer) < 1 + self.COPY.size:
+                    break
+                start, count = self.COPY.unpack_from(self.__buffer, 1)
+                del self.__buffer[:1 + self.COPY.size]
+                self.__copy(start, count)
+            elif opcode == Constants.DELTA_DATA:
+                if len(self.__buffer) < 1 + self.LENGTH.size:
+                    break
+                (length,) = self.LENGTH.unpack_from(self.__buffer, 1)
+                if length > Constants.DELTA_MAX_LITERAL or self.copied + self.literal + length > self.__filesize:
+                    raise ValueError(Constants.INVALID_DELTA)
+                end = 1 + self.LENGTH.size + length
+                if len(self.__buffer) < end:
+                    break
+                self.__write(self.__buffer[1 + self.LENGTH.size:end])
+                self.literal += length
+                del self.__buffer[:end]
+            elif opcode == Constants.DELTA_END:
+                del self.__buffer[:1]
+                self.finished = True
+            else:
+                raise ValueError(Constants.INVALID_DELTA)
+        return self.finished
+
+    def commit(self, committer=None) -> bool:
+        """
+        Replaces the basis with the new file, keeping the basis permissions, if the delta was complete and
+        the new file has the declared size and is authentic. Otherwise, the new file is removed
+
+        :param committer: Committer that renames the file, flushing it as its policy says. None to just rename it
+        :return: True if the basis was replaced
+        :raises OSError: if the new file couldn't be renamed (or flushed), it's removed
+        """
+        self.close()
+        if not self.finished or self.copied + self.literal != self.__filesize or \
+                self.__checksum.hexdigest() != self.__sha256sum:
+            self.discard()
+            return False
+        os.chmod(self.temporary_path, stat.S_IMODE(os.stat(self.path).st_mode))
+        try:
+            if committer is not None:
+                committer.commit(self.temporary_path, self.path)
+            else:
+                os.replace(self.temporary_path, self.path)
+        except OSError:
+            self.discard()
+            raise
+        return True
+
+    def close(self) -> None:
+        for file in (self.__basis, self.__output):
+            if file is not None:
+                file.close()
+
+    def discard(self) -> None:
+        self.close()
+        if self.temporary_path is not None and os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+
+    def __copy(self, start: int, count: int) -> None:
+        offset, remaining = start * self.__block_size, count * self.__block_size
+        if count == 0 or offset + remaining > os.fstat(self.__basis.fileno()).st_size or \
+                self.copied + self.literal + remaining > self.__filesize:
+            raise ValueError(Constants.INVALID_DELTA)
+        self.__basis.seek(offset)
+        while remaining:
+            data = self.__basis.read(min(remaining, Constants.SEND_BUFFER_SIZE))
+            if not data:
+                raise ValueError(Constants.INVALID_DELTA)
+            self.__write(data)
+            remaining -= len(data)
+        self.copied += count * self.__block_size
+
+    def __write(self, data) -> None:
+        self.__output.write(data)
+        self.__checksum.update(data)
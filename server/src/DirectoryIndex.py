@@ -0,0 +1,209 @@
+import os
+import time
+import stat
+import struct
+import ctypes
+import threading
+from collections import OrderedDict
+from .server_helper import Constants
+
+
+class Inotify:
+    """
+    Minimal wrapper of the Linux inotify API, through ctypes. The file descriptor is non-blocking, so
+    pending events are read when they're needed instead of in a thread of their own.
+    open() returns None where inotify isn't available (other systems, or the limit of instances was reached)
+    """
+    EVENT = struct.Struct("iIII")
+    MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800  # modify, attrib, close_write, moves, create, deletes
+    IGNORED = 0x8000
+    QUEUE_OVERFLOW = 0x4000
+    NONBLOCK_CLOEXEC = os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0)
+
+    def __init__(self, libc, fd: int):
+        self.__libc = libc
+        self.fd = fd
+
+    @classmethod
+    def open(cls):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(cls.NONBLOCK_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        return cls(libc, fd) if fd >= 0 else None
+
+    def add_watch(self, path: str):
+        """
+        :return: watch descriptor of the directory, or None if it can't be watched (max_user_watches reached)
+        """
+        wd = self.__libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        return wd if wd >= 0 else None
+
+    def remove_watch(self, wd: int) -> None:
+        self.__libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> list:
+        """
+        :return: list of (watch descriptor, mask) of the pending events, an empty list if there aren't any
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, Constants.STREAM_BUFFER_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                events.append((wd, mask))
+                offset += self.EVENT.size + length
+
+
+class DirectoryIndex:
+    """
+    Class representing a cache of directory listings, so listing a directory with hundreds of thousands of
+    entries, which takes seconds on network file systems, is paid once and not on every ls.
+
+    Listings come from os.scandir, sorted by name, so they can be paginated. The type of each entry comes
+    from the directory itself, and size and modification time, which need a stat of each entry, are only
+    read when they're asked for (scandir caches them in the entry, so each entry is stat'ed once).
+
+    A cached listing is dropped when:
+    - inotify reports a change in the directory or in any of its entries (Linux only). Each cached directory
+    is watched, and the watch is added before listing it, so changes made during the listing aren't missed
+    - the directory's inode or modification time changed. This is checked on every lookup, one stat, because
+    inotify only sees the changes made by this machine, not the ones made by other clients of a network file
+    system. Directories modified less than LIST_RACY_SECONDS before they were listed aren't trusted, since a
+    change made right after might not change their modification time
+
+    Up to LIST_CACHE_DIRECTORIES listings are kept, least recently used ones are evicted. It's safe to use from
+    several threads, and after a fork, each process starts with an empty cache of its own
+    """
+    def __init__(self, max_directories: int = Constants.LIST_CACHE_DIRECTORIES):
+        self.__max_directories = max_directories
+        self.__lock = threading.Lock()
+        self.__pid = None
+        self.__listings = None
+        self.__watches = None
+        self.__inotify = None
+        self.hits = 0
+        self.misses = 0
+
+    def listing(self, directory: str, details: bool = False) -> list:
+        """
+        Returns the entries of a directory, from the cache if it didn't change since it was listed
+
+        :param directory: path to the directory
+        :param details: if True, entries include size and modification time
+        :return: list of entries sorted by name, each one a list [name, type, size, mtime], where type is
+        LIST_DIRECTORY, LIST_LINK or LIST_FILE, and size and mtime (seconds since the epoch) are None unless
+        details were asked for
+        :raises FileNotFoundError: if the directory doesn't exist
+        :raises NotADirectoryError: if it isn't a directory
+        """
+        path = os.path.realpath(directory)
+        with self.__lock:
+            self.__check_process()
+            self.__read_events()
+            cached = self.__listings.get(path)
+            directory_key = self.__directory_key(path)
+            if cached is not None and cached[0] == directory_key and (cached[2] or not details):
+                self.__listings.move_to_end(path)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            self.__forget(path)
+            wd = self.__inotify.add_watch(path) if self.__inotify is not None else None
+            if wd is not None:
+                self.__watches.setdefault(wd, set()).add(path)
+
+        started = time.time_ns()
+        entries = self.__scan(path, details)
+        with self.__lock:
+            if self.__pid != os.getpid():
+                return entries
+            unchanged = wd is None or path in self.__watches.get(wd, ())
+            if unchanged and directory_key[2] < started - Constants.LIST_RACY_SECONDS * 10 ** 9:
+                self.__listings[path] = (directory_key, entries, details, wd)
+                while len(self.__listings) > self.__max_directories:
+                    self.__forget(next(iter(self.__listings)))
+            elif unchanged:
+                self.__unwatch(wd, path)
+        return entries
+
+    @staticmethod
+    def __directory_key(path: str) -> tuple:
+        stat_result = os.stat(path)
+        if not stat.S_ISDIR(stat_result.st_mode):
+            raise NotADirectoryError(path)
+        return stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns
+
+    @staticmethod
+    def __scan(path: str, details: bool) -> list:
+        entries = []
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_symlink():
+                        entry_type = Constants.LIST_LINK
+                    elif entry.is_dir():
+                        entry_type = Constants.LIST_DIRECTORY
+                    else:
+                        entry_type = Constants.LIST_FILE
+                    if details:
+                        stat_result = entry.stat(follow_symlinks=False)
+                        entries.append([entry.name, entry_type, stat_result.st_size, int(stat_result.st_mtime)])
+                    else:
+                        entries.append([entry.name, entry_type, None, None])
+                except FileNotFoundError:
+                    continue
+        entries.sort(key=lambda listed: listed[0])
+        return entries
+
+    def __check_process(self) -> None:
+        """
+        The inotify descriptor can't be shared between processes (each one would take the events of the other),
+        so a forked process opens its own one the first time it needs it
+        """
+        if self.__pid != os.getpid():
+            self.__pid = os.getpid()
+            self.__listings = OrderedDict()
+            self.__watches = {}
+            self.__inotify = Inotify.open()
+
+    def __read_events(self) -> None:
+        """
+        Drops the listings of the directories that changed. Directories being listed right now lose their
+        watch too, so their listing isn't cached when it's done
+        """
+        if self.__inotify is None:
+            return
+        for wd, mask in self.__inotify.read_events():
+            if mask & Inotify.QUEUE_OVERFLOW:
+                for overflowed in list(self.__watches):
+                    self.__inotify.remove_watch(overflowed)
+                self.__watches.clear()
+                self.__listings.clear()
+                continue
+            paths = self.__watches.pop(wd, None)
+            if paths is None:
+                continue
+            for path in paths:
+                self.__listings.pop(path, None)
+            if not mask & Inotify.IGNORED:
+                self.__inotify.remove_watch(wd)
+
+    def __forget(self, path: str) -> None:
+        cached = self.__listings.pop(path, None)
+        if cached is not None:
+            self.__unwatch(cached[3], path)
+
+    def __unwatch(self, wd, path: str) -> None:
+        paths = self.__watches.get(wd)
+        if paths is None:
+            return
+        paths.discard(path)
+        if not paths:
+            del self.__watches[wd]
+            self.__inotify.remove_watch(wd)
@@ -0,0 +1,144 @@
+import os
+import sys
+import atexit
+import json
+import queue
+import logging
+import datetime
+import threading
+import multiprocessing
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from .server_helper import Constants
+from .Metrics import METRICS
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through only one of every N records of the high-volume events, N given by rates. The records that
+    go through are tagged with "sampled": N, so totals can still be estimated. Counts are per process
+    """
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.__rates = rates
+        self.__counts = Counter()
+        self.__lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.__rates.get(getattr(record, "event", None))
+        if not rate:
+            return True
+        with self.__lock:
+            count = self.__counts[record.event]
+            self.__counts[record.event] += 1
+        if count % rate:
+            return False
+        record.fields = dict(record.fields, sampled=rate)
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never waits: if the queue is full, the record is dropped and counted in the metrics
+    """
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.inc(Constants.LOG_RECORDS_DROPPED)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The colored lines the server always printed: "[16/11/2020 - 12:01] message"
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        line = f"{Constants.date_time(record.created)} {record.getMessage()}"
+        color = getattr(record, "color", None)
+        return f"{Constants.COLORS[color]}{line}{Constants.COLORS['RESET']}" if color else line
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    A json object per line, with the time, level, event, message and process of the record and its fields
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+                 "level": record.levelname.lower(), "event": getattr(record, "event", None),
+                 "message": record.getMessage(), "pid": record.process}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, default=str)
+
+
+class EventLog:
+    """
+    Class representing the log of the server. Every event is a logging record with an event name, a human
+    readable message and structured fields: session and request ids of the commands, id, size, timing and
+    throughput of the transfers, and so on.
+
+    Logging never blocks whoever logs: records are put in a queue shared by every process of the server,
+    created before it forks, so the processes of the clients, the workers and the transfer threads only hand
+    them over. If the queue is full, the record is dropped and counted in the metrics. A thread of the master
+    process takes them out and writes them to the sinks (see start()). High-volume events are sampled before
+    they're queued, as LOG_SAMPLING says, so they don't cost anything when they're left out
+    """
+    def __init__(self):
+        self.__queue = multiprocessing.Queue(Constants.LOG_QUEUE_SIZE)
+        self.__logger = logging.getLogger(Constants.LOGGER_NAME)
+        self.__logger.setLevel(logging.DEBUG)
+        self.__logger.propagate = False
+        handler = DroppingQueueHandler(self.__queue)
+        handler.addFilter(SamplingFilter(Constants.LOG_SAMPLING))
+        self.__logger.addHandler(handler)
+        self.__listener = None
+        self.__pid = None
+
+    def event(self, event: str, message: str, color: str = None, level: int = logging.INFO, **fields) -> None:
+        """
+        Logs an event
+
+        :param event: name of the event, like "received"
+        :param message: human readable description, the line printed in text format
+        :param color: key of Constants.COLORS used to print it in text format, None for the default color
+        :param level: logging level. Text and json stdout only get INFO and above, the log file gets everything
+        :param fields: structured data of the event, they must be json serializable (or convertible with str)
+        :return: None
+        """
+        self.__logger.log(level, message, extra={"event": event, "color": color, "fields": fields})
+
+    def start(self, log_format: str = Constants.LOG_TEXT, log_file: str = None) -> None:
+        """
+        Starts writing the queued records to the sinks, from a thread of this process, until stop() is called
+        or the process exits. Must be called by the master process, before it forks
+
+        :param log_format: format of the records printed to stdout, LOG_TEXT or LOG_JSON
+        :param log_file: path to a file where every record is written in json, rotated every
+        LOG_FILE_MAX_BYTES bytes and keeping LOG_FILE_BACKUPS old files. None to only log to stdout
+        :return: None
+        """
+        stdout = logging.StreamHandler(sys.stdout)
+        stdout.setLevel(logging.INFO)
+        stdout.setFormatter(JsonFormatter() if log_format == Constants.LOG_JSON else TextFormatter())
+        handlers = [stdout]
+        if log_file is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            rotating = RotatingFileHandler(log_file, maxBytes=Constants.LOG_FILE_MAX_BYTES, backupCount=Constants.LOG_FILE_BACKUPS)
+            rotating.setFormatter(JsonFormatter())
+            handlers.append(rotating)
+        self.__listener = QueueListener(self.__queue, *handlers, respect_handler_level=True)
+        self.__listener.start()
+        self.__pid = os.getpid()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """
+        Writes the records still queued and stops the sinks. It does nothing outside the master process
+
+        :return: None
+        """
+        if self.__listener is not None and self.__pid == os.getpid():
+            self.__listener.stop()
+            self.__listener = None
+
+
+EVENT_LOG = EventLog()
@@ -0,0 +1,122 @@
+import json
+import struct
+from .server_helper import Constants
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer breaks the message framing in a way the stream can't recover from
+    """
+
+
+class MessageStream:
+    """
+    Class representing the json message channel of a main connection. It has two modes:
+    - unframed (protocol 1): messages are bare json documents. Consecutive documents in the buffer are split
+    with raw_decode, so messages merged by TCP are still answered one by one
+    - framed (protocol 2): each message is preceded by its length as a 4 bytes big-endian integer, so big
+    messages are read until complete and pipelined ones are never mixed
+
+    Every connection starts unframed and switches to framed once the client negotiates protocol 2.
+    Incoming bytes are kept in a buffer: feed() adds data and next_message() takes complete messages out.
+    If lenient is False, an unframed buffer that isn't valid json is dropped and reported as an error (the
+    server can't tell a truncated message from a bad formed one). If it's True, it waits for more data.
+    """
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, stream_socket, framed: bool = False, lenient: bool = False):
+        self.__socket = stream_socket
+        self.__buffer = bytearray()
+        self.__decoder = json.JSONDecoder()
+        self.__lenient = lenient
+        self.framed = framed
+
+    def encode(self, message: dict) -> bytes:
+        data = json.dumps(message).encode()
+        if self.framed:
+            return self.HEADER.pack(len(data)) + data
+        return data
+
+    def send(self, message: dict) -> None:
+        self.__socket.sendall(self.encode(message))
+
+    def feed(self, data: bytes) -> None:
+        self.__buffer += data
+
+    def next_message(self):
+        """
+        Takes the next complete message out of the buffer
+
+        :return: the decoded message, or None if there isn't a complete message in the buffer yet
+        :raises json.decoder.JSONDecodeError: if a complete message isn't valid json, or valid utf-8. The message is
+        discarded
+        :raises ProtocolError: if a framed message is bigger than Constants.MAX_MESSAGE_SIZE
+        """
+        if self.framed:
+            return self.__next_framed()
+        return self.__next_unframed()
+
+    def receive(self):
+        """
+        Blocking read of the next message, used by the side that waits for an answer
+
+        :return: the decoded message, or None if the connection was closed
+        """
+        while True:
+            message = self.next_message()
+            if message is not None:
+                return message
+            data = self.__socket.recv(Constants.STREAM_BUFFER_SIZE)
+            if not data:
+                return None
+            self.feed(data)
+
+    def __next_framed(self):
+        if len(self.__buffer) < self.HEADER.size:
+            return None
+        (length,) = self.HEADER.unpack_from(self.__buffer)
+        if length > Constants.MAX_MESSAGE_SIZE:
+            raise ProtocolError(Constants.MESSAGE_TOO_BIG)
+        end = self.HEADER.size + length
+        if len(self.__buffer) < end:
+            return None
+        data = bytes(self.__buffer[self.HEADER.size:end])
+        del self.__buffer[:end]
+        try:
+            text = data.decode()
+        except UnicodeDecodeError as error:
+            raise self.__not_utf8(data, error) from error
+        return json.loads(text)
+
+    def __next_unframed(self):
+        invalid = None
+        try:
+            text = self.__buffer.decode()
+        except UnicodeDecodeError as error:
+            text = self.__buffer[:error.start].decode()
+            # a character cut at the end of the buffer is completed by the next read, other errors never are
+            if error.reason != "unexpected end of data":
+                invalid = error
+        start = len(text) - len(text.lstrip())
+        if start == len(text):
+            if invalid is not None and not self.__lenient:
+                data = bytes(self.__buffer)
+                self.__buffer.clear()
+                raise self.__not_utf8(data, invalid) from invalid
+            return None
+        try:
+            message, end = self.__decoder.raw_decode(text, start)
+        except json.decoder.JSONDecodeError:
+            if self.__lenient:
+                return None
+            self.__buffer.clear()
+            raise
+        del self.__buffer[:len(text[:end].encode())]
+        return message
+
+    @staticmethod
+    def __not_utf8(data: bytes, error: UnicodeDecodeError) -> json.decoder.JSONDecodeError:
+        """
+        :return: the error of a message that isn't valid utf-8, which is bad formed json like any other
+        """
+        return json.decoder.JSONDecodeError(f"Invalid utf-8, {error.reason}", data.decode(errors="replace"), error.start)
@@ -0,0 +1,155 @@
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from .server_helper import Constants
+
+
+class Metrics:
+    """
+    Class representing the metrics of the server, exposed in the Prometheus text format. Every series is
+    declared up front (see Constants.METRICS) and lives in a shared memory array, created before the server
+    forks, so the processes of a client (process mode) and the workers (prefork mode) write to the same
+    counters the master process serves. Label values that weren't declared are counted as "other", so a
+    client can't make the server create series.
+
+    Counters and gauges take a slot each. Histograms take a slot per bucket, plus the +Inf bucket, the sum and
+    the count. Updates hold a lock shared by every process, they're a few additions each
+    """
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+    OTHER = "other"
+
+    def __init__(self, families: tuple = Constants.METRICS):
+        self.__families = families
+        self.__offsets = {}
+        size = 0
+        for name, metric_type, _, label, values, buckets in families:
+            for value in values + (self.OTHER,) if label else (None,):
+                self.__offsets[(name, value)] = size
+                size += len(buckets) + 3 if metric_type == self.HISTOGRAM else 1
+        self.__values = multiprocessing.RawArray("d", size)
+        self.__lock = multiprocessing.Lock()
+        self.__buckets = {name: buckets for name, _, _, _, _, buckets in families}
+
+    def __offset(self, name: str, label: str = None) -> int:
+        offset = self.__offsets.get((name, label)) if label is None or isinstance(label, str) else None
+        return offset if offset is not None else self.__offsets[(name, self.OTHER)]
+
+    def inc(self, name: str, amount: float = 1, label: str = None) -> None:
+        """
+        Adds amount to a counter or a gauge
+
+        :param name: name of the metric
+        :param amount: amount to add, negative to decrease a gauge
+        :param label: value of the metric's label, if it has one
+        :return: None
+        """
+        offset = self.__offset(name, label)
+        with self.__lock:
+            self.__values[offset] += amount
+
+    def dec(self, name: str, amount: float = 1, label: str = None) -> None:
+        self.inc(name, -amount, label)
+
+    def observe(self, name: str, value: float, label: str = None) -> None:
+        """
+        Records a value in a histogram
+
+        :param name: name of the metric
+        :param value: value observed, usually seconds
+        :param label: value of the metric's label, if it has one
+        :return: None
+        """
+        offset = self.__offset(name, label)
+        buckets = self.__buckets[name]
+        index = next((index for index, bound in enumerate(buckets) if value <= bound), len(buckets))
+        with self.__lock:
+            self.__values[offset + index] += 1
+            self.__values[offset + len(buckets) + 1] += value
+            self.__values[offset + len(buckets) + 2] += 1
+
+    @contextmanager
+    def timer(self, name: str, label: str = None):
+        """
+        Observes in a histogram the seconds the block inside the with statement took, even if it raised
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, label)
+
+    def render(self) -> str:
+        """
+        :return: every series in the Prometheus text exposition format. Series of undeclared label values are
+        only included once something was counted in them
+        """
+        with self.__lock:
+            values = self.__values[:]
+        lines = []
+        for name, metric_type, description, label, declared, buckets in self.__families:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for value in declared + (self.OTHER,) if label else (None,):
+                offset = self.__offsets[(name, value)]
+                labels = f'{label}="{value}"' if label else ""
+                if metric_type != self.HISTOGRAM:
+                    if value != self.OTHER or values[offset]:
+                        lines.append(f"{name}{{{labels}}} {self.format_value(values[offset])}" if labels
+                                     else f"{name} {self.format_value(values[offset])}")
+                    continue
+                if value == self.OTHER and not values[offset + len(buckets) + 2]:
+                    continue
+                separator = "," if labels else ""
+                cumulative = 0
+                for index, bound in enumerate(buckets + (float("inf"),)):
+                    cumulative += values[offset + index]
+                    bucket = "+Inf" if index == len(buckets) else self.format_value(bound)
+                    lines.append(f'{name}_bucket{{{labels}{separator}le="{bucket}"}} {self.format_value(cumulative)}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {self.format_value(values[offset + len(buckets) + 1])}")
+                lines.append(f"{name}_count{suffix} {self.format_value(values[offset + len(buckets) + 2])}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def format_value(value: float) -> str:
+        return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET /metrics with the metrics of the server, anything else is a 404
+    """
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != Constants.METRICS_PATH:
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", Constants.METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    """
+    Starts serving the metrics over plain HTTP in a daemon thread. It only listens on METRICS_HOST (the loopback
+    interface by default), the metrics aren't meant to be public
+
+    :param port: port number of the endpoint
+    :return: the running ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((Constants.METRICS_HOST, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+METRICS = Metrics()
@@ -0,0 +1,229 @@
+import os
+import time
+import stat
+import sqlite3
+import threading
+from .server_helper import Constants
+
+
+class PathIndex:
+    """
+    Class representing a persistent index of every file and directory under the served directory (the root),
+    used to answer find requests without walking the tree. It lives in a sqlite database, shared by every
+    process of the server, with one row per entry: its path relative to the root, type, size and
+    modification time.
+
+    The index is maintained incrementally: refresh() stats each indexed directory and only reads again the ones
+    whose modification time changed, which is what happens when entries are created, removed or renamed in them
+    (uploads included, since they're renamed to their final name). New directories are indexed as they're found,
+    and removed ones are dropped with everything inside them. Directories modified less than LIST_RACY_SECONDS
+    before they were read are read again on the next refresh, since a change made right after might not change
+    their modification time. Files modified in place don't change their directory, so their size and modification
+    time are updated when something else changes in the directory, or by the full refresh every
+    PATH_INDEX_FULL_REFRESH_SECONDS.
+
+    Changes are committed every PATH_INDEX_COMMIT_DIRECTORIES directories, so the first refresh of a big tree is
+    usable, and resumable, before it's done. Only a process refreshes at a time, the others wait for it
+    """
+    def __init__(self, database_path: str, root: str):
+        self.__database_path = database_path
+        self.__root = os.path.realpath(root)
+        self.__local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+        connection = self.__connection()
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, parent TEXT, name TEXT, "
+                           "type TEXT, size INTEGER, mtime INTEGER)")
+        connection.execute("CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)")
+        connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value)")
+        row = connection.execute("SELECT value FROM settings WHERE name = 'root'").fetchone()
+        if row is None or row[0] != self.__root:
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM directories")
+            connection.execute("INSERT OR REPLACE INTO settings VALUES ('root', ?), ('full_refresh', 0)",
+                               (self.__root,))
+            connection.execute("INSERT INTO directories VALUES ('', NULL)")
+        connection.execute("COMMIT")
+
+    @property
+    def root(self) -> str:
+        return self.__root
+
+    def __connection(self) -> sqlite3.Connection:
+        """
+        sqlite connections can't be shared between threads nor survive a fork, so each thread of each
+        process opens its own one the first time it needs it. Transactions are handled explicitly
+        """
+        if getattr(self.__local, "pid", None) != os.getpid():
+            self.__local.connection = sqlite3.connect(self.__database_path, timeout=Constants.PATH_INDEX_TIMEOUT_SECONDS,
+                                                      isolation_level=None)
+            self.__local.connection.execute("PRAGMA journal_mode=WAL")
+            self.__local.pid = os.getpid()
+        return self.__local.connection
+
+    def refresh(self) -> bool:
+        """
+        Brings the index up to date with the tree, reading again only the directories that changed
+
+        :return: False if the index couldn't be refreshed, because another process took longer than
+        PATH_INDEX_TIMEOUT_SECONDS refreshing it or the database isn't available. It can still be searched,
+        with what it has
+        """
+        connection = self.__connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error:
+            return False
+        try:
+            settings = dict(connection.execute("SELECT name, value FROM settings").fetchall())
+            now = time.time()
+            if now - settings["full_refresh"] >= Constants.PATH_INDEX_FULL_REFRESH_SECONDS:
+                connection.execute("UPDATE settings SET value = ? WHERE name = 'full_refresh'", (now,))
+                connection.execute("UPDATE directories SET mtime_ns = NULL")
+
+            pending = []
+            for path, mtime_ns in connection.execute("SELECT path, mtime_ns FROM directories").fetchall():
+                try:
+                    stat_result = os.stat(self.__absolute(path), follow_symlinks=False)
+                except OSError:
+                    stat_result = None
+                if stat_result is None or not stat.S_ISDIR(stat_result.st_mode):
+                    if path:
+                        self.__remove(connection, path)
+                elif stat_result.st_mtime_ns != mtime_ns:
+                    pending.append(path)
+
+            scanned = 0
+            while pending:
+                pending.extend(self.__scan(connection, pending.pop()))
+                scanned += 1
+                if scanned % Constants.PATH_INDEX_COMMIT_DIRECTORIES == 0:
+                    connection.execute("COMMIT")
+                    connection.execute("BEGIN IMMEDIATE")
+            connection.execute("COMMIT")
+            return True
+        except sqlite3.Error:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            return False
+
+    def search(self, directory: str, pattern: str, min_size: int = None, max_size: int = None, min_mtime: int = None,
+               max_mtime: int = None, limit: int = Constants.FIND_DEFAULT_LIMIT) -> tuple:
+        """
+        Looks for the entries under a directory that match a glob pattern (*, ? and [...], as in sqlite GLOB,
+        where * also matches /). Patterns without / are matched against the name of the entries, and patterns
+        with / against their path relative to the directory
+
+        :param directory: absolute path to the directory to search, inside the root
+        :param pattern: glob pattern
+        :param min_size: minimum size in bytes, directories are left out when it's given
+        :param max_size: maximum size in bytes, directories are left out when it's given
+        :param min_mtime: minimum modification time, in seconds since the epoch
+        :param max_mtime: maximum modification time, in seconds since the epoch
+        :param limit: maximum number of results
+        :return: a tuple with a list of [absolute path, type, size, mtime], sorted by path, and True if there
+        were more results than the limit
+        :raises ValueError: if the directory isn't inside the root or the index can't be read
+        """
+        prefix = self.__relative(directory)
+        conditions, parameters = [], []
+        if prefix:
+            conditions.append("path > ? AND path < ?")
+            parameters += [prefix + "/", prefix + "0"]
+        if "/" in pattern:
+            conditions.append("path GLOB ?")
+            parameters.append(f"{self.__escape(prefix)}/{pattern}" if prefix else pattern)
+        else:
+            conditions.append("name GLOB ?")
+            parameters.append(pattern)
+        for condition, value in (("size >= ?", min_size), ("size <= ?", max_size), ("mtime >= ?", min_mtime),
+                                 ("mtime <= ?", max_mtime)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        if min_size is not None or max_size is not None:
+            conditions.append("type != ?")
+            parameters.append(Constants.LIST_DIRECTORY)
+
+        try:
+            rows = self.__connection().execute(f"SELECT path, type, size, mtime FROM entries WHERE {' AND '.join(conditions)} "
+                                               "ORDER BY path LIMIT ?", parameters + [limit + 1]).fetchall()
+        except sqlite3.Error:
+            raise ValueError(Constants.PATH_INDEX_UNAVAILABLE)
+        return [[self.__absolute(path), entry_type, size, mtime] for path, entry_type, size, mtime in rows[:limit]], len(rows) > limit
+
+    def __scan(self, connection: sqlite3.Connection, path: str) -> list:
+        """
+        Reads a directory again, replacing its entries, and drops the subdirectories that aren't there anymore
+
+        :return: relative paths of the subdirectories that weren't indexed yet
+        """
+        started = time.time_ns()
+        rows, directories = [], set()
+        try:
+            mtime_ns = os.stat(self.__absolute(path), follow_symlinks=False).st_mtime_ns
+        except OSError:
+            if path:
+                self.__remove(connection, path)
+            return []
+        try:
+            with os.scandir(self.__absolute(path)) as iterator:
+                for entry in iterator:
+                    try:
+                        stat_result = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    relative_path = f"{path}/{entry.name}" if path else entry.name
+                    if stat.S_ISDIR(stat_result.st_mode):
+                        entry_type = Constants.LIST_DIRECTORY
+                        directories.add(relative_path)
+                    elif stat.S_ISLNK(stat_result.st_mode):
+                        entry_type = Constants.LIST_LINK
+                    else:
+                        entry_type = Constants.LIST_FILE
+                    rows.append((relative_path, path, entry.name, entry_type, stat_result.st_size, int(stat_result.st_mtime)))
+        except OSError:
+            pass
+
+        indexed = {row[0] for row in connection.execute("SELECT path FROM entries WHERE parent = ? AND type = ?",
+                                                         (path, Constants.LIST_DIRECTORY))}
+        for removed in indexed - directories:
+            self.__remove(connection, removed)
+        connection.execute("DELETE FROM entries WHERE parent = ?", (path,))
+        connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+        if mtime_ns is not None and mtime_ns >= started - Constants.LIST_RACY_SECONDS * 10 ** 9:
+            mtime_ns = None
+        connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (path, mtime_ns))
+        new_directories = [directory for directory in sorted(directories - indexed)
+                           if connection.execute("SELECT 1 FROM directories WHERE path = ?", (directory,)).fetchone() is None]
+        connection.executemany("INSERT INTO directories VALUES (?, NULL)", [(directory,) for directory in new_directories])
+        return new_directories
+
+    @staticmethod
+    def __remove(connection: sqlite3.Connection, path: str) -> None:
+        """
+        Drops a directory and everything inside it from the index. Paths inside it sort between "path/" and
+        "path0", since "0" is the character after "/"
+        """
+        for table in ("entries", "directories"):
+            connection.execute(f"DELETE FROM {table} WHERE path = ? OR (path > ? AND path < ?)", (path, path + "/", path + "0"))
+
+    @staticmethod
+    def __escape(path: str) -> str:
+        """
+        Escapes the characters GLOB gives a meaning to, so a path can be used as the literal start of a pattern
+        """
+        return "".join(f"[{character}]" if character in "*?[" else character for character in path)
+
+    def __absolute(self, path: str) -> str:
+        return os.path.join(self.__root, path) if path else self.__root
+
+    def __relative(self, directory: str) -> str:
+        directory = os.path.realpath(directory)
+        if directory == self.__root:
+            return ""
+        if not directory.startswith(self.__root.rstrip(os.sep) + os.sep):
+            raise ValueError(Constants.FIND_OUTSIDE_ROOT)
+        return os.path.relpath(directory, self.__root)
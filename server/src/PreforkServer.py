@@ -0,0 +1,156 @@
+import os
+import time
+import signal
+import logging
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+from .AsyncServer import AsyncServer
+from .EventLog import EVENT_LOG
+from .server_helper import Constants
+
+
+class PreforkServer:
+    """
+    Class representing the pre-forked flavour of the server. The master process forks a fixed number of
+    workers up front (one per core by default). Each worker runs an AsyncServer that owns its own
+    SO_REUSEPORT listeners on both the main and the transfer port, so the kernel spreads the accepted
+    connections across the workers and the master never accepts, wraps or forks on a connection.
+
+    The master only supervises: a worker that dies is replaced, and a SIGHUP triggers a rolling restart,
+    where every worker is replaced by a new one once the new one is listening. Retired workers stop
+    accepting and get WORKER_DRAIN_SECONDS to finish their sessions and transfers. Workers that die before
+    running WORKER_STABLE_SECONDS are replaced with a backoff, doubled each time up to WORKER_RESPAWN_MAX_SECONDS,
+    so a worker that can't start (the port is taken, the certificate is gone...) doesn't make the master fork
+    in a loop.
+    """
+    def __init__(self, context, main_port: int, transfer_port: int, tickets, checksum_cache, directory_index, path_index,
+                 content_store, scheduler, committer, root, workers: int):
+        self.__context = context
+        self.__main_port = main_port
+        self.__transfer_port = transfer_port
+        self.__tickets = tickets
+        self.__checksum_cache = checksum_cache
+        self.__directory_index = directory_index
+        self.__path_index = path_index
+        self.__content_store = content_store
+        self.__scheduler = scheduler
+        self.__committer = committer
+        self.__root = root
+        self.__workers_count = workers
+        self.__workers = []
+        self.__retiring = []
+        self.__started = {}
+        self.__respawns = []
+        self.__respawn_delay = 0
+        self.__restart_requested = False
+
+    def serve_forever(self) -> None:
+        """
+        Master loop. It forks the workers and then waits for them to exit or for a restart request
+
+        :return: None
+        """
+        signal.signal(signal.SIGHUP, self.request_restart)
+        for _ in range(self.__workers_count):
+            self.__spawn_worker()
+        print(f"{Constants.LISTENING_TRANSFERS} {self.__transfer_port}")
+        print(f"{Constants.PREFORK_WORKERS} {self.__workers_count}")
+        print('Waiting for connections...')
+
+        while True:
+            sentinels = {process.sentinel: process for process in self.__workers + self.__retiring}
+            timeout = Constants.PREFORK_POLL_SECONDS
+            if self.__respawns:
+                timeout = max(0, min(timeout, self.__respawns[0] - time.monotonic()))
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=timeout):
+                self.__reap(sentinels[sentinel])
+            while self.__respawns and self.__respawns[0] <= time.monotonic():
+                self.__respawns.pop(0)
+                self.__spawn_worker()
+            if self.__restart_requested:
+                self.__restart_requested = False
+                self.rolling_restart()
+
+    def request_restart(self, signum, frame) -> None:
+        """
+        SIGHUP handler. The restart itself happens in the master loop, not inside the handler
+
+        :param signum: signal number
+        :param frame: current stack frame
+        :return: None
+        """
+        self.__restart_requested = True
+
+    def rolling_restart(self) -> None:
+        """
+        Replaces the workers one by one. Each new worker is started and the old one is only asked to stop once
+        the new one opened its listeners, so the ports are never left without a listener. If a new worker isn't
+        listening after HANDSHAKE_TIMEOUT_SECONDS, it's stopped and the restart is given up, keeping the old
+        workers that are left
+
+        :return: None
+        """
+        EVENT_LOG.event("restarting", f"Restarting {len(self.__workers)} workers", "YELLOW", workers=len(self.__workers))
+        for old_worker in list(self.__workers):
+            new_worker, ready = self.__spawn_worker()
+            if not ready.wait(Constants.HANDSHAKE_TIMEOUT_SECONDS):
+                self.__workers.remove(new_worker)
+                self.__retiring.append(new_worker)
+                new_worker.terminate()
+                EVENT_LOG.event("restart_failed", f"Worker {new_worker.pid} didn't start, restart given up", "RED",
+                                logging.WARNING, worker=new_worker.pid)
+                return
+            self.__workers.remove(old_worker)
+            self.__retiring.append(old_worker)
+            old_worker.terminate()
+
+    def __spawn_worker(self) -> tuple:
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=self.run_worker, args=(ready,), daemon=True)
+        process.start()
+        self.__workers.append(process)
+        self.__started[process] = time.monotonic()
+        return process, ready
+
+    def __reap(self, process: multiprocessing.Process) -> None:
+        process.join()
+        started = self.__started.pop(process, None)
+        if process in self.__retiring:
+            self.__retiring.remove(process)
+            return
+
+        self.__workers.remove(process)
+        if started is not None and time.monotonic() - started >= Constants.WORKER_STABLE_SECONDS:
+            self.__respawn_delay = 0
+        else:
+            self.__respawn_delay = min(max(2 * self.__respawn_delay, Constants.WORKER_RESPAWN_MIN_SECONDS),
+                                       Constants.WORKER_RESPAWN_MAX_SECONDS)
+        EVENT_LOG.event("worker_exited", f"Worker {process.pid} exited with code {process.exitcode}, replacing it in "
+                        f"{self.__respawn_delay} seconds", "RED", logging.WARNING, worker=process.pid,
+                        exit_code=process.exitcode, respawn_seconds=self.__respawn_delay)
+        self.__respawns.append(time.monotonic() + self.__respawn_delay)
+        self.__respawns.sort()
+
+    def run_worker(self, ready) -> None:
+        """
+        Worker entry point, running in the forked process
+
+        :param ready: multiprocessing.Event set once the worker listeners are open
+        :return: None
+        """
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        server = AsyncServer(self.__context, self.__main_port, self.__transfer_port, self.__tickets,
+                             self.__checksum_cache, self.__directory_index, self.__path_index, self.__content_store,
+                             self.__scheduler, self.__committer, self.__root, reuse_port=True)
+        asyncio.run(self.__worker_main(server, ready))
+
+    @staticmethod
+    async def __worker_main(server: AsyncServer, ready) -> None:
+        stopping = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        await server.start()
+        ready.set()
+        await stopping.wait()
+        await server.shutdown(Constants.WORKER_DRAIN_SECONDS)
+        EVENT_LOG.event("worker_stopped", f"Worker {os.getpid()} stopped", "PURPLE", worker=os.getpid())
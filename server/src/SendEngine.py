@@ -0,0 +1,112 @@
+import os
+import ssl
+import socket
+from .server_helper import Constants, compressor
+
+
+class SendEngine:
+    """
+    Class representing the strategy used to push a file through a transfer socket. The path is picked
+    once per connection, when the instance is created:
+    - 'sendfile': plain TCP socket, the kernel copies the file straight into the socket with os.sendfile()
+    - 'ktls-sendfile': TLS socket with kernel TLS offload active, so os.sendfile() can still be used and
+    encryption happens in the kernel
+    - 'buffered': TLS done in user space, or a stream of a TransferChannel, which isn't a real socket. The file
+    is read into one large reusable buffer and sent with sendall(), which keeps the number of Python iterations
+    and syscalls low on big files
+    - a codec name ('zlib', 'bz2' or 'lzma'): the transfer is compressed, so the file goes through the
+    buffered path and each chunk is compressed before being sent
+
+    If a TransferTicket of a rate limited client is given, the file is sent in the chunks it allows, waiting
+    before each one (sendfile included, a chunk per call).
+
+    wire_bytes counts the bytes that actually went through the socket
+    """
+    SENDFILE = "sendfile"
+    KTLS_SENDFILE = "ktls-sendfile"
+    BUFFERED = "buffered"
+
+    def __init__(self, transfer_socket, compression: tuple = None, ticket=None):
+        self.__socket = transfer_socket
+        self.__ticket = ticket if ticket is not None and ticket.limited else None
+        self.__compressor = compressor(*compression) if compression is not None else None
+        self.__path = compression[0] if compression is not None else self.select_path(transfer_socket)
+        self.wire_bytes = 0
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @staticmethod
+    def select_path(transfer_socket) -> str:
+        """
+        Checks what the platform and the given connection offer and returns the fastest usable path
+
+        :param transfer_socket: socket (or SSLSocket) where the file is going to be sent
+        :return: one of SendEngine.SENDFILE, SendEngine.KTLS_SENDFILE or SendEngine.BUFFERED
+        """
+        if not hasattr(os, "sendfile") or not isinstance(transfer_socket, socket.socket):
+            return SendEngine.BUFFERED
+        if not isinstance(transfer_socket, ssl.SSLSocket):
+            return SendEngine.SENDFILE
+
+        ssl_object = getattr(transfer_socket, "_sslobj", None)
+        uses_ktls_for_send = getattr(ssl_object, "uses_ktls_for_send", None)
+        if uses_ktls_for_send is not None and uses_ktls_for_send():
+            return SendEngine.KTLS_SENDFILE
+        return SendEngine.BUFFERED
+
+    def send(self, file, offset: int = 0, count: int = None) -> int:
+        """
+        Sends count bytes of the given file (or until EOF if count is None) starting at offset
+
+        :param file: file object opened in binary-read mode
+        :param offset: position in the file where the send starts
+        :param count: amount of bytes to send, None means until EOF
+        :return: number of bytes sent
+        """
+        if self.__path == SendEngine.BUFFERED or self.__compressor is not None:
+            return self.__send_buffered(file, offset, count)
+        if self.__ticket is None:
+            sent = self.__socket.sendfile(file, offset, count)
+            self.wire_bytes += sent
+            return sent
+
+        total_sent = 0
+        while count is None or total_sent < count:
+            size = self.__ticket.limit(Constants.SEND_BUFFER_SIZE if count is None else min(Constants.SEND_BUFFER_SIZE, count - total_sent))
+            self.__ticket.wait(size)
+            sent = self.__socket.sendfile(file, offset + total_sent, size)
+            if not sent:
+                break
+            total_sent += sent
+        self.wire_bytes += total_sent
+        return total_sent
+
+    def __send_buffered(self, file, offset: int, count: int = None) -> int:
+        buffer = bytearray(Constants.SEND_BUFFER_SIZE)
+        view = memoryview(buffer)
+        total_sent = 0
+        file.seek(offset)
+        while count is None or total_sent < count:
+            to_read = Constants.SEND_BUFFER_SIZE if count is None else min(Constants.SEND_BUFFER_SIZE, count - total_sent)
+            if self.__ticket is not None:
+                to_read = self.__ticket.limit(to_read)
+            bytes_read = file.readinto(view[:to_read])
+            if not bytes_read:
+                break
+            if self.__ticket is not None:
+                self.__ticket.wait(bytes_read)
+            self.__write(view[:bytes_read])
+            total_sent += bytes_read
+        if self.__compressor is not None:
+            tail = self.__compressor.flush()
+            self.__socket.sendall(tail)
+            self.wire_bytes += len(tail)
+        return total_sent
+
+    def __write(self, data) -> None:
+        if self.__compressor is not None:
+            data = self.__compressor.compress(data)
+        self.__socket.sendall(data)
+        self.wire_bytes += len(data)
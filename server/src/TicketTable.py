@@ -0,0 +1,133 @@
+import hmac
+import json
+import time
+import struct
+import secrets
+import multiprocessing
+from .server_helper import Constants
+from .Metrics import METRICS
+
+
+class TicketTable:
+    """
+    Class representing the transfer tickets issued by the server. When a command allows a transfer, the server
+    issues a ticket that binds the operation and the path (and, for downloads, the size and the checksum it
+    answered with), and the client only gets the ticket's token. The transfer connection presents the token,
+    and the transfer is done with the fields of the ticket, whatever else the request says, so a client can't
+    make the transfer port read or write a path it wasn't allowed to. Tickets are single use, except the
+    ones of transfers that take several connections (range downloads and directory transfers), which can be
+    used until they go TICKET_TTL_SECONDS without being used. Unused tickets expire after TICKET_TTL_SECONDS.
+
+    The table lives in a shared memory array, created before the server forks, like the metrics, so a ticket
+    issued by the process of a client (process mode) or by a worker (prefork mode) can be redeemed by any other
+    process. It has TICKET_SLOTS slots of TICKET_SLOT_SIZE bytes. The token says which slot its ticket is in, so
+    looking it up doesn't search the table. Live tickets are never evicted: if every slot holds one, no ticket is
+    issued until one is used or expires. Each session can hold TICKET_SESSION_QUOTA live tickets (see live()),
+    enough for a full batch, and the table has room for several sessions doing that at once
+    """
+    HEADER = struct.Struct(Constants.TICKET_SLOT_HEADER)
+
+    def __init__(self, slots: int = Constants.TICKET_SLOTS, slot_size: int = Constants.TICKET_SLOT_SIZE):
+        self.__slots = slots
+        self.__slot_size = slot_size
+        self.__table = multiprocessing.RawArray("c", slots * slot_size)
+        self.__next = multiprocessing.RawValue("I", 0)
+        self.__lock = multiprocessing.Lock()
+
+    def issue(self, fields: dict, reusable: bool = False) -> str:
+        """
+        Issues a ticket
+
+        :param fields: the fields of the transfer request the ticket binds, like operation and absolute_path
+        :param reusable: True if the ticket can be used by several connections
+        :return: the ticket's token, which the client sends in its transfer requests
+        :raises ValueError: if the fields don't fit in a slot, or every slot holds a live ticket
+        """
+        payload = json.dumps(fields).encode()
+        if self.HEADER.size + len(payload) > self.__slot_size:
+            raise ValueError(Constants.TICKET_TOO_BIG)
+        secret = secrets.token_bytes(Constants.TICKET_SECRET_BYTES)
+        now = time.monotonic()
+        with self.__lock:
+            index = self.__free_slot(now)
+            if index is None:
+                METRICS.inc(Constants.TRANSFER_TICKETS, label="refused")
+                raise ValueError(Constants.TICKET_TABLE_FULL)
+            offset = index * self.__slot_size
+            self.HEADER.pack_into(self.__table, offset, secret, now + Constants.TICKET_TTL_SECONDS, reusable, len(payload))
+            self.__table[offset + self.HEADER.size:offset + self.HEADER.size + len(payload)] = payload
+        METRICS.inc(Constants.TRANSFER_TICKETS, label="issued")
+        return f"{index}.{secret.hex()}"
+
+    def redeem(self, token) -> dict:
+        """
+        Uses a ticket. Single use tickets are removed from the table
+
+        :param token: the token the client sent
+        :return: the fields of the ticket, or None if the token isn't valid, or its ticket expired or was used
+        """
+        return self.__lookup(token, consume=True)
+
+    def check(self, token) -> bool:
+        """
+        :return: True if the token belongs to a live ticket, without using it. Opening a transfer channel needs
+        one, and each of its streams redeems its own
+        """
+        return self.__lookup(token, consume=False) is not None
+
+    def live(self, tokens: list) -> list:
+        """
+        :param tokens: tokens issued before, like the ones of a session
+        :return: the ones whose ticket is still live, which haven't been used (single use tickets) or expired.
+        Used to enforce the quota of a session, so it's not counted as rejected tickets
+        """
+        now = time.monotonic()
+        alive = []
+        with self.__lock:
+            for token in tokens:
+                index, secret = token.split(".")
+                stored, expires = self.HEADER.unpack_from(self.__table, int(index) * self.__slot_size)[:2]
+                if expires >= now and hmac.compare_digest(stored, bytes.fromhex(secret)):
+                    alive.append(token)
+        return alive
+
+    def __lookup(self, token, consume: bool):
+        try:
+            index, secret = str(token).split(".")
+            index, secret = int(index), bytes.fromhex(secret)
+            if not 0 <= index < self.__slots:
+                raise ValueError()
+        except ValueError:
+            METRICS.inc(Constants.TRANSFER_TICKETS, label="rejected")
+            return None
+        offset = index * self.__slot_size
+        now = time.monotonic()
+        with self.__lock:
+            stored, expires, reusable, length = self.HEADER.unpack_from(self.__table, offset)
+            if expires < now or not hmac.compare_digest(stored, secret):
+                fields = None
+            else:
+                fields = self.__table[offset + self.HEADER.size:offset + self.HEADER.size + length]
+                if consume and reusable:
+                    self.HEADER.pack_into(self.__table, offset, stored, now + Constants.TICKET_TTL_SECONDS, reusable, length)
+                elif consume:
+                    self.HEADER.pack_into(self.__table, offset, bytes(Constants.TICKET_SECRET_BYTES), 0, False, 0)
+        if fields is None:
+            METRICS.inc(Constants.TRANSFER_TICKETS, label="rejected")
+            return None
+        if consume:
+            METRICS.inc(Constants.TRANSFER_TICKETS, label="redeemed")
+        return json.loads(fields)
+
+    def __free_slot(self, now: float) -> int:
+        """
+        Finds a slot without a live ticket, starting where the last search stopped. Must be called with the lock held
+
+        :return: the slot's index, or None if every slot holds a live ticket
+        """
+        for step in range(self.__slots):
+            index = (self.__next.value + step) % self.__slots
+            if self.HEADER.unpack_from(self.__table, index * self.__slot_size)[1] < now:
+                self.__next.value = (index + 1) % self.__slots
+                return index
+        return None
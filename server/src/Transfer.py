@@ -1,85 +1,332 @@
-import socket
 import json
-import os
-from .server_helper import print_colored, Constants, calculate_checksum
+import logging
+import time
+import threading
+from .server_helper import Constants
+from .SendEngine import SendEngine
+from .TransferProtocol import TransferAdmission, FileDownload, FileUpload, DeltaUpload, PackDownload, PackUpload, manifest_size
+from .TransferChannel import TransferChannel, ChannelStream
+from .Metrics import METRICS
+from .EventLog import EVENT_LOG
 
 
 class Transfer:
     """
-    Class representing a file transfer from the server point of view. An instance of this
-    class is created each time a client connects to the transfers socket. It will check if
-    the transfer is valid and can happen, and if everything is ok, send or receive the file.
-
+    Class representing a file transfer from the server point of view. An instance of this class is created each
+    time a client connects to the transfers socket. It will check if the transfer is valid and can happen, and if
+    everything is ok, send or receive the file. Transfers are only done with a ticket (see TicketTable), and the
+    operation and path are the ones the ticket binds, not the ones the request says, and the path must still be
+    inside the served root when the transfer starts. Transfers wait for a slot of the TransferScheduler before
+    starting, and send and receive at the pace of their client's rate limit. Bytes, queue time and duration go to
+    the metrics, and to the log, with the id of the transfer.
     """
-    def __init__(self, transfer_socket, client_address, token):
+    def __init__(self, transfer_socket, client_address, tickets, checksum_cache, content_store, scheduler, committer, root):
         self.__transfer_socket = transfer_socket
         self.__client_address = client_address
-        self.__token = token
+        self.__tickets = tickets
+        self.__checksum_cache = checksum_cache
+        self.__content_store = content_store
+        self.__scheduler = scheduler
+        self.__committer = committer
+        self.__root = root
+        self.__ticket = None
+        self.__operation = None
         self.__transfer_socket.settimeout(Constants.TRANSFERS_TIMEOUT_SECONDS)
 
     def begin(self) -> None:
         """
-        Main Transfer method. It will check the security token, and if valid, delegates
-        the transfer to send_file() or receive_file() depending on what client is asking to do.
-        If token is not valid, it will immediately close the connection and exit
+        Main Transfer method. It will redeem the ticket of the request, and if valid, delegates
+        the transfer to send_file() or receive_file() depending on what the ticket allows.
+        If the ticket is not valid, it will immediately close the connection and exit. Channels only need
+        a valid ticket, without using it, and don't take a slot of the scheduler, each of their streams does
         :return:
         """
         try:
             transfer_request = json.loads(self.__transfer_socket.recv(Constants.BUFFER_SIZE).decode())
-            if not transfer_request["token"] == self.__token:
+            if transfer_request.get("operation") == "channel":
+                if not self.__tickets.check(transfer_request.get("token")):
+                    self.reject(transfer_request)
+                    return
+                self.serve_channel()
+                return
+            ticket_fields = self.__tickets.redeem(transfer_request.get("token"))
+            if ticket_fields is None:
+                self.reject(transfer_request)
+                return
+            transfer_request.update(ticket_fields)
+            if not self.__root.encloses(transfer_request["absolute_path"]):
+                self.reject(transfer_request, Constants.OUTSIDE_ROOT)
+                return
+            self.__ticket = self.wait_for_slot(transfer_request)
+            if self.__ticket is None:
                 self.__transfer_socket.close()
                 return
-            elif transfer_request["operation"] == "get":
-                self.send_file(transfer_request)
-            elif transfer_request["operation"] == "put":
-                self.__transfer_socket.send(Constants.READY_FLAG)
-                self.receive_file(transfer_request)
-        except (socket.timeout, json.decoder.JSONDecodeError):
+            self.__operation = transfer_request["operation"]
+            started = time.perf_counter()
+            try:
+                if transfer_request["operation"] == "get":
+                    self.send_file(transfer_request)
+                elif transfer_request["operation"] == "put":
+                    self.receive_file(transfer_request)
+                elif transfer_request["operation"] == "delta":
+                    self.receive_delta(transfer_request)
+                elif transfer_request["operation"] == "get_tree":
+                    self.send_pack(transfer_request)
+                elif transfer_request["operation"] == "put_tree":
+                    self.receive_pack(transfer_request)
+            finally:
+                self.__scheduler.release(self.__ticket)
+                METRICS.observe(Constants.TRANSFER_DURATION, time.perf_counter() - started, self.__operation)
+        except (OSError, json.decoder.JSONDecodeError, ValueError, AttributeError, KeyError):  # socket.timeout is an OSError
             self.__transfer_socket.close()
             return
 
+    def reject(self, transfer_request: dict, reason: str = Constants.INVALID_TICKET) -> None:
+        """
+        Closes a transfer connection whose ticket isn't valid (unknown, expired or already used), or whose path
+        was moved outside the served root since the ticket was issued. Clients that understand the queue flags
+        are sent the rejected flag first, so they can tell it from a dropped connection and ask for the transfer
+        again
+
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :param reason: why the transfer is rejected, for the log
+        """
+        EVENT_LOG.event("rejected", f"REJECTED transfer from {self.__client_address}, {reason}", "RED", logging.WARNING,
+                        client=self.__client_address, reason=reason)
+        if transfer_request.get("queue"):
+            self.__transfer_socket.sendall(Constants.REJECTED_FLAG)
+        self.__transfer_socket.close()
+
+    def wait_for_slot(self, transfer_request: dict):
+        """
+        Queues the transfer in the scheduler and waits until it's admitted. If the request has "queue", the
+        client is sent the queued flag every TRANSFER_QUEUE_NOTICE_SECONDS while it waits, which also tells
+        when the client is gone, and the admitted flag once the transfer can start. Clients that don't
+        understand the flags are given up on after TRANSFER_QUEUE_TIMEOUT_SECONDS (see TransferAdmission)
+
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :return: the TransferTicket of the admitted transfer, or None if it was given up on
+        """
+        admitted = threading.Event()
+        admission = TransferAdmission(self.__scheduler, self.__client_address, transfer_request, admitted.set)
+        try:
+            while not admitted.wait(Constants.TRANSFER_QUEUE_NOTICE_SECONDS):
+                self.__transfer_socket.sendall(admission.notice())
+            self.__transfer_socket.sendall(admission.admit())
+        except OSError:  # TimeoutError too
+            admission.give_up()
+            return None
+        return admission.ticket
+
     def send_file(self, transfer_request: dict) -> None:
         """
-        Handles a file send to the associated client's socket. It will open the file in binary-read mode,
-        read chunks of 4096 bytes and send them to the client. When it's done reading the file and sending
-        it, it will close the connection and exit. This will send an EOF to the client side
-        after he receives the last byte of the file.
+        Handles a file send to the associated client's socket (see FileDownload). It will open the file in
+        binary-read mode and hand it to a SendEngine, which picks the fastest path available for this connection
+        (zero-copy sendfile, kernel TLS sendfile or a large-buffer fallback). When it's done sending the file, it
+        will close the connection and exit. This will send an EOF to the client side after he receives the last
+        byte of the file
+
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :return: None
+        """
+        download = FileDownload(transfer_request, self.__client_address, self.__ticket)
+        engine = SendEngine(self.__transfer_socket, download.compression, self.__ticket)
+        try:
+            with open(download.path, "rb") as file:
+                sent = engine.send(file, download.offset, download.length)
+        finally:
+            METRICS.inc(Constants.BYTES_SENT, engine.wire_bytes, "get")
+            self.__ticket.sent += engine.wire_bytes
+        download.finish(sent, engine.wire_bytes, engine.path)
+        self.__transfer_socket.close()
+
+    def receive_file(self, transfer_request: dict) -> None:
+        """
+        Handles a file receive from the associated client's socket, following the protocol of a FileUpload.
+        Chunks are received until EOF, straight into a buffer of RECEIVE_BUFFER_SIZE bytes that is reused for
+        every chunk
+
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :return: None
+        """
+        upload = FileUpload(transfer_request, self.__client_address, self.__ticket, self.__checksum_cache,
+                            self.__content_store, self.__committer)
+        if not upload.prepare():
+            self.__transfer_socket.close()
+            return
+        if upload.deduplicate():
+            self.__transfer_socket.send(Constants.DEDUP_FLAG)
+            self.__transfer_socket.close()
+            return
+        if not upload.open():
+            self.__transfer_socket.close()
+            return
+
+        buffer = memoryview(bytearray(Constants.receive_buffer_size()))
+        self.__transfer_socket.send(Constants.READY_FLAG)
+        try:
+            while True:
+                size = self.receive_into(buffer)
+                if not size or not upload.feed(buffer[:size]):
+                    break
+        except OSError:  # socket errors and timeouts
+            pass
+        upload.finish()
+
+    def receive_delta(self, transfer_request: dict) -> None:
+        """
+        Handles a delta upload of a file the server already has, following the protocol of a DeltaUpload
 
         :param transfer_request: Dictionary with all the transfer's metadata
         :return: None
         """
-        file_path = transfer_request["absolute_path"]
-        with open(file_path, "rb") as file:
+        delta = DeltaUpload(transfer_request, self.__client_address, self.__ticket, self.__checksum_cache,
+                            self.__content_store, self.__committer)
+        if not delta.prepare():
+            self.__transfer_socket.close()
+            return
+        signature = delta.signature()
+        self.__transfer_socket.sendall(signature)
+        METRICS.inc(Constants.BYTES_SENT, len(signature), "delta")
+        self.__ticket.sent += len(signature)
+        delta.open()
+        try:
             while True:
-                bytes_read = file.read(Constants.FILE_BUFFER_SIZE)
-                if not bytes_read:
+                data = self.receive_chunk(Constants.STREAM_BUFFER_SIZE)
+                if not data or delta.feed(data):
                     break
-                self.__transfer_socket.sendall(bytes_read)
+        except OSError:
+            pass
+        delta.finish()
+
+    def receive_manifest(self, transfer_request: dict) -> bytes:
+        """
+        Sends the start flag and reads the manifest of a pack, which follows the transfer request and can be
+        too big for a single read. Its size comes in the request's "manifest_size"
+
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :return: the json-formatted manifest
+        :raises ValueError: if the manifest size isn't valid or the connection is closed before it arrives
+        """
+        size = manifest_size(transfer_request)
+        self.__transfer_socket.send(Constants.READY_FLAG)
+        data = bytearray()
+        while len(data) < size:
+            bytes_read = self.__transfer_socket.recv(min(size - len(data), Constants.STREAM_BUFFER_SIZE))
+            if not bytes_read:
+                raise ValueError(Constants.INVALID_PACK)
+            data += bytes_read
+        return bytes(data)
 
-        print_colored(color="PURPLE", message=f"{Constants.date_time()} TRANSMITTED {file_path} to {self.__client_address}")
+    def send_pack(self, transfer_request: dict) -> None:
+        """
+        Handles a pack download, a part of a recursive get, following the protocol of a PackDownload
+
+        :param transfer_request: Dictionary with all the transfer's metadata
+        :return: None
+        """
+        pack = PackDownload(transfer_request, self.__client_address, self.__ticket)
+        pack.start(self.receive_manifest(transfer_request))
+        try:
+            for chunk in pack.chunks():
+                self.send_chunk(chunk)
+        except OSError:
+            pass
+        pack.finish()
         self.__transfer_socket.close()
 
-    def receive_file(self, transfer_request: dict) -> None:
+    def receive_pack(self, transfer_request: dict) -> None:
         """
-        Handles a file receive from the associated client's socket. It will open the file in binary-write
-        mode, read chunks of 4096 bytes from the client's socket and write them to the file.
-        When EOF is reached (client done transmitting), it will flush the file and exit
+        Handles a pack upload, a part of a recursive put, following the protocol of a PackUpload
 
         :param transfer_request: Dictionary with all the transfer's metadata
         :return: None
         """
-        file_path = transfer_request["absolute_path"]
-        with open(file_path, "wb") as file:
+        pack = PackUpload(transfer_request, self.__client_address, self.__ticket, self.__committer)
+        self.__transfer_socket.sendall(pack.start(self.receive_manifest(transfer_request)))
+        try:
+            while not pack.finished:
+                data = self.receive_chunk(Constants.STREAM_BUFFER_SIZE)
+                if not data or pack.feed(data):
+                    break
+        except OSError:
+            pass
+        finally:
+            summary = pack.finish()
+        if summary:
+            self.__transfer_socket.sendall(summary)
+        self.__transfer_socket.close()
+
+    def serve_channel(self) -> None:
+        """
+        Turns this transfer connection into a TransferChannel: the start flag is sent, and from then on the
+        connection carries frames of many file streams, each one served by a Transfer of its own in a thread,
+        until the client closes it or it's idle for CHANNEL_IDLE_TIMEOUT_SECONDS. Channels can't be nested
+
+        :return: None
+        """
+        if isinstance(self.__transfer_socket, ChannelStream):
+            self.__transfer_socket.close()
+            return
+        lock = threading.Lock()
+
+        def send(frame: bytes) -> None:
+            with lock:
+                self.__transfer_socket.sendall(frame)
+
+        channel = TransferChannel(send, lambda stream: Transfer(stream, self.__client_address, self.__tickets, self.__checksum_cache,
+                                                                    self.__content_store, self.__scheduler, self.__committer,
+                                                                    self.__root).begin())
+        self.__transfer_socket.settimeout(Constants.CHANNEL_IDLE_TIMEOUT_SECONDS)
+        self.__transfer_socket.sendall(Constants.READY_FLAG)
+        try:
             while True:
-                bytes_read = self.__transfer_socket.recv(Constants.FILE_BUFFER_SIZE)
-                if not bytes_read:
+                data = self.__transfer_socket.recv(Constants.STREAM_BUFFER_SIZE)
+                if not data:
                     break
-                file.write(bytes_read)
+                channel.feed(data)
+        except (OSError, ValueError):
+            pass
+        finally:
+            channel.shutdown()
+            self.__transfer_socket.close()
 
-        is_authentic = calculate_checksum(file_path) == transfer_request["sha256sum"]
-        if is_authentic:
-            print_colored(color="YELLOW", message=f"{Constants.date_time()} RECEIVED {file_path} from {self.__client_address}")
-        else:
-            os.remove(file_path)
+    def receive_chunk(self, size: int) -> bytes:
+        """
+        Receives at most size bytes, fewer if the client's rate limit asks for smaller chunks, and waits for
+        the client's token bucket afterwards. Not reading is what slows the client down
 
+        :param size: maximum amount of bytes to receive
+        :return: received bytes, empty once the client closed the connection
+        """
+        data = self.__transfer_socket.recv(self.__ticket.limit(size))
+        METRICS.inc(Constants.BYTES_RECEIVED, len(data), self.__operation)
+        self.__ticket.received += len(data)
+        self.__ticket.wait(len(data))
+        return data
+
+    def receive_into(self, buffer: memoryview) -> int:
+        """
+        Like receive_chunk(), but the bytes are received into buffer, so no new bytes object is created per chunk
 
+        :param buffer: writable memoryview, the maximum amount of bytes to receive is its size
+        :return: number of bytes received, 0 once the client closed the connection
+        """
+        size = self.__transfer_socket.recv_into(buffer, self.__ticket.limit(len(buffer)))
+        METRICS.inc(Constants.BYTES_RECEIVED, size, self.__operation)
+        self.__ticket.received += size
+        self.__ticket.wait(size)
+        return size
+
+    def send_chunk(self, data) -> None:
+        """
+        Sends data in the chunks the client's rate limit allows, waiting for the token bucket before each one
+        """
+        view = memoryview(data)
+        while view:
+            size = self.__ticket.limit(len(view))
+            self.__ticket.wait(size)
+            self.__transfer_socket.sendall(view[:size])
+            METRICS.inc(Constants.BYTES_SENT, size, self.__operation)
+            self.__ticket.sent += size
+            view = view[size:]
@@ -0,0 +1,187 @@
+import queue
+import socket
+import struct
+import threading
+from .server_helper import Constants
+
+
+class ChannelStream:
+    """
+    Class representing a single file stream carried by a TransferChannel. It looks like a socket to the code
+    using it (recv, recv_into, send, sendall, settimeout and close), so a Transfer can serve a stream exactly like it
+    serves a transfer connection of its own.
+
+    Received data is queued by the channel as it arrives, up to CHANNEL_STREAM_FRAMES frames. If the stream
+    isn't read and its queue stays full for CHANNEL_STALL_SECONDS, the channel gives up on it and closes it,
+    so a stuck stream can't block the others
+    """
+    def __init__(self, channel, stream_id: int):
+        self.stream_id = stream_id
+        self.__channel = channel
+        self.__incoming = queue.Queue(maxsize=Constants.CHANNEL_STREAM_FRAMES)
+        self.__pending = memoryview(b"")
+        self.__timeout = None
+        self.__eof = False
+        self.__closed = False
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Queues data received for this stream, empty bytes meaning the other side closed it
+
+        :return: False if the stream was stalled and had to be closed
+        """
+        try:
+            self.__incoming.put(data, timeout=Constants.CHANNEL_STALL_SECONDS)
+            return True
+        except queue.Full:
+            self.close()
+            return False
+
+    def recv(self, size: int) -> bytes:
+        """
+        :param size: maximum amount of bytes to return
+        :return: received bytes, or empty bytes once the other side closed the stream
+        :raises socket.timeout: if nothing arrives before the stream's timeout
+        """
+        return bytes(self.__take(size))
+
+    def recv_into(self, buffer, nbytes: int = 0) -> int:
+        """
+        Like recv(), but copies the bytes into buffer instead of returning new ones
+
+        :param buffer: writable bytes-like object, like a bytearray or a memoryview of one
+        :param nbytes: maximum amount of bytes to copy, 0 for the size of buffer
+        :return: number of bytes copied, 0 once the other side closed the stream
+        :raises socket.timeout: if nothing arrives before the stream's timeout
+        """
+        view = self.__take(nbytes or len(buffer))
+        buffer[:len(view)] = view
+        return len(view)
+
+    def send(self, data) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data) -> None:
+        if self.__closed:
+            raise BrokenPipeError()
+        view = memoryview(data)
+        for offset in range(0, len(view), Constants.CHANNEL_MAX_FRAME):
+            self.__channel.send_frame(self.stream_id, Constants.CHANNEL_DATA, view[offset:offset + Constants.CHANNEL_MAX_FRAME])
+
+    def settimeout(self, timeout) -> None:
+        self.__timeout = timeout
+
+    def close(self) -> None:
+        if not self.__closed:
+            self.__closed = True
+            self.__channel.close_stream(self.stream_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __take(self, size: int) -> memoryview:
+        """
+        :return: view of at most size bytes of the frame being read, waiting for the next frame if it was
+        read completely. The frame isn't copied until the caller does
+        """
+        if not self.__pending and not self.__eof:
+            try:
+                data = self.__incoming.get(timeout=self.__timeout)
+            except queue.Empty:
+                raise socket.timeout()
+            self.__eof = not data
+            self.__pending = memoryview(data)
+        view, self.__pending = self.__pending[:size], self.__pending[size:]
+        return view
+
+
+class TransferChannel:
+    """
+    Class representing a long-lived transfer connection that carries many file streams, so a client doesn't
+    pay a TCP and TLS handshake per transfer. Everything that goes through it is a frame: a 9 bytes header with
+    the stream id (4 bytes), the frame type (1 byte) and the payload length (4 bytes), all big-endian,
+    followed by the payload:
+    - CHANNEL_OPEN: the client opens a new stream with the given id. Its first data is the transfer request,
+    just like in a transfer connection of its own
+    - CHANNEL_DATA: bytes of the stream, at most CHANNEL_MAX_FRAME
+    - CHANNEL_CLOSE: the side that sends it won't send anything else through the stream
+
+    It doesn't read from the connection itself: feed() takes the bytes as they're received, so both the
+    threaded Transfer and the asyncio server can serve channels. Frames are written with the send function
+    it's given, which must be safe to call from several threads. Every stream opened is handed to
+    open_handler in a thread of its own
+    """
+    HEADER = struct.Struct(Constants.CHANNEL_HEADER)
+
+    def __init__(self, send, open_handler):
+        self.__send = send
+        self.__open_handler = open_handler
+        self.__streams = {}
+        self.__lock = threading.Lock()
+        self.__buffer = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        """
+        Adds data received from the client and dispatches every frame that is complete. It can block while
+        a stream's queue is full
+
+        :param data: bytes received from the channel's connection
+        :raises ValueError: if a frame is bad formed
+        """
+        self.__buffer += data
+        while len(self.__buffer) >= self.HEADER.size:
+            stream_id, frame_type, length = self.HEADER.unpack_from(self.__buffer)
+            if length > Constants.CHANNEL_MAX_FRAME:
+                raise ValueError(Constants.INVALID_FRAME)
+            if len(self.__buffer) < self.HEADER.size + length:
+                break
+            payload = bytes(self.__buffer[self.HEADER.size:self.HEADER.size + length])
+            del self.__buffer[:self.HEADER.size + length]
+            self.dispatch(stream_id, frame_type, payload)
+
+    def dispatch(self, stream_id: int, frame_type: bytes, payload: bytes) -> None:
+        if frame_type == Constants.CHANNEL_OPEN:
+            with self.__lock:
+                if stream_id in self.__streams or len(self.__streams) >= Constants.CHANNEL_MAX_STREAMS:
+                    raise ValueError(Constants.INVALID_FRAME)
+                stream = self.__streams[stream_id] = ChannelStream(self, stream_id)
+            threading.Thread(target=self.__serve, args=(stream,), daemon=True).start()
+            return
+        if frame_type not in (Constants.CHANNEL_DATA, Constants.CHANNEL_CLOSE):
+            raise ValueError(Constants.INVALID_FRAME)
+        with self.__lock:
+            stream = self.__streams.get(stream_id)
+        if stream is not None and (payload or frame_type == Constants.CHANNEL_CLOSE):
+            stream.feed(payload if frame_type == Constants.CHANNEL_DATA else b"")
+
+    def send_frame(self, stream_id: int, frame_type: bytes, payload=b"") -> None:
+        self.__send(self.HEADER.pack(stream_id, frame_type, len(payload)) + bytes(payload))
+
+    def close_stream(self, stream_id: int) -> None:
+        with self.__lock:
+            self.__streams.pop(stream_id, None)
+        try:
+            self.send_frame(stream_id, Constants.CHANNEL_CLOSE)
+        except OSError:
+            pass
+
+    def shutdown(self) -> None:
+        """
+        Called when the channel's connection is closed: every open stream reads EOF
+        """
+        with self.__lock:
+            streams, self.__streams = list(self.__streams.values()), {}
+        for stream in streams:
+            stream.feed(b"")
+
+    def __serve(self, stream: ChannelStream) -> None:
+        try:
+            self.__open_handler(stream)
+        except (OSError, ValueError):
+            pass
+        finally:
+            stream.close()
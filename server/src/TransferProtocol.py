@@ -0,0 +1,373 @@
+import json
+import time
+import logging
+from .server_helper import Constants, transfer_range, transfer_codec, upload_size, BoundedDecompressor, DECOMPRESSION_ERRORS, \
+    calculate_signatures
+from .PartialFile import PartialFile
+from .DeltaPatcher import DeltaPatcher
+from .TreePack import PackSender, PackReceiver, read_manifest, skipped_files
+from .Metrics import METRICS
+from .EventLog import EVENT_LOG
+
+
+class TransferAdmission:
+    """
+    Class representing the wait of a transfer for a slot of the TransferScheduler (see Transfer.wait_for_slot()).
+    The transfer is queued when it's created, and the adapter waits for on_admit to be called, asking for
+    notice() every TRANSFER_QUEUE_NOTICE_SECONDS meanwhile
+    """
+    def __init__(self, scheduler, client_address, transfer_request: dict, on_admit):
+        self.__scheduler = scheduler
+        self.__queue = transfer_request.get("queue")
+        self.ticket = scheduler.request(client_address[0], on_admit)
+        if not self.ticket.admitted:
+            stats = scheduler.stats()
+            EVENT_LOG.event("queued", f"QUEUED {transfer_request['operation']} {transfer_request.get('absolute_path')} "
+                                      f"from {client_address} [{Constants.scheduler_state(stats)}]", "BLUE",
+                            transfer=self.ticket.id, client=client_address, operation=transfer_request["operation"],
+                            path=transfer_request.get("absolute_path"), **stats)
+
+    def notice(self) -> bytes:
+        """
+        :return: the queued flag for clients that asked for them (the request has "queue"), to send while they wait.
+        Empty for the rest
+        :raises TimeoutError: once a client that doesn't understand the flags waited TRANSFER_QUEUE_TIMEOUT_SECONDS
+        """
+        if self.__queue:
+            return Constants.QUEUED_FLAG
+        if time.monotonic() - self.ticket.queued_at >= Constants.TRANSFER_QUEUE_TIMEOUT_SECONDS:
+            raise TimeoutError()
+        return b""
+
+    def admit(self) -> bytes:
+        """
+        Records how long the transfer waited, once it's admitted
+
+        :return: the admitted flag for clients that asked for the queue flags, to send before the transfer starts
+        """
+        METRICS.observe(Constants.TRANSFER_QUEUE_DURATION, time.monotonic() - self.ticket.queued_at)
+        return Constants.ADMITTED_FLAG if self.__queue else b""
+
+    def give_up(self) -> None:
+        """
+        Takes the transfer out of the queue, or frees its slot if it was admitted in the meantime
+        """
+        if not self.__scheduler.cancel(self.ticket):
+            self.__scheduler.release(self.ticket)
+
+
+class TransferOperation:
+    """
+    Base class of the operations of an admitted transfer, which hold the request, with the fields of its ticket, and
+    the TransferTicket that paces it and counts its bytes.
+
+    Operations are the transfer protocol without any I/O on sockets: they decide what the server answers and apply
+    what it receives, while the threaded Transfer and the asyncio server only move the bytes, calling their methods
+    in the order the protocol says and sending what they return. That way both servers speak exactly the same
+    protocol, and the asyncio server runs the methods that touch the disk (the ones that say they block) in a thread
+    """
+    def __init__(self, transfer_request: dict, client_address, ticket):
+        self.request = transfer_request
+        self.path = transfer_request["absolute_path"]
+        self.client_address = client_address
+        self.ticket = ticket
+
+    def log(self, event: str, message: str, color: str, level: int = logging.INFO, **fields) -> None:
+        """
+        Logs an event of this transfer (see EventLog.event()), adding the client's address, the operation, the path
+        and the summary of its ticket: id, timing, bytes and throughput
+        """
+        EVENT_LOG.event(event, message, color, level, client=self.client_address, operation=self.request["operation"],
+                        path=self.path, **self.ticket.summary(), **fields)
+
+
+def manifest_size(transfer_request: dict) -> int:
+    """
+    :param transfer_request: Dictionary with all the transfer's metadata
+    :return: the size of the manifest of a pack, which follows the transfer request
+    :raises ValueError: if it isn't valid
+    """
+    size = transfer_request.get("manifest_size")
+    if not isinstance(size, int) or isinstance(size, bool) or not 0 < size <= Constants.MAX_MESSAGE_SIZE:
+        raise ValueError(Constants.INVALID_PACK)
+    return size
+
+
+class FileDownload(TransferOperation):
+    """
+    A get: the file, or the byte range of it the request has an "offset" and a "length" for, compressed if the
+    request has a "codec". How it's sent depends on the server, so this only says what and logs it
+    """
+    def __init__(self, transfer_request: dict, client_address, ticket):
+        super().__init__(transfer_request, client_address, ticket)
+        self.offset, self.length = transfer_range(transfer_request)
+        self.compression = transfer_codec(transfer_request)
+
+    def finish(self, sent: int, wire_bytes: int, engine: str) -> None:
+        """
+        :param sent: bytes of the file sent
+        :param wire_bytes: bytes that went through the connection, fewer than sent if the file was compressed
+        :param engine: how the file was sent, for the log
+        """
+        saved = f", {Constants.bytes_saved(sent, wire_bytes)}" if self.compression is not None else ""
+        self.log("transmitted", f"TRANSMITTED {self.path} to {self.client_address} [{engine}{saved}]", "PURPLE",
+                 engine=engine, file_bytes=sent)
+
+
+class FileUpload(TransferOperation):
+    """
+    A put. The file is written to a PartialFile, which hashes each chunk while it's written, so the file doesn't
+    need to be read again once it's complete. The protocol is:
+    1. prepare(): uploads whose size isn't valid, too big or bigger than the free space are rejected before
+    anything is allocated (see upload_size()), and so are the ones whose resume offset isn't an integer between 0
+    and the size
+    2. deduplicate(): if the request has "dedup" and the content store has a file with the same checksum, it's
+    put in place instead and the server answers the dedup flag, so the client doesn't send anything
+    3. open(): the partial file is created, or the one of a previous interrupted upload is reused if the request
+    has a "resume" offset, and the server answers the start flag
+    4. feed() with every chunk received until EOF, decompressed first if the request has a "codec", a bounded
+    piece at a time (see BoundedDecompressor), so checksums are always calculated on the original bytes
+    5. finish(): an upload that ends before the whole file arrived is kept to be resumed. A complete one is moved
+    to its final path if it's authentic, and its checksums are stored in the checksum cache, so the first
+    download doesn't hash it again
+
+    deduplicate(), open(), feed() and finish() block
+    """
+    def __init__(self, transfer_request: dict, client_address, ticket, checksum_cache, content_store, committer):
+        super().__init__(transfer_request, client_address, ticket)
+        self.__checksum_cache = checksum_cache
+        self.__content_store = content_store
+        self.__committer = committer
+        self.__partial = None
+        self.__resume = 0
+        self.__decompress = None
+
+    def prepare(self) -> bool:
+        """
+        :return: False if the upload was rejected, and the connection must be closed
+        """
+        try:
+            filesize = upload_size(self.request)
+            self.__resume = self.request.get("resume", 0)
+            if not isinstance(self.__resume, int) or isinstance(self.__resume, bool) or \
+                    not 0 <= self.__resume <= (filesize if filesize is not None else Constants.max_upload_size()):
+                raise ValueError(Constants.INVALID_RESUME_OFFSET)
+        except ValueError as error:
+            self.log("rejected", f"REJECTED {self.path} from {self.client_address}, {error}", "RED", logging.WARNING,
+                     reason=str(error))
+            return False
+        self.__partial = PartialFile(self.path, self.request["sha256sum"], filesize, Constants.TRANSFER_BLOCK_SIZE)
+        compression = transfer_codec(self.request)
+        if compression is not None:
+            limit = (filesize if filesize is not None else Constants.max_upload_size()) - self.__resume
+            self.__decompress = BoundedDecompressor(compression[0], limit).decompress
+        return True
+
+    def deduplicate(self) -> bool:
+        """
+        :return: True if the file was put in place out of the content store, and the dedup flag must be sent
+        """
+        if not self.request.get("dedup") or self.__content_store is None or \
+                not self.__content_store.place(self.request["sha256sum"], self.request.get("filesize"), self.path):
+            return False
+        self.__partial.discard()
+        self.__checksum_cache.invalidate(self.path)
+        self.__checksum_cache.store_file(self.path, self.request["sha256sum"])
+        self.log("deduplicated", f"DEDUPLICATED {self.path} from {self.client_address}", "YELLOW",
+                 file_bytes=self.request.get("filesize"))
+        return True
+
+    def open(self) -> bool:
+        """
+        :return: False if the partial file can't be created, or the disk can't hold it, and the connection must be
+        closed. Otherwise, the start flag must be sent
+        :raises ValueError: if the resume offset isn't valid for the partial file there is
+        """
+        try:
+            self.__partial.open(resume=self.__resume > 0)
+        except OSError as error:
+            self.__partial.discard()
+            self.log("failed", f"FAILED {self.path} from {self.client_address}, {error.strerror}", "RED", logging.WARNING,
+                     reason=error.strerror)
+            return False
+        try:
+            self.__partial.seek(self.__resume)
+        except ValueError:
+            self.__partial.close()
+            raise
+        return True
+
+    def feed(self, data) -> bool:
+        """
+        :param data: bytes received, or a view of the buffer they were received into
+        :return: False if the upload can't go on: the data goes beyond the file size, completes a block that doesn't
+        match its checksum, can't be decompressed or can't be written
+        """
+        try:
+            pieces = self.__decompress(data) if self.__decompress else (data,)
+            return all(self.__partial.write(piece) for piece in pieces)
+        except DECOMPRESSION_ERRORS:  # OSError covers the errors of the disk too
+            return False
+
+    def finish(self) -> None:
+        if not self.__partial.is_complete():
+            self.__partial.close()
+            self.log("interrupted", f"INTERRUPTED {self.path} from {self.client_address}", "RED", logging.WARNING)
+            return
+        self.__checksum_cache.invalidate(self.path)
+        if self.__partial.commit(self.request.get("blocks_sha256sum"), self.__committer):
+            block_digests = self.__partial.block_digests() or None
+            self.__checksum_cache.store_file(self.path, self.request["sha256sum"],
+                                             block_digests and Constants.TRANSFER_BLOCK_SIZE, block_digests)
+            if self.__content_store is not None:
+                self.__content_store.ingest(self.path, self.__partial.received_checksum())
+            self.log("received", f"RECEIVED {self.path} from {self.client_address}", "YELLOW",
+                     file_bytes=self.request.get("filesize"))
+
+
+class DeltaUpload(TransferOperation):
+    """
+    A delta upload of a file the server already has. The protocol is:
+    1. prepare(): requests without a valid size are rejected (see upload_size()), since the size the client declares
+    is what bounds the delta
+    2. signature(): the server answers the signature of its copy, weak and strong checksums of its blocks
+    3. open() and feed() with every chunk received: the client sends the delta, instructions to copy blocks of
+    the server's copy and the literal data that changed, which a DeltaPatcher applies to a new file
+    4. finish(): once the delta is complete, the new file atomically replaces the old one, if its size and its
+    checksum match the ones the client declared. If anything fails, the old file is left untouched
+
+    signature(), open(), feed() and finish() block
+    """
+    def __init__(self, transfer_request: dict, client_address, ticket, checksum_cache, content_store, committer):
+        super().__init__(transfer_request, client_address, ticket)
+        self.__checksum_cache = checksum_cache
+        self.__content_store = content_store
+        self.__committer = committer
+        self.__patcher = None
+
+    def prepare(self) -> bool:
+        """
+        :return: False if the delta was rejected, and the connection must be closed
+        """
+        try:
+            filesize = upload_size(self.request)
+            if filesize is None:
+                raise ValueError(Constants.INVALID_FILESIZE)
+        except ValueError as error:
+            self.log("rejected", f"REJECTED {self.path} from {self.client_address}, {error}", "RED", logging.WARNING,
+                     reason=str(error))
+            return False
+        self.__patcher = DeltaPatcher(self.path, Constants.DELTA_BLOCK_SIZE, self.request["sha256sum"], filesize)
+        return True
+
+    def signature(self) -> bytes:
+        with METRICS.timer(Constants.CHECKSUM_DURATION, "signatures"):
+            return calculate_signatures(self.path, Constants.DELTA_BLOCK_SIZE)
+
+    def open(self) -> None:
+        self.__patcher.open()
+
+    def feed(self, data) -> bool:
+        """
+        :param data: bytes received
+        :return: True once the delta is complete
+        :raises ValueError: if the delta isn't valid, the new file is removed
+        """
+        try:
+            return self.__patcher.feed(data)
+        except ValueError:
+            self.__patcher.discard()
+            raise
+
+    def finish(self) -> None:
+        self.__checksum_cache.invalidate(self.path)
+        if self.__patcher.commit(self.__committer):
+            self.__checksum_cache.store_file(self.path, self.request["sha256sum"])
+            if self.__content_store is not None:
+                self.__content_store.ingest(self.path, self.request["sha256sum"])
+            self.log("patched", f"PATCHED {self.path} from {self.client_address} ({self.__patcher.literal} bytes received, "
+                                f"{self.__patcher.copied} bytes reused)", "YELLOW",
+                     literal_bytes=self.__patcher.literal, reused_bytes=self.__patcher.copied)
+
+
+class PackDownload(TransferOperation):
+    """
+    A pack download, a part of a recursive get. The server answers the start flag, reads the manifest
+    (manifest_size() bytes) and passes it to start(), and then sends the chunks() of the files listed in it, all of
+    them inside the requested directory, one after the other (see PackSender). start() and chunks() block
+    """
+    def __init__(self, transfer_request: dict, client_address, ticket):
+        super().__init__(transfer_request, client_address, ticket)
+        self.__sender = None
+
+    def start(self, manifest: bytes) -> None:
+        """
+        :raises ValueError: if the manifest is bad formed
+        """
+        files, _ = read_manifest(manifest)
+        self.__sender = PackSender(self.path, files)
+
+    def chunks(self):
+        return self.__sender.chunks()
+
+    def finish(self, engine: str = None) -> None:
+        """
+        :param engine: how the pack was sent, for the log, if it isn't the default
+        """
+        engine = f"{engine}, " if engine else ""
+        self.log("transmitted", f"TRANSMITTED {self.path} to {self.client_address} [{engine}{self.__sender.sent_files} files, "
+                                f"{self.__sender.sent_bytes} bytes]", "PURPLE", files=self.__sender.sent_files,
+                 file_bytes=self.__sender.sent_bytes)
+
+
+class PackUpload(TransferOperation):
+    """
+    A pack upload, a part of a recursive put. The server answers the start flag and reads the manifest
+    (manifest_size() bytes). Files that already exist are skipped: start() gives the answer to the manifest, a
+    byte per file, b"1" if it exists and the client must leave it out of the stream, b"0" otherwise. The files
+    received are passed to feed(), which writes them inside the requested directory (see PackReceiver), and
+    finish() puts them in place and gives the json-formatted summary to send back once the pack is complete,
+    with the number of files received and skipped and the ones that failed. start(), feed() and finish() block
+    """
+    def __init__(self, transfer_request: dict, client_address, ticket, committer):
+        super().__init__(transfer_request, client_address, ticket)
+        self.__committer = committer
+        self.__receiver = None
+        self.__skipped = 0
+
+    def start(self, manifest: bytes) -> bytes:
+        """
+        :raises ValueError: if the manifest is bad formed
+        """
+        files, directories = read_manifest(manifest)
+        existing = skipped_files(self.path, files)
+        self.__skipped = sum(existing)
+        self.__receiver = PackReceiver(self.path, [path for path, exists in zip(files, existing) if not exists], directories,
+                                       committer=self.__committer)
+        self.__receiver.open()
+        return b"".join(b"1" if exists else b"0" for exists in existing)
+
+    @property
+    def finished(self) -> bool:
+        return self.__receiver.finished
+
+    def feed(self, data) -> bool:
+        """
+        :return: True once the whole pack was received
+        """
+        return self.__receiver.feed(data)
+
+    def finish(self, engine: str = None) -> bytes:
+        """
+        :param engine: how the pack was received, for the log, if it isn't the default
+        :return: the summary to send, empty if the pack isn't complete
+        """
+        receiver = self.__receiver
+        receiver.close()
+        engine = f"{engine}, " if engine else ""
+        self.log("received", f"RECEIVED {self.path} from {self.client_address} [{engine}{receiver.received_files} files, "
+                             f"{receiver.received_bytes} bytes, {len(receiver.failed)} failed]", "YELLOW",
+                 files=receiver.received_files, file_bytes=receiver.received_bytes, failed=len(receiver.failed))
+        if not receiver.finished:
+            return b""
+        return json.dumps({"received": receiver.received_files, "skipped": self.__skipped, "failed": receiver.failed}).encode()
@@ -0,0 +1,224 @@
+import time
+import secrets
+import threading
+from collections import OrderedDict, deque, Counter
+from .server_helper import Constants
+from .Metrics import METRICS
+
+
+class TokenBucket:
+    """
+    Token bucket of a client: it fills at rate bytes per second, up to TRANSFER_BURST_SECONDS worth of bytes.
+    Consuming more tokens than it has leaves it in debt, which is paid off by waiting
+    """
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.capacity = rate * Constants.TRANSFER_BURST_SECONDS
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def consume(self, size: int) -> float:
+        """
+        :param size: amount of bytes about to be transferred
+        :return: seconds to wait before transferring them
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - size
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def is_full(self, now: float) -> bool:
+        """
+        :return: True if the bucket refilled completely, so a new bucket would be the same as this one
+        """
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class TransferTicket:
+    """
+    Class representing a transfer that is waiting for, or holding, a slot of a TransferScheduler. Once it's
+    admitted, the transfer uses it to respect the rate limit of its client: limit() gives the size of the next
+    chunk to send or receive, and wait() (or delay(), in coroutines) how long to wait before it.
+    The transfer counts the bytes it sends and receives in it, for the logs (see summary())
+    """
+    def __init__(self, scheduler, client: str, on_admit):
+        self.id = secrets.token_hex(Constants.TRANSFER_ID_BYTES)
+        self.client = client
+        self.on_admit = on_admit
+        self.admitted = False
+        self.queued_at = time.monotonic()
+        self.admitted_at = None
+        self.sent = 0
+        self.received = 0
+        self.__scheduler = scheduler
+
+    @property
+    def limited(self) -> bool:
+        return self.__scheduler.client_rate is not None
+
+    def limit(self, size: int) -> int:
+        return self.__scheduler.chunk_size(self, size)
+
+    def delay(self, size: int) -> float:
+        return self.__scheduler.delay(self, size)
+
+    def wait(self, size: int) -> None:
+        delay = self.delay(size)
+        if delay > 0:
+            time.sleep(delay)
+
+    def summary(self) -> dict:
+        """
+        :return: fields logged when the transfer ends: its id, the seconds it was queued and running, the bytes
+        sent and received and its throughput in bytes per second
+        """
+        now = time.monotonic()
+        started = self.admitted_at if self.admitted_at is not None else now
+        seconds = now - started
+        return {"transfer": self.id, "queue_seconds": round(started - self.queued_at, 6), "seconds": round(seconds, 6),
+                "bytes_sent": self.sent, "bytes_received": self.received,
+                "throughput": round((self.sent + self.received) / seconds) if seconds > 0 else None}
+
+
+class TransferScheduler:
+    """
+    Class representing the admission and pacing of the transfers of the server, so a single client can't take
+    every thread and all the bandwidth:
+    - at most max_active transfers run at the same time. The rest wait in a queue, and are admitted as slots free up
+    - the queue is fair: each client has a queue of its own, and free slots are given to clients in turns (round
+    robin), so a client that asks for 50 transfers doesn't make the others wait for all of them
+    - if client_rate is given, each client is limited to client_rate bytes per second, shared by all of its
+    transfers, with a token bucket. Chunks get smaller as a client runs more transfers, so no transfer waits
+    long enough between chunks for the other side to time out. The bucket outlives the client's transfers, so
+    transfers made one after another (a batch, a recursive get) share the rate too, instead of each one starting
+    with a full burst. Buckets of clients without transfers are dropped once they refilled, every
+    TRANSFER_BUCKET_SWEEP_SECONDS
+
+    Clients are identified by their IP address. Admission works with callbacks, so it can be waited for both from
+    threads and from coroutines. It's safe to use from several threads. The transfers running and queued are kept
+    in the ACTIVE_TRANSFERS and QUEUED_TRANSFERS gauges, which add up the schedulers of every process
+    """
+    def __init__(self, max_active: int = Constants.TRANSFER_MAX_ACTIVE, client_rate: int = None):
+        self.max_active = max_active
+        self.client_rate = client_rate
+        self.__lock = threading.Lock()
+        self.__queues = OrderedDict()
+        self.__active = Counter()
+        self.__buckets = {}
+        self.__swept = time.monotonic()
+        self.active = 0
+        self.queued = 0
+
+    def request(self, client: str, on_admit) -> TransferTicket:
+        """
+        Queues a transfer. If there's a free slot and nobody waiting, it's admitted right away
+
+        :param client: IP address of the client
+        :param on_admit: function called, without arguments, when the transfer is admitted. It can be called
+        from this same call or from the thread that frees a slot, so it must be quick and thread-safe
+        :return: the TransferTicket of the transfer
+        """
+        ticket = TransferTicket(self, client, on_admit)
+        with self.__lock:
+            self.__queues.setdefault(client, deque()).append(ticket)
+            self.queued += 1
+            METRICS.inc(Constants.QUEUED_TRANSFERS)
+            if self.client_rate is not None:
+                self.__sweep()
+                if client not in self.__buckets:
+                    self.__buckets[client] = TokenBucket(self.client_rate)
+            admitted = self.__admit()
+        for admitted_ticket in admitted:
+            admitted_ticket.on_admit()
+        return ticket
+
+    def cancel(self, ticket: TransferTicket) -> bool:
+        """
+        Takes a transfer out of the queue, because its client is gone
+
+        :return: False if it was admitted in the meantime, and has to be released instead
+        """
+        with self.__lock:
+            if ticket.admitted:
+                return False
+            queue = self.__queues[ticket.client]
+            queue.remove(ticket)
+            if not queue:
+                del self.__queues[ticket.client]
+            self.queued -= 1
+            METRICS.dec(Constants.QUEUED_TRANSFERS)
+        return True
+
+    def release(self, ticket: TransferTicket) -> None:
+        """
+        Frees the slot of a finished transfer and admits the next ones in the queue
+        """
+        with self.__lock:
+            self.active -= 1
+            METRICS.dec(Constants.ACTIVE_TRANSFERS)
+            self.__active[ticket.client] -= 1
+            if not self.__active[ticket.client]:
+                del self.__active[ticket.client]
+            admitted = self.__admit()
+        for admitted_ticket in admitted:
+            admitted_ticket.on_admit()
+
+    def delay(self, ticket: TransferTicket, size: int) -> float:
+        """
+        :return: seconds the transfer has to wait before sending or receiving size bytes
+        """
+        if self.client_rate is None:
+            return 0
+        with self.__lock:
+            return self.__buckets[ticket.client].consume(size)
+
+    def chunk_size(self, ticket: TransferTicket, size: int) -> int:
+        """
+        :return: size if the client isn't rate limited, otherwise the amount of bytes the transfer should send
+        or receive at a time, about TRANSFER_THROTTLE_SECONDS worth of its share of the client's rate
+        """
+        if self.client_rate is None:
+            return size
+        share = self.client_rate * Constants.TRANSFER_THROTTLE_SECONDS / max(self.__active[ticket.client], 1)
+        return max(min(size, int(share)), Constants.TRANSFER_THROTTLE_MIN_CHUNK)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"active": self.active, "queued": self.queued, "waiting_clients": len(self.__queues)}
+
+    def __admit(self) -> list:
+        """
+        Gives the free slots to the clients in the queue, in turns. Must be called with the lock held
+
+        :return: tickets admitted, whose callbacks must be called once the lock is released
+        """
+        admitted = []
+        while self.active < self.max_active and self.__queues:
+            client, queue = next(iter(self.__queues.items()))
+            ticket = queue.popleft()
+            if queue:
+                self.__queues.move_to_end(client)
+            else:
+                del self.__queues[client]
+            ticket.admitted = True
+            ticket.admitted_at = time.monotonic()
+            self.active += 1
+            self.queued -= 1
+            self.__active[client] += 1
+            METRICS.inc(Constants.ACTIVE_TRANSFERS)
+            METRICS.dec(Constants.QUEUED_TRANSFERS)
+            admitted.append(ticket)
+        return admitted
+
+    def __sweep(self) -> None:
+        """
+        Drops the buckets of the clients that have no transfers and whose bucket refilled, at most every
+        TRANSFER_BUCKET_SWEEP_SECONDS. Must be called with the lock held
+        """
+        now = time.monotonic()
+        if now - self.__swept < Constants.TRANSFER_BUCKET_SWEEP_SECONDS:
+            return
+        self.__swept = now
+        for client in [client for client, bucket in self.__buckets.items() if bucket.is_full(now)]:
+            if client not in self.__active and client not in self.__queues:
+                del self.__buckets[client]
@@ -0,0 +1,262 @@
+import os
+import json
+import struct
+import hashlib
+from .server_helper import Constants, tree_path
+from .Committer import Committer
+
+# files are opened without following a symbolic link in their last component, tree_path() checked the path,
+# but a link could be put in its place before it's opened
+NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+
+class PackSender:
+    """
+    Class producing the stream of a pack: several files of a directory sent one after the other through a
+    single transfer connection. For each file, in the order of the pack manifest, the stream has:
+    - an entry header: a status byte (PACK_FILE_OK or PACK_FILE_MISSING) and the file size, as 8 bytes
+    big-endian integer
+    - the contents of the file, exactly that many bytes
+    - the sha256 digest of the contents (32 bytes), if the file was there
+
+    Headers and small files are buffered together, so packing thousands of small files doesn't mean
+    thousands of tiny TLS records. If a file shrinks while it's read, it's padded so the stream stays in
+    sync, and its digest, calculated on what was actually read, makes the receiver reject it. Symbolic links
+    aren't sent, they're reported as missing files.
+    It doesn't do any I/O on sockets, so both the threaded Transfer and the asyncio server can use it
+    """
+    ENTRY = struct.Struct(Constants.PACK_ENTRY)
+
+    def __init__(self, root: str, files: list):
+        self.root = root
+        self.files = files
+        self.sent_files = 0
+        self.sent_bytes = 0
+
+    def chunks(self):
+        """
+        Generator of the pack stream
+
+        :return: generator of bytes, at least STREAM_BUFFER_SIZE long except the last one
+        :raises ValueError: if a path of the manifest isn't inside the root directory
+        """
+        buffer = bytearray()
+        for relative_path in self.files:
+            try:
+                file = os.fdopen(os.open(tree_path(self.root, relative_path), os.O_RDONLY | NOFOLLOW), "rb")
+            except OSError:
+                buffer += self.ENTRY.pack(Constants.PACK_FILE_MISSING, 0)
+                continue
+            with file:
+                size = os.fstat(file.fileno()).st_size
+                buffer += self.ENTRY.pack(Constants.PACK_FILE_OK, size)
+                checksum = hashlib.sha256()
+                remaining = size
+                while remaining:
+                    data = file.read(min(remaining, Constants.SEND_BUFFER_SIZE))
+                    if data:
+                        checksum.update(data)
+                    else:
+                        data = bytes(min(remaining, Constants.SEND_BUFFER_SIZE))
+                    remaining -= len(data)
+                    self.sent_bytes += len(data)
+                    if len(buffer) + len(data) < Constants.STREAM_BUFFER_SIZE:
+                        buffer += data
+                        continue
+                    if buffer:
+                        yield bytes(buffer)
+                        buffer.clear()
+                    yield data
+                buffer += checksum.digest()
+                self.sent_files += 1
+            if len(buffer) >= Constants.STREAM_BUFFER_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+
+class PackReceiver:
+    """
+    Class writing the files of a pack stream (see PackSender) as it's received. Each file is written to
+    "<file>.part" and renamed to its final path once its digest matches, so a file is never left half
+    written under its real name. The directories listed in the manifest are created first, so empty
+    directories are transferred too.
+
+    Files that already exist are skipped, their contents are read and dropped, unless overwrite is True.
+    Files that are missing on the sender side, already exist or don't match their digest are listed
+    in failed, with the reason.
+
+    Files are renamed by the committer (see Committer), by default one that just renames them. If its policy
+    flushes files, the files received are renamed together when the receiver is closed, so a pack of many
+    small files pays for a couple of flushes instead of two per file (see Committer.commit_all())
+    """
+    ENTRY = struct.Struct(Constants.PACK_ENTRY)
+
+    def __init__(self, root: str, files: list, directories: list = (), overwrite: bool = False, committer=None):
+        self.root = root
+        self.files = files
+        self.directories = directories
+        self.overwrite = overwrite
+        self.committer = committer or Committer()
+        self.received_files = 0
+        self.received_bytes = 0
+        self.failed = []
+        self.finished = not files
+        self.__buffer = bytearray()
+        self.__index = 0
+        self.__remaining = None
+        self.__file = None
+        self.__path = None
+        self.__checksum = None
+        self.__skip_reason = None
+        self.__staged = []
+
+    def open(self) -> None:
+        """
+        Creates the root directory and the directories of the manifest
+
+        :raises ValueError: if a path of the manifest isn't inside the root directory
+        """
+        os.makedirs(self.root, exist_ok=True)
+        for relative_path in self.directories:
+            os.makedirs(tree_path(self.root, relative_path), exist_ok=True)
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Adds data received and writes every part of it that is complete
+
+        :param data: bytes received
+        :return: True once every file of the manifest was received
+        :raises ValueError: if a path of the manifest isn't inside the root directory or an entry is bad formed
+        """
+        self.__buffer += data
+        while self.__buffer and not self.finished:
+            if self.__remaining is None:
+                if len(self.__buffer) < self.ENTRY.size:
+                    break
+                status, size = self.ENTRY.unpack_from(self.__buffer)
+                del self.__buffer[:self.ENTRY.size]
+                self.__start(status, size)
+            elif self.__remaining > 0:
+                data = self.__buffer[:self.__remaining]
+                del self.__buffer[:len(data)]
+                self.__remaining -= len(data)
+                self.received_bytes += len(data)
+                self.__checksum.update(data)
+                if self.__file is not None:
+                    self.__file.write(data)
+            else:
+                if len(self.__buffer) < Constants.PACK_DIGEST_SIZE:
+                    break
+                digest = bytes(self.__buffer[:Constants.PACK_DIGEST_SIZE])
+                del self.__buffer[:Constants.PACK_DIGEST_SIZE]
+                self.__finish(digest)
+        return self.finished
+
+    def close(self) -> None:
+        """
+        Removes the file that was being written, if the stream ended in the middle of it, and renames the
+        files received that are waiting for the committer
+        """
+        if self.__file is not None:
+            self.__file.close()
+            os.remove(self.__path + Constants.PARTIAL_SUFFIX)
+            self.__file = None
+        staged, self.__staged = self.__staged, []
+        if staged:
+            self.__commit(staged)
+
+    def pending_files(self) -> list:
+        """
+        :return: paths of the manifest whose entry wasn't completely received
+        """
+        return self.files[self.__index:]
+
+    def __start(self, status: int, size: int) -> None:
+        relative_path = self.files[self.__index]
+        self.__path = tree_path(self.root, relative_path)
+        if status == Constants.PACK_FILE_MISSING:
+            self.failed.append((relative_path, Constants.FILE_DOESNT_EXISTS))
+            self.__next()
+            return
+        if status != Constants.PACK_FILE_OK:
+            raise ValueError(Constants.INVALID_PACK)
+        self.__remaining = size
+        self.__checksum = hashlib.sha256()
+        self.__skip_reason = None
+        if not self.overwrite and os.path.lexists(self.__path):
+            self.__skip_reason = Constants.FILE_EXISTS
+            return
+        try:
+            os.makedirs(os.path.dirname(self.__path), exist_ok=True)
+            self.__file = os.fdopen(os.open(self.__path + Constants.PARTIAL_SUFFIX,
+                                            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | NOFOLLOW, 0o666), "wb")
+        except OSError as error:
+            self.__skip_reason = error.strerror
+
+    def __finish(self, digest: bytes) -> None:
+        relative_path = self.files[self.__index]
+        if self.__file is None:
+            self.failed.append((relative_path, self.__skip_reason))
+        elif digest != self.__checksum.digest():
+            self.close()
+            self.failed.append((relative_path, Constants.INVALID_CHECKSUM))
+        else:
+            self.__file.close()
+            self.__file = None
+            self.received_files += 1
+            if self.committer.syncs:
+                self.__staged.append((relative_path, self.__path))
+            else:
+                self.__commit([(relative_path, self.__path)])
+        self.__next()
+
+    def __commit(self, received: list) -> None:
+        """
+        Renames received files to their final paths. The ones that can't be renamed are removed and moved
+        from the received files to the failed ones
+
+        :param received: list of tuples with the relative path and the final path of each file
+        """
+        renames = [(path + Constants.PARTIAL_SUFFIX, path) for _, path in received]
+        for (relative_path, path), error in zip(received, self.committer.commit_all(renames)):
+            if error is not None:
+                if os.path.exists(path + Constants.PARTIAL_SUFFIX):
+                    os.remove(path + Constants.PARTIAL_SUFFIX)
+                self.received_files -= 1
+                self.failed.append((relative_path, error.strerror))
+
+    def __next(self) -> None:
+        self.__remaining = None
+        self.__index += 1
+        self.finished = self.__index == len(self.files)
+
+
+def read_manifest(data: bytes) -> tuple:
+    """
+    Decodes the manifest of a pack, a json object with the "files" of the pack and, optionally, the
+    "directories" to create, all of them paths relative to the directory being transferred
+
+    :param data: bytes of the json-formatted manifest
+    :return: a tuple with the list of files and the list of directories
+    :raises ValueError: if the manifest is bad formed
+    """
+    manifest = json.loads(data.decode())
+    if not isinstance(manifest, dict):
+        raise ValueError(Constants.INVALID_PACK)
+    files, directories = manifest.get("files"), manifest.get("directories", [])
+    if not isinstance(files, list) or not isinstance(directories, list) or \
+            not all(isinstance(path, str) for path in files + directories):
+        raise ValueError(Constants.INVALID_PACK)
+    return files, directories
+
+
+def skipped_files(root: str, files: list) -> list:
+    """
+    :param root: absolute path to the directory being uploaded
+    :param files: paths of the files of a pack
+    :return: a list of booleans, True for the files that already exist and won't be received
+    :raises ValueError: if a path isn't inside the root directory
+    """
+    return [os.path.lexists(tree_path(root, path)) for path in files]
@@ -0,0 +1,131 @@
+import os
+import stat
+import errno
+import posixpath
+from .server_helper import Constants
+
+
+class OutsideRootError(PermissionError):
+    """
+    Raised when a path given by a client leads outside the served directory
+    """
+
+
+class ServedRoot:
+    """
+    Class representing the directory the server serves. Sessions see it as /, and can't get out of it: .. in
+    the root is the root, like in a chroot, and paths that lead outside through symbolic links are refused.
+
+    The directory is opened once, and every session of the process resolves its paths against that file
+    descriptor, with the dir_fd argument of the os functions (openat(), fstatat(), mkdirat()...)
+    """
+    def __init__(self, path: str):
+        self.path = os.path.realpath(path)
+        self.fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+
+    def contains(self, absolute_path: str) -> bool:
+        """
+        :return: True if absolute_path, once its symbolic links are resolved, is the root or is inside it
+        """
+        return os.path.commonpath([self.path, absolute_path]) == self.path
+
+    def encloses(self, absolute_path: str) -> bool:
+        """
+        Like contains(), but resolving the symbolic links of absolute_path now. Paths resolved a while ago, like
+        the ones of transfer tickets, are checked again with it, in case a link was changed in between
+
+        :return: True if absolute_path leads to the root or inside it
+        """
+        return self.contains(os.path.realpath(absolute_path))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class WorkingDirectory:
+    """
+    Class representing the working directory of a session, inside a ServedRoot. It replaces the process working
+    directory (os.chdir()), which is shared by every thread of a process, so sessions don't need a process each:
+    the working directory is just a path, relative to the root, and paths given by the client are resolved
+    against it.
+
+    Paths are resolved to the root relative path of the file they lead to, symbolic links included. Files are
+    then looked at with that path and the descriptor of the root, and absolute() gives the path on disk, for the
+    indexes, caches and transfers, which work with absolute paths
+    """
+    def __init__(self, root: ServedRoot):
+        self.root = root
+        self.__path = os.curdir
+
+    @property
+    def path(self) -> str:
+        """
+        :return: the working directory as the client sees it, / being the root
+        """
+        return "/" if self.__path == os.curdir else f"/{self.__path}"
+
+    def resolve(self, path: str) -> str:
+        """
+        Resolves a path given by the client, relative to the working directory or, if it starts with /, to the root
+
+        :return: the path relative to the root, os.curdir for the root itself
+        :raises OutsideRootError: if the path leads outside the root through a symbolic link
+        :raises FileNotFoundError: if the path isn't valid, like one with a null byte
+        """
+        virtual_path = posixpath.normpath(posixpath.join(self.path, path)).lstrip("/")
+        try:
+            real_path = os.path.realpath(os.path.join(self.root.path, virtual_path))
+        except ValueError:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if not self.root.contains(real_path):
+            raise OutsideRootError(errno.EACCES, Constants.OUTSIDE_ROOT, path)
+        return os.path.relpath(real_path, self.root.path)
+
+    def absolute(self, path: str = os.curdir) -> str:
+        """
+        :return: the absolute path on disk of a path given by the client, see resolve()
+        """
+        return os.path.normpath(os.path.join(self.root.path, self.resolve(path)))
+
+    def stat(self, path: str) -> os.stat_result:
+        return os.stat(self.resolve(path), dir_fd=self.root.fd)
+
+    def isdir(self, path: str) -> bool:
+        """
+        isdir(), isfile() and exists() work like their os.path versions, but paths outside the root are an error
+
+        :raises OutsideRootError: if the path leads outside the root
+        """
+        return self.__is(path, stat.S_ISDIR)
+
+    def isfile(self, path: str) -> bool:
+        return self.__is(path, stat.S_ISREG)
+
+    def exists(self, path: str) -> bool:
+        return self.__is(path, lambda mode: True)
+
+    def mkdir(self, path: str) -> None:
+        """
+        :raises FileExistsError: if there's something with that name already
+        """
+        os.mkdir(self.resolve(path), dir_fd=self.root.fd)
+
+    def chdir(self, path: str) -> None:
+        """
+        Changes the working directory. The directory is opened to check it's one, and that it can be read
+
+        :raises FileNotFoundError: if it doesn't exist
+        :raises NotADirectoryError: if it isn't a directory
+        :raises PermissionError: if it can't be read or it's outside the root
+        """
+        relative_path = self.resolve(path)
+        os.close(os.open(relative_path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0), dir_fd=self.root.fd))
+        self.__path = relative_path
+
+    def __is(self, path: str, check) -> bool:
+        try:
+            return check(os.stat(self.resolve(path), dir_fd=self.root.fd).st_mode)
+        except OutsideRootError:
+            raise
+        except OSError:
+            return False
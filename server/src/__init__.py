@@ -1,3 +1,16 @@
 from .Connection import Connection
 from .Transfer import Transfer
-from .server_helper import Constants, print_colored
\ No newline at end of file
+from .ChecksumCache import ChecksumCache
+from .DirectoryIndex import DirectoryIndex
+from .PathIndex import PathIndex
+from .ContentStore import ContentStore
+from .TransferScheduler import TransferScheduler
+from .TicketTable import TicketTable
+from .Committer import Committer
+from .WorkingDirectory import ServedRoot
+from .PartialFile import PartialFile
+from .AsyncServer import AsyncServer
+from .PreforkServer import PreforkServer
+from .Metrics import METRICS, serve_metrics
+from .EventLog import EVENT_LOG
+from .server_helper import Constants, parse_rate
\ No newline at end of file
@@ -1,6 +1,12 @@
 from collections import defaultdict
 import datetime
 import hashlib
+import mmap
+import os
+import struct
+import zlib
+import bz2
+import lzma
 
 
 class Constants:
@@ -11,6 +17,7 @@ class Constants:
     COLORS["YELLOW"] = "\033[1;33m"
     COLORS["PURPLE"] = "\033[1;35m"
     COLORS["GREEN"] = "\033[1;32m"
+    COLORS["BLUE"] = "\033[1;34m"
     COLORS["RESET"] = "\033[0m"
 
     # Connection
@@ -23,10 +30,47 @@ class Constants:
     FILE_DOESNT_EXISTS = "No such file"
     INVALID_COMMAND = "Invalid command or argument(s)"
     BAD_FORMED_MESSAGE = "Invalid command format, it doesn't respect the protocol"
+    UNSUPPORTED_PROTOCOL = "Unsupported protocol version"
+    MESSAGE_TOO_BIG = "Message exceeds the maximum message size"
+    INVALID_RANGE = "Transfer offset and length must be non-negative integers"
+    INVALID_BATCH = "A batch must be a list of at most {} commands, and can't be nested"
+    INVALID_RESUME = "Transfers can only be resumed at a confirmed block boundary"
+    INVALID_RESUME_OFFSET = "Resume offset must be a non-negative integer no bigger than the file size"
+    INVALID_FILESIZE = "File size must be a non-negative integer no bigger than the maximum upload size"
+    NO_SPACE_FOR_UPLOAD = "Not enough free space for the upload"
+    DECOMPRESSED_TOO_BIG = "Decompressed data is bigger than the file"
+    PARTIAL_FILES_EXPIRED = "partial files of abandoned uploads removed"
+    INVALID_DELTA = "Bad formed delta instruction"
+    INVALID_COMPRESSION = "Compression must be zlib, bz2 or lzma, with a level from 1 to 9"
+    COMPRESSION_ENABLED = "Compression enabled"
+    INVALID_CHECKSUM = "Checksum doesn't match"
+    INVALID_PACK = "Bad formed pack entry"
+    INVALID_FRAME = "Bad formed channel frame"
+    INVALID_TREE_PATH = "Paths in a directory transfer must be relative and stay inside the directory"
+    INVALID_FIND = "A find request needs a pattern, and sizes, ages and limit must be non-negative integers"
+    FIND_OUTSIDE_ROOT = "Only the served directory can be searched"
+    OUTSIDE_ROOT = "Path leads outside the served directory"
+    INVALID_TICKET = "invalid ticket"
+    PATH_INDEX_UNAVAILABLE = "The path index isn't available right now, try again later"
+    INVALID_LIST = "A list request needs a path (null for the current directory) and non-negative offset and limit"
+
+    # Protocol
+    FRAMED_PROTOCOL_VERSION = "2"
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+    MAX_BATCH_SIZE = 1000
 
     # Buffers
     BUFFER_SIZE = 2048
-    FILE_BUFFER_SIZE = 4096
+    SEND_BUFFER_SIZE = 1024 * 1024
+    STREAM_BUFFER_SIZE = 64 * 1024
+    RECEIVE_BUFFER_SIZE = 256 * 1024
+    MAX_UPLOAD_SIZE = 1024 ** 4
+    DECOMPRESSION_CHUNK_SIZE = 256 * 1024
+    CHECKSUM_BLOCK_SIZE = 1024 * 1024
+    TRANSFER_BLOCK_SIZE = 4 * 1024 * 1024
+    PARTIAL_EXPIRY_SECONDS = 7 * 24 * 60 * 60
+    PARTIAL_EXPIRY_INTERVAL_SECONDS = 60 * 60
+    PARTIAL_EXPIRY_BATCH = 1000
 
     # Main
     CERT_NOT_FOUND = "Certificate not found"
@@ -39,15 +83,197 @@ class Constants:
     EXITING = "Closing connections..."
     PORTS_VALUE_ERROR = "Ports must be positive integers"
     PORTS_ASSERTION_ERROR = "Main port and Transfer port can not be the same"
+    INVALID_MODE = "Server mode must be 'process', 'async' or 'prefork'"
+    WORKERS_VALUE_ERROR = "Workers must be a positive integer"
+    MAX_TRANSFERS_VALUE_ERROR = "Maximum transfers must be a positive integer"
+    CLIENT_RATE_VALUE_ERROR = "Client rate must be a positive amount of bytes per second, optionally followed by K, M or G"
+    PREFORK_WORKERS = "Pre-forked workers:"
+    ROOT_NOT_A_DIRECTORY = "The served root must be an existing directory"
+    SERVING_ROOT = "Serving"
+
+    # Server modes
+    PROCESS_MODE = "process"
+    ASYNC_MODE = "async"
+    PREFORK_MODE = "prefork"
+    SERVER_MODES = (PROCESS_MODE, ASYNC_MODE, PREFORK_MODE)
+    ASYNC_BACKLOG = 1024
+    COMMAND_THREADS = 8
+    PREFORK_POLL_SECONDS = 1
+    WORKER_DRAIN_SECONDS = 30
+    WORKER_STABLE_SECONDS = 10
+    WORKER_RESPAWN_MIN_SECONDS = 1
+    WORKER_RESPAWN_MAX_SECONDS = 60
 
     READY_FLAG = b'10101010'
+    DEDUP_FLAG = b'01010101'
+    REJECTED_FLAG = b'11001100'
     TRANSFERS_TIMEOUT_SECONDS = 15
     HANDSHAKE_TIMEOUT_SECONDS = 10
     JOINER_INTERVAL_SECONDS = 60 * 5
+    BLOCK_DIGESTS_MIN_SIZE = 32 * 1024 * 1024
+    PARTIAL_SUFFIX = ".part"
+    MANIFEST_SUFFIX = ".manifest"
+
+    # Compression
+    CODECS = ("zlib", "bz2", "lzma")
+    COMPRESSION_LEVELS = range(1, 10)
+    DEFAULT_COMPRESSION_LEVEL = 6
+    COMPRESSION_SAMPLE_SIZE = 256 * 1024
+    COMPRESSION_MIN_SIZE = 4096
+    COMPRESSION_MAX_RATIO = 0.9
+
+    # Delta transfers
+    DELTA_BLOCK_SIZE = 64 * 1024
+    DELTA_MAX_LITERAL = 1024 * 1024
+    DELTA_SUFFIX = ".delta"
+    DELTA_COPY = b"C"
+    DELTA_DATA = b"D"
+    DELTA_END = b"E"
+    SIGNATURE_HEADER = "!QII"
+    SIGNATURE_ENTRY = "!I32s"
+
+    # Directory transfers
+    PACK_ENTRY = "!BQ"
+    PACK_FILE_OK = 0
+    PACK_FILE_MISSING = 1
+    PACK_DIGEST_SIZE = 32
+
+    # Transfer channels
+    CHANNEL_HEADER = "!IcI"
+    CHANNEL_OPEN = b"O"
+    CHANNEL_DATA = b"D"
+    CHANNEL_CLOSE = b"C"
+    CHANNEL_MAX_FRAME = 256 * 1024
+    CHANNEL_MAX_STREAMS = 64
+    CHANNEL_STREAM_FRAMES = 32
+    CHANNEL_STALL_SECONDS = 30
+    CHANNEL_IDLE_TIMEOUT_SECONDS = 5 * 60
+
+    # Directory listings
+    LIST_PAGE_SIZE = 1000
+    LIST_CACHE_DIRECTORIES = 32
+    LIST_RACY_SECONDS = 2
+    LIST_DIRECTORY = "d"
+    LIST_LINK = "l"
+    LIST_FILE = "f"
+
+    # Path index
+    PATH_INDEX_TIMEOUT_SECONDS = 5
+    PATH_INDEX_REFRESH_SECONDS = 5
+    PATH_INDEX_FULL_REFRESH_SECONDS = 60 * 60
+    PATH_INDEX_COMMIT_DIRECTORIES = 500
+    FIND_DEFAULT_LIMIT = 1000
+    FIND_MAX_LIMIT = 10000
+
+    # Transfer scheduling
+    QUEUED_FLAG = b'11110000'
+    ADMITTED_FLAG = b'00001111'
+    TRANSFER_MAX_ACTIVE = 32
+    TRANSFER_QUEUE_NOTICE_SECONDS = 2
+    TRANSFER_QUEUE_TIMEOUT_SECONDS = 60
+    TRANSFER_BURST_SECONDS = 1
+    TRANSFER_BUCKET_SWEEP_SECONDS = 60
+    TRANSFER_THROTTLE_SECONDS = 0.25
+    TRANSFER_THROTTLE_MIN_CHUNK = 1024
+    RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+    # Content store
+    CONTENT_STORE_OBJECTS = "objects"
+    CONTENT_STORE_SUFFIX = ".dedup"
+
+    # Commits
+    FSYNC_NONE = "none"
+    FSYNC_COMMIT = "commit"
+    FSYNC_GROUP = "group"
+    FSYNC_SYNCFS = "syncfs"
+    FSYNC_POLICIES = (FSYNC_NONE, FSYNC_COMMIT, FSYNC_GROUP, FSYNC_SYNCFS)
+    FSYNC_POLICY_ERROR = "Fsync policy must be 'none', 'commit', 'group' or 'syncfs'"
+    COMMIT_FAILED = "The file couldn't be committed"
+
+    # Transfer tickets
+    TICKET_SESSION_QUOTA = MAX_BATCH_SIZE
+    TICKET_SLOTS = 4 * TICKET_SESSION_QUOTA
+    TICKET_SLOT_SIZE = 4352
+    TICKET_SLOT_HEADER = "!16sdBH"  # secret, expiration (monotonic clock), reusable, length of the fields
+    TICKET_SECRET_BYTES = 16
+    TICKET_TTL_SECONDS = 10 * 60
+    TICKET_TOO_BIG = "Path too long to transfer"
+    TICKET_TABLE_FULL = "The server has too many pending transfers, try again later"
+    TICKET_QUOTA_EXCEEDED = "Too many pending transfers in this session, do some of them first"
+
+    # Metrics
+    METRICS_HOST = "127.0.0.1"
+    METRICS_PATH = "/metrics"
+    METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    METRICS_STARTED = "Serving metrics at"
+    METRICS_PORT_VALUE_ERROR = "Metrics port must be a positive integer"
+    ACTIVE_CONNECTIONS = "fileserver_active_connections"
+    COMMAND_DURATION = "fileserver_command_duration_seconds"
+    BYTES_SENT = "fileserver_bytes_sent_total"
+    BYTES_RECEIVED = "fileserver_bytes_received_total"
+    TRANSFER_DURATION = "fileserver_transfer_duration_seconds"
+    TRANSFER_QUEUE_DURATION = "fileserver_transfer_queue_seconds"
+    ACTIVE_TRANSFERS = "fileserver_active_transfers"
+    QUEUED_TRANSFERS = "fileserver_queued_transfers"
+    HANDSHAKE_DURATION = "fileserver_tls_handshake_duration_seconds"
+    CHECKSUM_DURATION = "fileserver_checksum_duration_seconds"
+    LOG_RECORDS_DROPPED = "fileserver_log_records_dropped_total"
+    COMMIT_DURATION = "fileserver_commit_duration_seconds"
+    COMMIT_BATCH_FILES = "fileserver_commit_batch_files"
+    TRANSFER_TICKETS = "fileserver_transfer_tickets_total"
+    INVALID_COMMAND_LABEL = "invalid"
+    METRIC_COMMANDS = ("pwd", "cd", "ls", "mkdir", "get", "put", "sync", "protocol", "batch", "compression", "get_tree",
+                       "put_tree", "list", "find", INVALID_COMMAND_LABEL)
+    METRIC_OPERATIONS = ("get", "put", "delta", "get_tree", "put_tree")
+    METRIC_PORTS = ("main", "transfer")
+    METRIC_TICKET_EVENTS = ("issued", "redeemed", "rejected", "refused")
+    FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+    BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+    METRICS = (  # name, type, help, label, label values, histogram buckets
+        (ACTIVE_CONNECTIONS, "gauge", "Connections open right now", "port", METRIC_PORTS, None),
+        (COMMAND_DURATION, "histogram", "Time to execute a command and send its answer", "command", METRIC_COMMANDS, FAST_BUCKETS),
+        (BYTES_SENT, "counter", "File bytes sent through transfer connections, as they went on the wire", "operation",
+         METRIC_OPERATIONS, None),
+        (BYTES_RECEIVED, "counter", "File bytes received through transfer connections, as they came from the wire",
+         "operation", METRIC_OPERATIONS, None),
+        (TRANSFER_DURATION, "histogram", "Time transfers took once admitted", "operation", METRIC_OPERATIONS, SLOW_BUCKETS),
+        (TRANSFER_QUEUE_DURATION, "histogram", "Time transfers waited for a slot of the scheduler", None, (), SLOW_BUCKETS),
+        (ACTIVE_TRANSFERS, "gauge", "Transfers holding a slot of the scheduler right now", None, (), None),
+        (QUEUED_TRANSFERS, "gauge", "Transfers waiting for a slot of the scheduler right now", None, (), None),
+        (HANDSHAKE_DURATION, "histogram", "Time taken by TLS handshakes", "port", METRIC_PORTS, FAST_BUCKETS),
+        (CHECKSUM_DURATION, "histogram", "Time spent hashing files, checksum cache misses only", "kind",
+         ("file", "blocks", "signatures"), SLOW_BUCKETS),
+        (LOG_RECORDS_DROPPED, "counter", "Log records dropped because the log queue was full", None, (), None),
+        (COMMIT_DURATION, "histogram", "Time to put received files in place, flushes included", None, (), FAST_BUCKETS),
+        (COMMIT_BATCH_FILES, "histogram", "Files flushed together, with the commit and group fsync policies", None, (),
+         BATCH_BUCKETS),
+        (TRANSFER_TICKETS, "counter", "Transfer tickets issued, redeemed, rejected (unknown, expired or used already) "
+                                      "and refused because the table was full", "event", METRIC_TICKET_EVENTS, None),
+    )
+
+    # Logging
+    LOGGER_NAME = "fileserver"
+    LOG_TEXT = "text"
+    LOG_JSON = "json"
+    LOG_FORMATS = (LOG_TEXT, LOG_JSON)
+    LOG_FORMAT_ERROR = "Log format must be 'text' or 'json'"
+    LOG_QUEUE_SIZE = 10000
+    LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+    LOG_FILE_BACKUPS = 5
+    LOG_SAMPLING = {"command": 100}  # only one of every N records of these events is logged
+    SESSION_ID_BYTES = 4
+    TRANSFER_ID_BYTES = 4
+
+    # Checksum cache
+    CHECKSUM_CACHE_MAX_ENTRIES = 10000
+    CHECKSUM_CACHE_MEMORY_ENTRIES = 256
+    CHECKSUM_CACHE_TIMEOUT_SECONDS = 30
+    CHECKSUM_CACHE_FLUSH_SECONDS = 10
 
     @staticmethod
-    def date_time():
-        now = datetime.datetime.now()
+    def date_time(timestamp: float = None):
+        now = datetime.datetime.fromtimestamp(timestamp) if timestamp is not None else datetime.datetime.now()
         year = '{:02d}'.format(now.year)
         month = '{:02d}'.format(now.month)
         day = '{:02d}'.format(now.day)
@@ -57,12 +283,333 @@ class Constants:
         # [16/11/2020 - 12:01]
         return f"[{day}/{month}/{year} - {hour}:{minute}]"
 
+    @staticmethod
+    def checksum_cache_path():
+        default_cache_dir = os.getenv("XDG_CACHE_HOME", default=os.path.join(os.path.expanduser("~"), ".cache"))
+        return os.getenv("CHECKSUM_CACHE_PATH", default=os.path.join(default_cache_dir, "file-server", "checksums.db"))
+
+    @staticmethod
+    def path_index_path():
+        default_cache_dir = os.getenv("XDG_CACHE_HOME", default=os.path.join(os.path.expanduser("~"), ".cache"))
+        return os.getenv("PATH_INDEX_PATH", default=os.path.join(default_cache_dir, "file-server", "paths.db"))
+
+    @staticmethod
+    def content_store_path():
+        return os.getenv("CONTENT_STORE_PATH") or None
+
+    @staticmethod
+    def receive_buffer_size():
+        return int(os.getenv("RECEIVE_BUFFER_SIZE") or Constants.RECEIVE_BUFFER_SIZE)
+
+    @staticmethod
+    def max_upload_size():
+        return int(os.getenv("MAX_UPLOAD_SIZE") or Constants.MAX_UPLOAD_SIZE)
+
+    @staticmethod
+    def scheduler_state(stats: dict):
+        return f"{stats['active']} active, {stats['queued']} queued from {stats['waiting_clients']} clients"
+
+    @staticmethod
+    def bytes_saved(original, sent):
+        return f"saved {original - sent} of {original} bytes"
+
+    @staticmethod
+    def checksum_cache_stats(stats):
+        return f"Checksum cache: {stats['total_hits']} hits, {stats['total_misses']} misses, {stats['entries']} files cached"
+
+
+def transfer_range(transfer_request: dict) -> tuple:
+    """
+    Reads the optional byte range of a get transfer request
+
+    :param transfer_request: Dictionary with all the transfer's metadata
+    :return: a tuple with the offset (0 by default) and the length (None, meaning until EOF, by default)
+    :raises ValueError: if offset or length aren't non-negative integers
+    """
+    offset, length = transfer_request.get("offset") or 0, transfer_request.get("length")
+    if not isinstance(offset, int) or offset < 0 or (length is not None and (not isinstance(length, int) or length < 0)):
+        raise ValueError(Constants.INVALID_RANGE)
+    return offset, length
+
+
+def upload_size(transfer_request: dict):
+    """
+    Reads the size of an upload. It comes from the client, and the partial file's list of blocks and its
+    preallocated space depend on it, so it's checked before anything is allocated
 
-def print_colored(color: str, message: str):
-    print(f"{Constants.COLORS[color.upper()]}{message}{Constants.COLORS['RESET']}")
+    :param transfer_request: Dictionary with all the transfer's metadata
+    :return: the size in bytes, or None if the request doesn't have one (older clients)
+    :raises ValueError: if it isn't a non-negative integer, it's bigger than the maximum upload size, or it doesn't
+    fit in the free space of the file system (plus what a partial file of a previous upload already takes)
+    """
+    filesize = transfer_request.get("filesize")
+    if filesize is None:
+        return None
+    if not isinstance(filesize, int) or isinstance(filesize, bool) or not 0 <= filesize <= Constants.max_upload_size():
+        raise ValueError(Constants.INVALID_FILESIZE)
+    path = transfer_request["absolute_path"]
+    try:
+        stats = os.statvfs(os.path.dirname(path))
+    except OSError:
+        return filesize
+    try:
+        reserved = os.path.getsize(path + Constants.PARTIAL_SUFFIX)
+    except OSError:
+        reserved = 0
+    if filesize > stats.f_bavail * stats.f_frsize + reserved:
+        raise ValueError(Constants.NO_SPACE_FOR_UPLOAD)
+    return filesize
 
 
-def calculate_checksum(filepath):
+def transfer_codec(transfer_request: dict):
+    """
+    Reads the optional compression codec of a transfer request
+
+    :param transfer_request: Dictionary with all the transfer's metadata
+    :return: a tuple with the codec and the level, or None if the transfer isn't compressed
+    :raises ValueError: if the codec or the level aren't supported
+    """
+    codec = transfer_request.get("codec")
+    if codec is None:
+        return None
+    level = transfer_request.get("level") or Constants.DEFAULT_COMPRESSION_LEVEL
+    if codec not in Constants.CODECS or level not in Constants.COMPRESSION_LEVELS:
+        raise ValueError(Constants.INVALID_COMPRESSION)
+    return codec, level
+
+
+def compressor(codec: str, level: int):
+    """
+    :return: a streaming compressor of the given codec, with compress() and flush() methods
+    """
+    if codec == "zlib":
+        return zlib.compressobj(level)
+    if codec == "bz2":
+        return bz2.BZ2Compressor(level)
+    return lzma.LZMACompressor(preset=level)
+
+
+DECOMPRESSION_ERRORS = (EOFError, OSError, zlib.error, lzma.LZMAError)
+
+
+def decompressor(codec: str):
+    """
+    :return: a streaming decompressor of the given codec, with a decompress() method
+    """
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    return lzma.LZMADecompressor()
+
+
+class BoundedDecompressor:
+    """
+    Streaming decompressor whose output is bounded. The codec and the data come from the other side of the
+    connection, and a few hundred bytes of bz2 can inflate to hundreds of MiB, so data is never inflated all at
+    once: each piece is at most DECOMPRESSION_CHUNK_SIZE bytes, and the whole output at most limit bytes, the
+    size that is expected
+    """
+    def __init__(self, codec: str, limit: int):
+        self.__engine = decompressor(codec)
+        self.__remaining = limit
+
+    def decompress(self, data):
+        """
+        Decompresses data, piece by piece. zlib keeps the input it didn't use in unconsumed_tail, bz2 and lzma
+        keep it inside and are called again with no input until they need more
+
+        :param data: compressed bytes received
+        :return: generator of the decompressed pieces
+        :raises EOFError: if the output goes beyond the limit
+        """
+        while True:
+            max_length = min(self.__remaining + 1, Constants.DECOMPRESSION_CHUNK_SIZE)
+            piece = self.__engine.decompress(data, max_length)
+            if len(piece) > self.__remaining:
+                raise EOFError(Constants.DECOMPRESSED_TOO_BIG)
+            self.__remaining -= len(piece)
+            if piece:
+                yield piece
+            if hasattr(self.__engine, "unconsumed_tail"):
+                data = self.__engine.unconsumed_tail
+                if not data and len(piece) < max_length:
+                    return
+            else:
+                data = b""
+                if self.__engine.eof or self.__engine.needs_input:
+                    return
+
+
+def is_compressible(filepath, codec: str, level: int, offset: int = 0) -> bool:
+    """
+    Compresses a sample of the file, its first COMPRESSION_SAMPLE_SIZE bytes from offset, to tell if
+    compressing it is worth the CPU. Already compressed content (archives, images, video) barely shrinks,
+    and tiny files aren't worth it either
+
+    :param filepath: path to the file
+    :param codec: codec that would be used
+    :param level: compression level that would be used
+    :param offset: position of the file where the transfer starts
+    :return: True if the sample shrinks to COMPRESSION_MAX_RATIO of its size or less
+    """
+    with open(filepath, 'rb') as file:
+        file.seek(offset)
+        sample = file.read(Constants.COMPRESSION_SAMPLE_SIZE)
+    if len(sample) < Constants.COMPRESSION_MIN_SIZE:
+        return False
+    engine = compressor(codec, level)
+    compressed_size = len(engine.compress(sample)) + len(engine.flush())
+    return compressed_size <= len(sample) * Constants.COMPRESSION_MAX_RATIO
+
+
+def calculate_checksum(filepath, use_mmap: bool = False) -> str:
+    """
+    Calculates the sha256 checksum of the given file, reading it in blocks of CHECKSUM_BLOCK_SIZE bytes
+    so memory usage doesn't depend on the file size
+
+    :param filepath: path to the file to hash
+    :param use_mmap: if True, the file is memory-mapped and hashed through a memoryview instead of being
+    read into Python buffers
+    :return: hex digest of the file
+    """
+    checksum = hashlib.sha256()
     with open(filepath, 'rb') as file:
-        checksum = hashlib.sha256(file.read())
-        return checksum.hexdigest()
+        if use_mmap and os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for start in range(0, len(view), Constants.CHECKSUM_BLOCK_SIZE):
+                    checksum.update(view[start:start + Constants.CHECKSUM_BLOCK_SIZE])
+        else:
+            buffer = bytearray(Constants.CHECKSUM_BLOCK_SIZE)
+            with memoryview(buffer) as view:
+                while True:
+                    bytes_read = file.readinto(view)
+                    if not bytes_read:
+                        break
+                    checksum.update(view[:bytes_read])
+    return checksum.hexdigest()
+
+
+def calculate_block_checksums(filepath, block_size: int) -> tuple:
+    """
+    Calculates, in a single read of the file, its sha256 checksum and the sha256 checksum of every block of
+    block_size bytes. Block checksums let clients verify byte ranges of the file on their own
+
+    :param filepath: path to the file to hash
+    :param block_size: size of the blocks in bytes (the last block can be shorter)
+    :return: a tuple with the hex digest of the file and the list of hex digests of its blocks
+    """
+    checksum = hashlib.sha256()
+    block_digests = []
+    buffer = bytearray(block_size)
+    with open(filepath, 'rb') as file, memoryview(buffer) as view:
+        while True:
+            bytes_read = file.readinto(view)
+            if not bytes_read:
+                break
+            checksum.update(view[:bytes_read])
+            block_digests.append(hashlib.sha256(view[:bytes_read]).hexdigest())
+    return checksum.hexdigest(), block_digests
+
+
+def blocks_checksum(block_digests: list) -> str:
+    """
+    Calculates the sha256 checksum of a list of block checksums. Two files have the same one if and only if
+    all their blocks match, so it can verify a resumed transfer without reading the blocks that were
+    already confirmed
+
+    :param block_digests: list of hex digests of the file blocks
+    :return: hex digest of the list
+    """
+    return hashlib.sha256("".join(block_digests).encode()).hexdigest()
+
+
+def calculate_signatures(filepath, block_size: int) -> bytes:
+    """
+    Calculates the signature of a file for delta transfers: an adler32 weak checksum, which the client can
+    roll byte by byte to find blocks at any offset, and a sha256 strong checksum of every full block of
+    block_size bytes. A last block shorter than block_size has no signature, it's always sent as data
+
+    :param filepath: path to the file
+    :param block_size: size of the blocks in bytes
+    :return: the signature, a SIGNATURE_HEADER (file size, block size and number of blocks) followed by
+    a SIGNATURE_ENTRY (weak and strong checksum) per block
+    """
+    entry = struct.Struct(Constants.SIGNATURE_ENTRY)
+    entries = []
+    buffer = bytearray(block_size)
+    with open(filepath, 'rb') as file, memoryview(buffer) as view:
+        filesize = os.fstat(file.fileno()).st_size
+        while file.readinto(view) == block_size:
+            entries.append(entry.pack(zlib.adler32(view), hashlib.sha256(view).digest()))
+    return struct.pack(Constants.SIGNATURE_HEADER, filesize, block_size, len(entries)) + b"".join(entries)
+
+
+def walk_tree(root: str) -> tuple:
+    """
+    Lists every directory and regular file under root, using os.scandir() so the type and size of each
+    entry mostly come from the directory listing itself. Symbolic links aren't followed nor listed, so a link
+    can't take a directory transfer outside the served directory
+
+    :param root: path to the directory
+    :return: a tuple with the list of directories and the list of [path, size] of the files, both with paths
+    relative to root and sorted
+    """
+    directories, files = [], []
+    pending = [""]
+    while pending:
+        relative_directory = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative_directory))
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_directory, entry.name)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(relative_path)
+                        pending.append(relative_path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append([relative_path, entry.stat(follow_symlinks=False).st_size])
+                except OSError:
+                    continue
+    return sorted(directories), sorted(files)
+
+
+def tree_path(root: str, relative_path: str) -> str:
+    """
+    :param root: absolute path to the directory being transferred
+    :param relative_path: path of a file or directory inside it
+    :return: the absolute path of relative_path
+    :raises ValueError: if relative_path is absolute or leaves root, also through a symbolic link (the paths
+    come from the client's manifest, so sub/link/file must not lead wherever sub/link points to)
+    """
+    if not isinstance(relative_path, str) or not relative_path or os.path.isabs(relative_path):
+        raise ValueError(Constants.INVALID_TREE_PATH)
+    path = os.path.normpath(os.path.join(root, relative_path))
+    if os.path.commonpath([root, path]) != os.path.normpath(root) or path == os.path.normpath(root):
+        raise ValueError(Constants.INVALID_TREE_PATH)
+    real_root = os.path.realpath(root)
+    if os.path.commonpath([real_root, os.path.realpath(path)]) != real_root:
+        raise ValueError(Constants.INVALID_TREE_PATH)
+    return path
+
+
+def parse_rate(rate: str) -> int:
+    """
+    Reads a transfer rate given in the command line: bytes per second, optionally followed by K, M or G
+    (powers of 1024), like 512K or 1.5M
+
+    :param rate: rate as written by the user
+    :return: bytes per second
+    :raises ValueError: if it isn't a positive rate
+    """
+    unit = rate[-1:].upper() if rate[-1:].isalpha() else ""
+    try:
+        amount = float(rate[:-1] if unit else rate)
+        if unit not in Constants.RATE_UNITS or not amount > 0:
+            raise ValueError
+        return max(int(amount * Constants.RATE_UNITS[unit]), 1)
+    except (ValueError, OverflowError):
+        raise ValueError(Constants.CLIENT_RATE_VALUE_ERROR)
@@ -0,0 +1,26 @@
+import os
+import sys
+import random
+import pytest
+
+# the server and the client aren't installed packages, they're run from their directories, like the benchmarks do
+REPOSITORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(REPOSITORY_PATH, "server"))
+sys.path.insert(0, os.path.join(REPOSITORY_PATH, "client"))
+
+
+def split(data: bytes, rng: random.Random, max_size: int) -> list:
+    """
+    :return: data cut in pieces of random sizes, from 1 to max_size bytes, like a socket could deliver it
+    """
+    pieces, position = [], 0
+    while position < len(data):
+        size = rng.randint(1, max_size)
+        pieces.append(data[position:position + size])
+        position += size
+    return pieces
+
+
+@pytest.fixture
+def rng() -> random.Random:
+    return random.Random(1234)
@@ -0,0 +1,27 @@
+import hashlib
+import sqlite3
+from src.ChecksumCache import ChecksumCache
+
+
+def last_used(database_path) -> list:
+    with sqlite3.connect(database_path) as connection:
+        return [row[0] for row in connection.execute("SELECT last_used FROM checksums")]
+
+
+def test_hits_are_written_on_flush(tmp_path):
+    database_path, path = tmp_path / "cache.db", tmp_path / "file"
+    path.write_bytes(b"data")
+    cache = ChecksumCache(str(database_path))
+    cache.checksum(str(path))
+    cache.flush()
+    stored = last_used(database_path)
+
+    cache = ChecksumCache(str(database_path))
+    assert cache.checksum(str(path)) == hashlib.sha256(b"data").hexdigest()
+    assert cache.checksum(str(path)) == hashlib.sha256(b"data").hexdigest()
+    assert last_used(database_path) == stored
+    assert (cache.hits, cache.misses) == (2, 0)
+
+    stats = cache.stats()
+    assert (stats["total_hits"], stats["total_misses"], stats["entries"]) == (2, 1, 1)
+    assert last_used(database_path)[0] > stored[0]
@@ -0,0 +1,70 @@
+import os
+import threading
+import pytest
+from src.Committer import Committer, SYNCFS
+from src.server_helper import Constants
+
+
+def temporary_files(directory, count: int) -> list:
+    renames = []
+    for index in range(count):
+        temporary_path = directory / f"{index}{Constants.PARTIAL_SUFFIX}"
+        temporary_path.write_bytes(str(index).encode())
+        renames.append((str(temporary_path), str(directory / str(index))))
+    return renames
+
+
+@pytest.fixture
+def fsyncs(monkeypatch) -> list:
+    """
+    Paths flushed with fsync(), in order
+    """
+    flushed = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda descriptor: flushed.append(os.readlink(f"/proc/self/fd/{descriptor}"))
+                        or fsync(descriptor))
+    return flushed
+
+
+@pytest.mark.parametrize("policy", Constants.FSYNC_POLICIES)
+def test_commit_all(tmp_path, policy):
+    renames = temporary_files(tmp_path, 5)
+    assert Committer(policy).commit_all(renames) == [None] * 5
+    assert sorted(os.listdir(tmp_path)) == [str(index) for index in range(5)]
+
+
+def test_missing_file_isnt_renamed(tmp_path):
+    renames = temporary_files(tmp_path, 2)
+    os.remove(renames[0][0])
+    errors = Committer(Constants.FSYNC_COMMIT).commit_all(renames)
+    assert isinstance(errors[0], FileNotFoundError) and errors[1] is None
+    assert os.listdir(tmp_path) == ["1"]
+
+
+@pytest.mark.parametrize("policy", [Constants.FSYNC_COMMIT, Constants.FSYNC_GROUP])
+def test_every_file_and_its_directory_are_flushed(tmp_path, fsyncs, policy):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    renames = temporary_files(tmp_path / "a", 3) + temporary_files(tmp_path / "b", 2)
+    Committer(policy).commit_all(renames)
+    assert fsyncs == [temporary_path for temporary_path, _ in renames] + [str(tmp_path / "a"), str(tmp_path / "b")]
+
+
+@pytest.mark.skipif(SYNCFS is None, reason="syncfs() is Linux only")
+def test_syncfs_is_only_used_when_asked_for(tmp_path, fsyncs):
+    Committer(Constants.FSYNC_SYNCFS).commit_all(temporary_files(tmp_path, 5))
+    assert fsyncs == [str(tmp_path)]
+
+
+def test_group_commit_from_several_threads(tmp_path):
+    committer = Committer(Constants.FSYNC_GROUP)
+    renames = temporary_files(tmp_path, 20)
+    errors = {}
+    threads = [threading.Thread(target=lambda rename=rename: errors.update({rename: committer.commit(*rename)}))
+               for rename in renames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == {rename: None for rename in renames}
+    assert sorted(os.listdir(tmp_path), key=int) == [str(index) for index in range(20)]
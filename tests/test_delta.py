@@ -0,0 +1,147 @@
+import os
+import hashlib
+import pytest
+from models.DeltaEncoder import DeltaEncoder
+from src.DeltaPatcher import DeltaPatcher
+from src.server_helper import Constants, calculate_signatures
+from conftest import split
+
+BLOCK_SIZE = 64
+
+
+def delta_round_trip(tmp_path, basis: bytes, new: bytes, rng):
+    """
+    Encodes new against the signature of basis, like the client does, and applies the delta to basis, like
+    the server does, feeding it in pieces of random sizes
+
+    :return: the rebuilt file and the encoder, which counts the bytes copied and sent
+    """
+    path = tmp_path / "file"
+    path.write_bytes(basis)
+    encoder = DeltaEncoder(calculate_signatures(str(path), BLOCK_SIZE))
+    delta = b"".join(encoder.instructions(new))
+    patcher = DeltaPatcher(str(path), BLOCK_SIZE, hashlib.sha256(new).hexdigest(), len(new))
+    patcher.open()
+    finished = [patcher.feed(piece) for piece in split(delta, rng, 100)]
+    assert finished[-1] and not any(finished[:-1])
+    assert patcher.commit()
+    assert not os.path.exists(patcher.temporary_path)
+    return path.read_bytes(), encoder
+
+
+@pytest.fixture
+def basis(rng) -> bytes:
+    return rng.randbytes(50 * BLOCK_SIZE + 17)
+
+
+@pytest.mark.parametrize("change", [
+    lambda data: data,
+    lambda data: data[:1000] + b"inserted in the middle" + data[1000:],
+    lambda data: b"inserted at the start" + data,
+    lambda data: data + b"appended at the end",
+    lambda data: data[:700] + data[1500:],
+    lambda data: data[BLOCK_SIZE:],
+    lambda data: data[:-BLOCK_SIZE - 5],
+    lambda data: data[2000:] + data[:2000],
+    lambda data: b"",
+    lambda data: data[:BLOCK_SIZE - 1],
+], ids=["unchanged", "insertion", "prefix", "suffix", "deletion", "first-block-removed", "truncated", "rotated",
+        "emptied", "shorter-than-a-block"])
+def test_round_trip(tmp_path, basis, rng, change):
+    new = change(basis)
+    rebuilt, encoder = delta_round_trip(tmp_path, basis, new, rng)
+    assert rebuilt == new
+    assert encoder.copied + encoder.literal == len(new)
+
+
+def test_insertion_reuses_the_blocks_after_it(tmp_path, basis, rng):
+    new = basis[:1000] + b"x" * 10 + basis[1000:]
+    _, encoder = delta_round_trip(tmp_path, basis, new, rng)
+    assert encoder.literal < 3 * BLOCK_SIZE
+
+
+@pytest.mark.parametrize("basis_size", [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE])
+@pytest.mark.parametrize("new_size", [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, 3 * BLOCK_SIZE + 1])
+def test_small_files(tmp_path, rng, basis_size, new_size):
+    basis = rng.randbytes(basis_size)
+    new = (basis + rng.randbytes(new_size))[:new_size]
+    assert delta_round_trip(tmp_path, basis, new, rng)[0] == new
+
+
+def test_wrong_checksum_keeps_the_basis(tmp_path, basis):
+    path = tmp_path / "file"
+    path.write_bytes(basis)
+    encoder = DeltaEncoder(calculate_signatures(str(path), BLOCK_SIZE))
+    patcher = DeltaPatcher(str(path), BLOCK_SIZE, hashlib.sha256(b"something else").hexdigest(), len(basis) + 3)
+    patcher.open()
+    assert patcher.feed(b"".join(encoder.instructions(basis + b"new")))
+    assert not patcher.commit()
+    assert path.read_bytes() == basis
+    assert not os.path.exists(patcher.temporary_path)
+
+
+@pytest.mark.parametrize("instruction", [
+    Constants.DELTA_COPY + DeltaPatcher.COPY.pack(1000, 1),
+    Constants.DELTA_COPY + DeltaPatcher.COPY.pack(0, 0),
+    Constants.DELTA_DATA + DeltaPatcher.LENGTH.pack(Constants.DELTA_MAX_LITERAL + 1),
+    b"X",
+], ids=["copy-beyond-basis", "empty-copy", "literal-too-long", "unknown-opcode"])
+def test_bad_instructions(tmp_path, basis, instruction):
+    path = tmp_path / "file"
+    path.write_bytes(basis)
+    patcher = DeltaPatcher(str(path), BLOCK_SIZE, hashlib.sha256(basis).hexdigest(), len(basis))
+    patcher.open()
+    with pytest.raises(ValueError):
+        patcher.feed(instruction)
+    patcher.discard()
+    assert path.read_bytes() == basis
+
+
+@pytest.mark.parametrize("instruction", [
+    Constants.DELTA_COPY + DeltaPatcher.COPY.pack(0, 1),
+    Constants.DELTA_DATA + DeltaPatcher.LENGTH.pack(BLOCK_SIZE + 1) + bytes(BLOCK_SIZE + 1),
+], ids=["copy", "literal"])
+def test_delta_bigger_than_the_declared_size(tmp_path, basis, instruction):
+    """
+    Copy instructions are 9 bytes, and each one can repeat the whole basis
+    """
+    path = tmp_path / "file"
+    path.write_bytes(basis)
+    patcher = DeltaPatcher(str(path), BLOCK_SIZE, hashlib.sha256(basis).hexdigest(), BLOCK_SIZE)
+    patcher.open()
+    patcher.feed(Constants.DELTA_COPY + DeltaPatcher.COPY.pack(0, 1))
+    with pytest.raises(ValueError, match=Constants.INVALID_DELTA):
+        patcher.feed(instruction)
+    patcher.discard()
+    assert os.listdir(tmp_path) == ["file"]
+
+
+def test_delta_smaller_than_the_declared_size(tmp_path, basis):
+    path = tmp_path / "file"
+    path.write_bytes(basis)
+    patcher = DeltaPatcher(str(path), BLOCK_SIZE, hashlib.sha256(basis[:BLOCK_SIZE]).hexdigest(), BLOCK_SIZE + 1)
+    patcher.open()
+    assert patcher.feed(Constants.DELTA_COPY + DeltaPatcher.COPY.pack(0, 1) + Constants.DELTA_END)
+    assert not patcher.commit()
+    assert os.listdir(tmp_path) == ["file"]
+
+
+def test_concurrent_deltas_of_the_same_file(tmp_path, basis, rng):
+    path = tmp_path / "file"
+    path.write_bytes(basis)
+    encoder = DeltaEncoder(calculate_signatures(str(path), BLOCK_SIZE))
+    versions = [basis + b"first", b"second" + basis]
+    patchers = [DeltaPatcher(str(path), BLOCK_SIZE, hashlib.sha256(new).hexdigest(), len(new)) for new in versions]
+    for patcher in patchers:
+        patcher.open()
+    assert patchers[0].temporary_path != patchers[1].temporary_path
+    deltas = [split(b"".join(encoder.instructions(new)), rng, 100) for new in versions]
+    for pieces in zip(*deltas):
+        for patcher, piece in zip(patchers, pieces):
+            patcher.feed(piece)
+    for patcher, pieces in zip(patchers, deltas):
+        for piece in pieces[len(min(deltas, key=len)):]:
+            patcher.feed(piece)
+    assert all(patcher.commit() for patcher in patchers)
+    assert path.read_bytes() == versions[1]
+    assert os.listdir(tmp_path) == ["file"]
@@ -0,0 +1,49 @@
+import json
+import pytest
+from src.MessageStream import MessageStream
+from models.MessageStream import MessageStream as ClientMessageStream
+from conftest import split
+
+MESSAGES = [{"command": "ls"}, {"command": "get", "argument": "ñandú.txt"}, {"command": "put", "argument": "€" * 100}]
+
+
+@pytest.mark.parametrize("stream_class, framed", [(MessageStream, True), (ClientMessageStream, True),
+                                                  (ClientMessageStream, False)], ids=["server", "client", "client-unframed"])
+def test_messages_split_at_any_point(rng, stream_class, framed):
+    """
+    The server reads unframed messages strictly, it can't tell a truncated message from a bad formed one
+    """
+    stream = stream_class(None, framed=framed)
+    received = []
+    for piece in split(b"".join(stream.encode(message) for message in MESSAGES), rng, 7):
+        stream.feed(piece)
+        while (message := stream.next_message()) is not None:
+            received.append(message)
+    assert received == MESSAGES
+
+
+@pytest.mark.parametrize("stream_class", [MessageStream, ClientMessageStream], ids=["server", "client"])
+def test_framed_message_that_isnt_utf8(stream_class):
+    stream = stream_class(None, framed=True)
+    stream.feed(MessageStream.HEADER.pack(2) + b"\xff\xfe" + stream.encode(MESSAGES[0]))
+    with pytest.raises(json.decoder.JSONDecodeError):
+        stream.next_message()
+    assert stream.next_message() == MESSAGES[0]
+
+
+def test_unframed_message_that_isnt_utf8():
+    stream = MessageStream(None)
+    stream.feed(b'{"command": "ls"} \xff\xfe')
+    assert stream.next_message() == {"command": "ls"}
+    with pytest.raises(json.decoder.JSONDecodeError):
+        stream.next_message()
+    stream.feed(b'{"command": "ls"}')
+    assert stream.next_message() == {"command": "ls"}
+
+
+def test_lenient_stream_waits_for_the_rest_of_the_json():
+    stream = ClientMessageStream(None)
+    stream.feed(b'{"status_code": 2')
+    assert stream.next_message() is None
+    stream.feed(b'00}')
+    assert stream.next_message() == {"status_code": 200}
@@ -0,0 +1,106 @@
+import os
+import time
+import hashlib
+import pytest
+from src.PartialFile import PartialFile
+from src.server_helper import Constants, blocks_checksum
+
+BLOCK_SIZE = 1024
+
+
+@pytest.fixture
+def data(rng) -> bytes:
+    return rng.randbytes(10 * BLOCK_SIZE + 100)
+
+
+def block_digests(data: bytes) -> list:
+    return [hashlib.sha256(data[start:start + BLOCK_SIZE]).hexdigest() for start in range(0, len(data), BLOCK_SIZE)]
+
+
+def new_partial(path, data: bytes, digests: list = None) -> PartialFile:
+    return PartialFile(str(path), hashlib.sha256(data).hexdigest(), len(data), BLOCK_SIZE, digests)
+
+
+def test_complete_upload(tmp_path, data):
+    partial = new_partial(tmp_path / "file", data)
+    assert partial.open() == 0
+    assert os.path.getsize(partial.part_path) == len(data)
+    assert partial.write(data)
+    assert partial.is_complete()
+    assert partial.commit()
+    assert (tmp_path / "file").read_bytes() == data
+    assert not os.path.exists(partial.part_path) and not os.path.exists(partial.manifest_path)
+
+
+def test_resumed_upload(tmp_path, data):
+    partial = new_partial(tmp_path / "file", data)
+    partial.open()
+    assert partial.write(data[:3 * BLOCK_SIZE + 500])
+    partial.close()
+    assert PartialFile.resume_point(str(tmp_path / "file")) == (hashlib.sha256(data).hexdigest(), 3 * BLOCK_SIZE)
+
+    partial = new_partial(tmp_path / "file", data)
+    offset = partial.open()
+    assert offset == 3 * BLOCK_SIZE
+    assert partial.write(data[offset:])
+    assert partial.received_checksum() is None
+    assert not partial.commit()
+
+    partial = new_partial(tmp_path / "file", data)
+    partial.open()
+    partial.write(data[:2 * BLOCK_SIZE])
+    partial.close()
+    partial = new_partial(tmp_path / "file", data)
+    offset = partial.open()
+    assert partial.write(data[offset:])
+    assert partial.commit(blocks_checksum(block_digests(data)))
+    assert (tmp_path / "file").read_bytes() == data
+
+
+def test_other_file_isnt_resumed(tmp_path, data):
+    partial = new_partial(tmp_path / "file", data)
+    partial.open()
+    partial.write(data[:5 * BLOCK_SIZE])
+    partial.close()
+    assert new_partial(tmp_path / "file", data[::-1]).open() == 0
+
+
+def test_write_beyond_the_size(tmp_path, data):
+    partial = new_partial(tmp_path / "file", data)
+    partial.open()
+    assert not partial.write(data + b"more")
+    partial.discard()
+
+
+def test_block_that_doesnt_match_isnt_confirmed(tmp_path, data):
+    corrupted = data[:BLOCK_SIZE] + bytes(BLOCK_SIZE) + data[2 * BLOCK_SIZE:]
+    partial = new_partial(tmp_path / "file", data, block_digests(data))
+    partial.open()
+    assert not partial.write(corrupted)
+    assert partial.missing_blocks()[0] == 1
+    partial.discard()
+
+
+@pytest.mark.parametrize("seek", [-1, 1, BLOCK_SIZE + 1, 4 * BLOCK_SIZE])
+def test_invalid_resume_offset(tmp_path, data, seek):
+    partial = new_partial(tmp_path / "file", data)
+    partial.open()
+    partial.write(data[:2 * BLOCK_SIZE])
+    with pytest.raises(ValueError, match=Constants.INVALID_RESUME):
+        partial.seek(seek)
+    partial.discard()
+
+
+def test_expire(tmp_path, data):
+    abandoned, running = new_partial(tmp_path / "abandoned", data), new_partial(tmp_path / "running", data)
+    for partial in (abandoned, running):
+        partial.open()
+        partial.write(data[:BLOCK_SIZE])
+        partial.close()
+    old = time.time() - Constants.PARTIAL_EXPIRY_SECONDS - 60
+    for path in (abandoned.part_path, abandoned.manifest_path, running.part_path):
+        os.utime(path, (old, old))
+
+    assert PartialFile.expire([abandoned.path, running.path, str(tmp_path / "missing")]) == 1
+    assert not os.path.exists(abandoned.part_path) and not os.path.exists(abandoned.manifest_path)
+    assert os.path.exists(running.part_path) and os.path.exists(running.manifest_path)
@@ -0,0 +1,83 @@
+import os
+import pytest
+from src import TreePack
+from src.server_helper import Constants, walk_tree, tree_path
+from src.WorkingDirectory import ServedRoot
+
+
+@pytest.fixture
+def escape(tmp_path) -> tuple:
+    """
+    A served directory with symbolic links to a file and a directory outside of it
+    """
+    root, outside = tmp_path / "root", tmp_path / "outside"
+    root.mkdir()
+    outside.mkdir()
+    (outside / "secret").write_bytes(b"secret")
+    (root / "file").write_bytes(b"file")
+    (root / "link_to_file").symlink_to(outside / "secret")
+    (root / "link_to_directory").symlink_to(outside)
+    return str(root), str(outside)
+
+
+def test_walk_tree_doesnt_follow_links(escape):
+    root, _ = escape
+    assert walk_tree(root) == ([], [["file", 4]])
+
+
+@pytest.mark.parametrize("relative_path", ["../outside/secret", "/etc/passwd", "link_to_directory/secret",
+                                           "link_to_directory/new", ""])
+def test_tree_path_stays_inside(escape, relative_path):
+    root, _ = escape
+    with pytest.raises(ValueError):
+        tree_path(root, relative_path)
+
+
+@pytest.mark.parametrize("relative_path", ["link_to_file", "link_to_directory/secret"])
+def test_sender_refuses_links(escape, relative_path):
+    root, _ = escape
+    with pytest.raises(ValueError):
+        list(TreePack.PackSender(root, [relative_path]).chunks())
+
+
+def test_receiver_refuses_links(escape):
+    root, outside = escape
+    stream = b"".join(TreePack.PackSender(root, ["file"]).chunks())
+    for files, directories in [(["link_to_directory/planted"], []), (["link_to_file"], []),
+                               ([], ["link_to_directory/new_directory"])]:
+        receiver = TreePack.PackReceiver(root, files, directories, overwrite=True)
+        with pytest.raises(ValueError):
+            receiver.open()
+            receiver.feed(stream)
+        receiver.close()
+    assert os.listdir(outside) == ["secret"]
+
+
+def test_links_put_after_the_check_arent_followed(escape, monkeypatch):
+    """
+    A link can replace a file between tree_path() and the moment it's opened, so files are opened without
+    following a link in their last component
+    """
+    root, outside = escape
+    monkeypatch.setattr(TreePack, "tree_path", os.path.join)
+    stream = b"".join(TreePack.PackSender(root, ["link_to_file"]).chunks())
+    assert stream == TreePack.PackSender.ENTRY.pack(Constants.PACK_FILE_MISSING, 0)
+
+    os.symlink(os.path.join(outside, "planted"), os.path.join(root, "file" + Constants.PARTIAL_SUFFIX))
+    stream = b"".join(TreePack.PackSender(root, ["file"]).chunks())
+    receiver = TreePack.PackReceiver(root, ["file"], overwrite=True)
+    receiver.open()
+    assert receiver.feed(stream)
+    receiver.close()
+    assert receiver.received_files == 0
+    assert os.listdir(outside) == ["secret"]
+
+
+def test_served_root_encloses(escape):
+    root, outside = escape
+    served_root = ServedRoot(root)
+    assert served_root.encloses(os.path.join(root, "file"))
+    assert served_root.encloses(os.path.join(root, "new_file"))
+    assert not served_root.encloses(os.path.join(root, "link_to_file"))
+    assert not served_root.encloses(os.path.join(root, "link_to_directory", "secret"))
+    served_root.close()
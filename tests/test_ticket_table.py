@@ -0,0 +1,67 @@
+import pytest
+from src.TicketTable import TicketTable
+from src.server_helper import Constants
+
+FIELDS = {"operation": "get", "absolute_path": "/srv/file"}
+
+
+def test_single_use_ticket():
+    tickets = TicketTable(slots=4)
+    token = tickets.issue(FIELDS)
+    assert tickets.check(token)
+    assert tickets.redeem(token) == FIELDS
+    assert tickets.redeem(token) is None
+    assert not tickets.check(token)
+
+
+def test_reusable_ticket():
+    tickets = TicketTable(slots=4)
+    token = tickets.issue(FIELDS, reusable=True)
+    assert tickets.redeem(token) == FIELDS
+    assert tickets.redeem(token) == FIELDS
+
+
+@pytest.mark.parametrize("token", [None, "", "0", "x.00", "99.00", "-1.00", "0.zz", "0." + "00" * 16])
+def test_invalid_tokens(token):
+    tickets = TicketTable(slots=4)
+    tickets.issue(FIELDS)
+    assert tickets.redeem(token) is None
+
+
+def test_forged_secret():
+    tickets = TicketTable(slots=4)
+    index, secret = tickets.issue(FIELDS).split(".")
+    assert tickets.redeem(f"{index}.{'0' * len(secret)}") is None
+
+
+def test_full_table_doesnt_evict_live_tickets():
+    tickets = TicketTable(slots=3)
+    tokens = [tickets.issue(dict(FIELDS, index=index)) for index in range(3)]
+    with pytest.raises(ValueError, match=Constants.TICKET_TABLE_FULL):
+        tickets.issue(FIELDS)
+    assert [tickets.check(token) for token in tokens] == [True] * 3
+
+    assert tickets.redeem(tokens[1]) == dict(FIELDS, index=1)
+    token = tickets.issue(FIELDS)
+    assert token.split(".")[0] == "1"
+    assert tickets.redeem(tokens[0]) == dict(FIELDS, index=0)
+
+
+def test_expired_tickets_free_their_slot(monkeypatch):
+    monkeypatch.setattr(Constants, "TICKET_TTL_SECONDS", -1)
+    tickets = TicketTable(slots=1)
+    token = tickets.issue(FIELDS)
+    assert not tickets.check(token)
+    assert tickets.redeem(tickets.issue(FIELDS)) is None
+
+
+def test_live():
+    tickets = TicketTable(slots=4)
+    tokens = [tickets.issue(FIELDS) for _ in range(3)]
+    tickets.redeem(tokens[0])
+    assert tickets.live(tokens) == tokens[1:]
+
+
+def test_fields_too_big():
+    with pytest.raises(ValueError, match=Constants.TICKET_TOO_BIG):
+        TicketTable(slots=1).issue({"absolute_path": "x" * Constants.TICKET_SLOT_SIZE})
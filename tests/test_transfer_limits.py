@@ -0,0 +1,69 @@
+import bz2
+import lzma
+import zlib
+import pytest
+from models import client_helper
+from src import server_helper
+from src.server_helper import Constants, upload_size
+
+CODECS = {"zlib": zlib.compress, "bz2": bz2.compress, "lzma": lzma.compress}
+
+
+@pytest.mark.parametrize("filesize", [-1, 1.5, "10", True, [], Constants.MAX_UPLOAD_SIZE + 1])
+def test_invalid_filesize(tmp_path, filesize):
+    with pytest.raises(ValueError, match=Constants.INVALID_FILESIZE):
+        upload_size({"absolute_path": str(tmp_path / "file"), "filesize": filesize})
+
+
+def test_maximum_upload_size_from_the_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("MAX_UPLOAD_SIZE", "1000")
+    request = {"absolute_path": str(tmp_path / "file")}
+    assert upload_size(dict(request, filesize=1000)) == 1000
+    with pytest.raises(ValueError, match=Constants.INVALID_FILESIZE):
+        upload_size(dict(request, filesize=1001))
+
+
+def test_filesize_bigger_than_the_free_space(tmp_path):
+    with pytest.raises(ValueError, match=Constants.NO_SPACE_FOR_UPLOAD):
+        upload_size({"absolute_path": str(tmp_path / "file"), "filesize": Constants.MAX_UPLOAD_SIZE})
+
+
+def test_valid_filesize(tmp_path):
+    request = {"absolute_path": str(tmp_path / "file")}
+    assert upload_size(request) is None
+    assert upload_size(dict(request, filesize=0)) == 0
+    assert upload_size(dict(request, filesize=1024)) == 1024
+
+
+@pytest.fixture(params=[server_helper, client_helper], ids=["server", "client"])
+def helper(request):
+    return request.param
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_decompression_round_trip(helper, codec, rng):
+    data = rng.randbytes(100000) + bytes(3 * Constants.DECOMPRESSION_CHUNK_SIZE)
+    compressed = CODECS[codec](data)
+    decompressor = helper.BoundedDecompressor(codec, len(data))
+    pieces = [piece for start in range(0, len(compressed), 1000)
+              for piece in decompressor.decompress(compressed[start:start + 1000])]
+    assert b"".join(pieces) == data
+    assert max(len(piece) for piece in pieces) <= Constants.DECOMPRESSION_CHUNK_SIZE
+
+
+@pytest.fixture(scope="module", params=CODECS)
+def bomb(request) -> tuple:
+    return request.param, CODECS[request.param](bytes(32 * 1024 * 1024))
+
+
+def test_decompression_bomb(helper, bomb):
+    """
+    A few KiB that inflate to 32 MiB must stop being inflated as soon as they go beyond the expected size
+    """
+    codec, data = bomb
+    decompressor = helper.BoundedDecompressor(codec, 1024 * 1024)
+    inflated = 0
+    with pytest.raises(EOFError, match=Constants.DECOMPRESSED_TOO_BIG):
+        for piece in decompressor.decompress(data):
+            inflated += len(piece)
+    assert inflated <= 1024 * 1024
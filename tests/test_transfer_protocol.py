@@ -0,0 +1,121 @@
+import os
+import json
+import socket
+import hashlib
+import pytest
+from models import client_helper
+from src.TransferProtocol import TransferAdmission, FileUpload, PackUpload, manifest_size
+from src.TransferScheduler import TransferScheduler
+from src.server_helper import Constants
+
+
+class ChecksumCache:
+    """
+    Keeps what the transfers store, instead of a database
+    """
+    def __init__(self):
+        self.files = {}
+
+    def invalidate(self, path: str) -> None:
+        self.files.pop(path, None)
+
+    def store_file(self, path: str, sha256sum: str, block_size: int = None, block_digests: list = None) -> None:
+        self.files[path] = sha256sum
+
+
+@pytest.fixture
+def ticket():
+    return TransferScheduler().request("127.0.0.1", lambda: None)
+
+
+def new_upload(path, data: bytes, ticket, checksum_cache, **fields) -> FileUpload:
+    request = {"operation": "put", "absolute_path": str(path), "sha256sum": hashlib.sha256(data).hexdigest(),
+               "filesize": len(data), **fields}
+    return FileUpload(request, ("127.0.0.1", 1), ticket, checksum_cache, None, None)
+
+
+def test_upload(tmp_path, rng, ticket):
+    data, checksum_cache = rng.randbytes(300 * 1024), ChecksumCache()
+    upload = new_upload(tmp_path / "file", data, ticket, checksum_cache)
+    assert upload.prepare() and not upload.deduplicate() and upload.open()
+    assert all(upload.feed(memoryview(data)[start:start + 1000]) for start in range(0, len(data), 1000))
+    upload.finish()
+    assert (tmp_path / "file").read_bytes() == data
+    assert checksum_cache.files == {str(tmp_path / "file"): hashlib.sha256(data).hexdigest()}
+
+
+def test_interrupted_upload_is_kept(tmp_path, rng, ticket):
+    data, checksum_cache = rng.randbytes(300 * 1024), ChecksumCache()
+    upload = new_upload(tmp_path / "file", data, ticket, checksum_cache)
+    upload.prepare()
+    upload.open()
+    assert upload.feed(data[:1000])
+    upload.finish()
+    assert not (tmp_path / "file").exists() and (tmp_path / f"file{Constants.PARTIAL_SUFFIX}").exists()
+    assert not checksum_cache.files
+
+
+def test_upload_bigger_than_its_size(tmp_path, rng, ticket):
+    data = rng.randbytes(1000)
+    upload = new_upload(tmp_path / "file", data, ticket, ChecksumCache())
+    upload.prepare()
+    upload.open()
+    assert not upload.feed(data + b"more")
+
+
+@pytest.mark.parametrize("filesize", [-1, "10", True, Constants.MAX_UPLOAD_SIZE + 1])
+def test_invalid_upload_size_is_rejected(tmp_path, ticket, filesize):
+    assert not new_upload(tmp_path / "file", b"", ticket, ChecksumCache(), filesize=filesize).prepare()
+    assert not os.listdir(tmp_path)
+
+
+def test_pack_upload(tmp_path, ticket):
+    (tmp_path / "existing").write_bytes(b"old")
+    pack = PackUpload({"operation": "put_tree", "absolute_path": str(tmp_path)}, ("127.0.0.1", 1), ticket, None)
+    assert pack.start(json.dumps({"files": ["existing", "new"]}).encode()) == b"10"
+    assert not pack.finished
+    assert pack.finish() == b""
+
+
+@pytest.mark.parametrize("size", [None, 0, True, "10", Constants.MAX_MESSAGE_SIZE + 1])
+def test_invalid_manifest_size(size):
+    with pytest.raises(ValueError, match=Constants.INVALID_PACK):
+        manifest_size({"manifest_size": size})
+
+
+def test_admission_flags():
+    scheduler = TransferScheduler(max_active=1)
+    running = scheduler.request("127.0.0.1", lambda: None)
+    admitted = []
+    admission = TransferAdmission(scheduler, ("127.0.0.1", 1), {"operation": "get", "queue": True}, lambda: admitted.append(1))
+    assert not admission.ticket.admitted and admission.notice() == Constants.QUEUED_FLAG
+    scheduler.release(running)
+    assert admitted and admission.admit() == Constants.ADMITTED_FLAG
+    admission.give_up()
+    assert scheduler.stats() == {"active": 0, "queued": 0, "waiting_clients": 0}
+
+
+def test_rejected_ticket_flag():
+    server_socket, client_socket = socket.socketpair()
+    with server_socket, client_socket:
+        server_socket.sendall(Constants.QUEUED_FLAG + Constants.REJECTED_FLAG)
+        with pytest.raises(client_helper.TransferRejected):
+            client_helper.wait_for_admission(client_socket)
+
+
+def test_admission_without_flags_times_out(monkeypatch):
+    scheduler = TransferScheduler(max_active=0)
+    admission = TransferAdmission(scheduler, ("127.0.0.1", 1), {"operation": "get"}, lambda: None)
+    assert admission.notice() == b""
+    monkeypatch.setattr(Constants, "TRANSFER_QUEUE_TIMEOUT_SECONDS", 0)
+    with pytest.raises(TimeoutError):
+        admission.notice()
+    admission.give_up()
+    assert scheduler.stats()["queued"] == 0
+
+
+@pytest.mark.parametrize("resume", [-1, "10", 1.5, True, [], 1001])
+def test_invalid_resume_offset_is_rejected(tmp_path, rng, ticket, resume):
+    upload = new_upload(tmp_path / "file", rng.randbytes(1000), ticket, ChecksumCache(), resume=resume)
+    assert not upload.prepare()
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,86 @@
+import time
+import pytest
+from src.Metrics import METRICS
+from src.TransferScheduler import TransferScheduler
+from src.server_helper import Constants
+
+
+class Clock:
+    """
+    Replaces time.monotonic() in the scheduler, so waiting is moving it forward
+    """
+    def __init__(self):
+        self.now = time.monotonic()
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_admission_in_turns():
+    scheduler = TransferScheduler(max_active=1)
+    admitted = []
+    tickets = [scheduler.request(client, lambda client=client: admitted.append(client)) for client in "AAAB"]
+    for ticket in tickets[:2]:
+        scheduler.release(ticket)
+    assert admitted == ["A", "A", "B"]
+    assert scheduler.cancel(tickets[2])
+    scheduler.release(tickets[3])
+    assert admitted == ["A", "A", "B"]
+    assert scheduler.stats() == {"active": 0, "queued": 0, "waiting_clients": 0}
+
+
+def gauges() -> tuple:
+    """
+    :return: the values of the active and queued transfers gauges
+    """
+    lines = METRICS.render().splitlines()
+    return tuple(next(int(line.split()[1]) for line in lines if line.startswith(f"{name} "))
+                 for name in (Constants.ACTIVE_TRANSFERS, Constants.QUEUED_TRANSFERS))
+
+
+def test_transfer_gauges():
+    active, queued = gauges()
+    scheduler = TransferScheduler(max_active=2)
+    tickets = [scheduler.request(client, lambda: None) for client in "AABC"]
+    assert gauges() == (active + 2, queued + 2)
+    assert scheduler.cancel(tickets[3])
+    assert gauges() == (active + 2, queued + 1)
+    scheduler.release(tickets[0])
+    assert gauges() == (active + 2, queued)
+    for ticket in tickets[1:3]:
+        scheduler.release(ticket)
+    assert gauges() == (active, queued)
+
+
+def test_sequential_transfers_share_the_rate(clock):
+    """
+    A client that makes its transfers one after another (a batch, a recursive get) mustn't get a new burst
+    for each of them
+    """
+    scheduler = TransferScheduler(client_rate=1000)
+    waited = 0
+    for _ in range(5):
+        ticket = scheduler.request("client", lambda: None)
+        delay = ticket.delay(1000)
+        clock.now += delay
+        waited += delay
+        scheduler.release(ticket)
+    assert waited == pytest.approx(4)
+
+
+def test_idle_buckets_are_dropped_once_full(clock):
+    scheduler = TransferScheduler(client_rate=1000)
+    ticket = scheduler.request("client", lambda: None)
+    ticket.delay(5000)
+    scheduler.release(ticket)
+
+    clock.now += Constants.TRANSFER_BUCKET_SWEEP_SECONDS
+    scheduler.request("other", lambda: None)
+    assert scheduler.request("client", lambda: None).delay(1000) == 0
@@ -0,0 +1,98 @@
+import os
+import pytest
+from models import TreePack as ClientTreePack
+from src import TreePack as ServerTreePack
+from src.server_helper import Constants, walk_tree
+from conftest import split
+
+FILES = {
+    "empty": b"",
+    "small.txt": b"hello",
+    "sub/medium.bin": bytes(range(256)) * 300,
+    "sub/deeper/big.bin": os.urandom(3 * Constants.STREAM_BUFFER_SIZE + 7),
+}
+
+
+@pytest.fixture
+def source(tmp_path) -> str:
+    root = tmp_path / "source"
+    for relative_path, data in FILES.items():
+        (root / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (root / relative_path).write_bytes(data)
+    (root / "empty_directory").mkdir()
+    return str(root)
+
+
+def transfer(sender, receiver, pieces) -> None:
+    """
+    Feeds the whole stream of sender to receiver, cut in the given pieces (a function of the stream)
+    """
+    receiver.open()
+    stream = b"".join(sender.chunks())
+    finished = [receiver.feed(piece) for piece in pieces(stream)]
+    assert finished[-1] and not any(finished[:-1])
+    receiver.close()
+
+
+@pytest.mark.parametrize("sender_module, receiver_module", [
+    (ServerTreePack, ServerTreePack),
+    (ClientTreePack, ServerTreePack),
+    (ServerTreePack, ClientTreePack),
+], ids=["server-to-server", "upload", "download"])
+@pytest.mark.parametrize("cut", ["whole", "random", "bytes"])
+def test_split_stream(tmp_path, source, rng, sender_module, receiver_module, cut):
+    directories, files = walk_tree(source)
+    paths = [path for path, _ in files]
+    pieces = {"whole": lambda stream: [stream],
+              "random": lambda stream: split(stream, rng, 5000),
+              "bytes": lambda stream: [stream[i:i + 1] for i in range(len(stream))]}[cut]
+    if cut == "bytes":
+        paths = [path for path in paths if len(FILES[path]) < 100000]
+    sender = sender_module.PackSender(source, paths)
+    receiver = receiver_module.PackReceiver(str(tmp_path / "destination"), paths, directories)
+    transfer(sender, receiver, pieces)
+
+    assert receiver.failed == []
+    assert receiver.received_files == len(paths)
+    for path in paths:
+        assert (tmp_path / "destination" / path).read_bytes() == FILES[path]
+    assert (tmp_path / "destination" / "empty_directory").is_dir()
+    assert not [name for _, _, names in os.walk(tmp_path / "destination") for name in names
+                if name.endswith(Constants.PARTIAL_SUFFIX)]
+
+
+def test_missing_and_existing_files(tmp_path, source):
+    paths = ["small.txt", "gone", "sub/medium.bin"]
+    destination = tmp_path / "destination"
+    destination.mkdir()
+    (destination / "small.txt").write_bytes(b"keep me")
+    receiver = ServerTreePack.PackReceiver(str(destination), paths)
+    transfer(ServerTreePack.PackSender(source, paths), receiver, lambda stream: [stream])
+
+    assert receiver.failed == [("small.txt", Constants.FILE_EXISTS), ("gone", Constants.FILE_DOESNT_EXISTS)]
+    assert (destination / "small.txt").read_bytes() == b"keep me"
+    assert (destination / "sub" / "medium.bin").read_bytes() == FILES["sub/medium.bin"]
+
+
+def test_corrupted_file_isnt_kept(tmp_path, source):
+    paths = ["small.txt", "sub/medium.bin"]
+    stream = bytearray(b"".join(ServerTreePack.PackSender(source, paths).chunks()))
+    stream[ServerTreePack.PackSender.ENTRY.size] ^= 0xff
+    receiver = ServerTreePack.PackReceiver(str(tmp_path / "destination"), paths)
+    transfer(ServerTreePack.PackSender(source, []), receiver, lambda _: [bytes(stream)])
+
+    assert receiver.failed == [("small.txt", Constants.INVALID_CHECKSUM)]
+    assert not (tmp_path / "destination" / "small.txt").exists()
+    assert not (tmp_path / "destination" / ("small.txt" + Constants.PARTIAL_SUFFIX)).exists()
+
+
+def test_interrupted_stream(tmp_path, source):
+    paths = ["small.txt", "sub/deeper/big.bin"]
+    stream = b"".join(ServerTreePack.PackSender(source, paths).chunks())
+    receiver = ServerTreePack.PackReceiver(str(tmp_path / "destination"), paths)
+    receiver.open()
+    assert not receiver.feed(stream[:len(stream) // 2])
+    receiver.close()
+
+    assert receiver.pending_files() == ["sub/deeper/big.bin"]
+    assert os.listdir(tmp_path / "destination" / "sub" / "deeper") == []